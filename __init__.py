@@ -1,5 +1,8 @@
 #$Id$
-from aggregation import Quick, Accurate
+from aggregation import Quick, Accurate, WriteBehind, retry_deadlocks, is_deadlock
+from bulk import bulk_insert
+from stripes import striped, fold_stripes
+from rollup import Rollup, bucket
 from library import *
 from convert_expr import Source, Target, SourceRecalcOnly
 # vim:ts=4:sw=4:expandtab
@@ -9,6 +9,10 @@ Authors: Paul Colomiets <pc@gafol.net>, Svilen Dobrev <svilen_dobrev@sourceforge
 '''
 
 from sqlalchemy.orm import MapperExtension
+try:
+    from sqlalchemy.orm.interfaces import SessionExtension
+except ImportError:
+    SessionExtension = object   #SA0.3 - no flush-scoped hooks, hence no coalescing
 try:
     from sqlalchemy.orm import EXT_CONTINUE
     _v03 = False
@@ -19,9 +23,12 @@ except ImportError:
 import sqlalchemy.orm.attributes
 import sqlalchemy.orm.properties
 import warnings
+import operator
+import weakref
+from contextlib import contextmanager
 
 #XXX no such thing as ifnull XXX - use coalesce, case, whatever
-from sqlalchemy import func, select, bindparam, case
+from sqlalchemy import func, select, bindparam, case, or_, and_, text, literal_column, exists
 
 def _func_type( f, *args, **kargs):
     type = kargs.pop( 'type', None) or kargs.pop( 'type_', None)
@@ -33,11 +40,17 @@ class Func( object):
         me.name = name
         me.default_func = getattr( func, name)
         me.replacement_expr = replacement_expr
+        me._translated = dict()     #db funcname -> func
     def translate( me, func_checker):
         fname = func_checker( me.name)
-        if not fname: return me.replacement_expr
-        if fname == me.name: return me.default_func
-        return getattr( func, fname)
+        try:
+            return me._translated[ fname]
+        except KeyError: pass
+        if not fname: f = me.replacement_expr
+        elif fname == me.name: f = me.default_func
+        else: f = getattr( func, fname)
+        me._translated[ fname] = f
+        return f
     def __call__( me, *args, **kargs):
         #print me.name, args, kargs
         func_checker = kargs.pop( 'func_checker', None )
@@ -83,7 +96,16 @@ public virtual methods/attributes - must be overloaded:
     func_checker( funcname) will return True if the func is supported by db
 
     filter_expr = ... #either with var-bindparams, or const-bindparams (getattr from instance)
+
+optional virtual methods - delta protocol (see Quick coalesce=):
+    def delta( self, action, instance):
+    def apply_delta( self, func_checker, value):
+    def delta4array( self, array):
+  and conditional recalc:
+    def conditional_recalc( self, action, instance):
+    def recalc_if( self, func_checker, value, recalc):
 """
+    __slots__ = ()
 
     if (hasattr( sqlalchemy.orm.attributes, 'InstanceState')    #>v3463
        or hasattr( sqlalchemy.orm.attributes, 'state') ):       #??v5970
@@ -94,6 +116,26 @@ public virtual methods/attributes - must be overloaded:
                 Raises KeyError if no original state exists
                 """
                 return instance._state.committed_state[ attribute]
+        elif hasattr( sqlalchemy.orm.attributes, 'instance_state'):     #v0.5
+            @staticmethod
+            def _orig( instance, attribute,
+                        _state= sqlalchemy.orm.attributes.instance_state,
+                        _never= sqlalchemy.orm.attributes.NEVER_SET,
+                        _no= sqlalchemy.orm.attributes.NO_VALUE):
+                """Returns original value of instance attribute - as of get_history(),
+                but straight from the committed state, not making a History
+                """
+                state = _state( instance)
+                original = state.committed_state.get( attribute, _never)
+                if original is _never:      #unchanged
+                    d = state.dict
+                    if attribute in d: return d[ attribute]
+                elif original is not _no:
+                    return original
+                added,unchanged,deleted = getattr( instance.__class__, attribute).get_history( instance)
+                r = deleted or unchanged
+                assert r    #raise KeyError ?? should never happen anyway
+                return r[0]
         else:
             @staticmethod
             def _orig( instance, attribute):
@@ -120,10 +162,49 @@ public virtual methods/attributes - must be overloaded:
     def onrecalc_old( self, func_checker, instance):
         return self.onrecalc( func_checker, instance, True)
 
+    #delta protocol - optional; allows Quick to combine the contributions of
+    #many instances into one update per target row (see Quick coalesce=)
+    _delta_combine = None   #how two deltas are combined: operator.add, max, min
+    stripes = None          #number of stripe rows for the deltas, see stripes.py
+    distinct = False        #counted via refcount side table, see distinct.py
+    def delta( self, action, instance):
+        '''python-side contribution of instance for action;
+        None if the change cannot be expressed as delta (then action-method is used)'''
+        return None
+    def apply_delta( self, func_checker, value):
+        'sql expression applying (combined) delta value over the target column; do overload'
+        raise NotImplementedError
+    def recalc4action( self, action):
+        'the old-flag if action is done by plain recalc (see _Agg_1Target_1Source), else None'
+        return None
+    def conditional_recalc( self, action, instance):
+        '''(value, old-flag) if action needs recalc only when the target holds value
+        (e.g. the extreme of Max leaving); else None'''
+        return None
+    def recalc_if( self, func_checker, value, recalc):
+        'sql expression doing recalc only if the target holds value; do overload'
+        raise NotImplementedError
+    def delta4array( self, array):
+        '''vectorized delta of oninsert over numpy structured array of source rows -
+        array (or scalar) of per-row values to combine; None if not possible'''
+        return None
+    def recalc4set( self):
+        '''dict of target-column names/subselects recalculating them for any number
+        of target rows at once, i.e. correlated to the target table; do overload'''
+        raise NotImplementedError
+    def cascades( self, lower):
+        '''if a delta of aggregation lower, into the source column of this one,
+        is a delta of this one as is (e.g. Sum of Sums) - see Quick cascade='''
+        return False
+
 ###################
-from convert_expr import Converter
+from convert_expr import Converter, _bindparam, split_equijoin, split_range
+from stripes import stripes_table, StripedGroup
+from distinct import DistinctSide
 
 class _Agg_1Target_1Source( _Aggregation):
+    __slots__ = ( 'target', 'source', 'filter_expr', 'corresp_src_cols', 'stripes',
+                  '_filter4recalc', '_filter4mapper', '_filter4set', '_equijoin', '_range', )
     def __init__( self, target, source, filter_expr =None, corresp_src_cols ={}):
         """aggregation of single source-column into single target-column
         target - column where to store value of aggregation
@@ -138,6 +219,12 @@ class _Agg_1Target_1Source( _Aggregation):
         self.source = source
         self.filter_expr = filter_expr #also used for comparison when combining with other aggregations
         self.corresp_src_cols = corresp_src_cols
+        self.stripes = None
+        self._filter4recalc = None
+        self._filter4mapper = None
+        self._filter4set = None
+        self._equijoin = None   #( [(source_expr, target_col)..], [source-only clauses..] ) - see split_equijoin
+        self._range = None      #( [(source_expr, target_col)..], (source_expr, op, target_col), [..] ) - see split_range
 
     def _initialize( self, default_table =None):
         if self.filter_expr:
@@ -148,6 +235,14 @@ class _Agg_1Target_1Source( _Aggregation):
                     )
             self._filter4recalc = Converter.apply( inside_mapperext= False, **kargs)
             self._filter4mapper = Converter.apply( inside_mapperext= True, **kargs)
+            self._filter4set = self.filter_expr     #as is - correlated to target table
+            self._equijoin = split_equijoin( self.filter_expr, self.target.table)
+            self._range = split_range( self.filter_expr, self.target.table)
+
+    def _set_stripes( self, stripes):
+        if stripes:
+            self.stripes = stripes
+            stripes_table( self.target)     #in the metadata from now on
 
     target_table = property( lambda self: self.target.table)
     def target_or_0( self, func_checker):
@@ -156,9 +251,6 @@ class _Agg_1Target_1Source( _Aggregation):
     def value( self, instance): return getattr( instance, self.source.name)
     def oldv(  self, instance): return self._orig( instance, self.source.name)
 
-    filter_expr = None
-    _filter4recalc = None
-    _filter4mapper = None
     def get_filter_and_bindings( self, (fexpr,bindings), instance, old):
         'return either with var-bindparams, or const-bound-bindparams (value= getattr(instance))'
         if callable( fexpr): fexpr = fexpr( instance, old)
@@ -184,6 +276,21 @@ class _Agg_1Target_1Source( _Aggregation):
         fexpr,vbindings = self.get_filter_and_bindings( self._filter4recalc, instance, old)
         return select( [self.sqlfunc4column( self.source) ], fexpr ), vbindings
 
+    def recalc4action( self, action):
+        '''the old-flag if action-method is the plain onrecalc (i.e. statement shape
+        does not depend on the instance), else None'''
+        if callable( self._filter4recalc[0]): return None
+        recalc = _Agg_1Target_1Source.onrecalc.im_func
+        klas = self.__class__
+        if klas.onrecalc.im_func is not recalc: return None
+        m = getattr( klas, action).im_func
+        if m is recalc: return False
+        if m is _Aggregation.onrecalc_old.im_func: return True
+        return None
+
+    def recalc4set( self):
+        return { self.target.name: select( [self.sqlfunc4column( self.source) ], self._filter4set ) }
+
     def setup_fkey( self, key, grouping_attribute):
         'used as fallback if no other filters are setup'
         self._filter4recalc = (
@@ -194,6 +301,8 @@ class _Agg_1Target_1Source( _Aggregation):
                 (key.column == bindparam( Converter._pfx+ grouping_attribute)),
                 ( grouping_attribute, )
             )
+        self._filter4set = (key.parent == key.column)
+        self._equijoin = [ (key.parent, key.column) ], []
         #the getattr(instance, name, old) part is done in aggregator/mapperext
 
 
@@ -202,6 +311,609 @@ class _Agg_1Target_1Source( _Aggregation):
 
 ################
 import sqlalchemy.orm
+from sqlalchemy.orm import mapperlib
+from sqlalchemy.sql.expression import Update, Insert, ClauseElement
+try:
+    from sqlalchemy.ext.compiler import compiles
+except ImportError:
+    compiles = None     #<SA0.5.4 - RETURNING only on postgres
+
+class _UpdateReturning( Update):
+    'UPDATE .. RETURNING columns, for sqlite'
+    def __init__( self, table, whereclause, values, columns):
+        Update.__init__( self, table, whereclause, values= values)
+        self.returning_cols = columns
+
+if compiles:
+    @compiles( _UpdateReturning)
+    def _compile_update_returning( element, compiler, **kw):
+        return (compiler.visit_update( element) + ' RETURNING ' +
+                ', '.join( compiler.process( c) for c in element.returning_cols))
+
+_FUSED = '/*fused*/'
+class _FusedValue( ClauseElement):
+    '''the row-value subselect of _FusedUpdate, as value of its first column;
+    compiled in place (keeping the order of binds), then marked for the (x,y,z) = ..'''
+    def __init__( self, select):
+        self.select = select
+
+class _FusedUpdate( Update):
+    '''UPDATE with several target columns from one row-value subselect:
+        UPDATE t SET a=.., (x,y,z) = (SELECT max(..), count(*), sum(..) FROM .. WHERE ..)
+    i.e. one scan of the source rows instead of one per column'''
+    returning_cols = None
+    def __init__( self, table, whereclause, values, names, fused, **kwargs):
+        values = dict( values)
+        values[ names[0]] = _FusedValue( fused)
+        Update.__init__( self, table, whereclause, values= values, **kwargs)
+        self.fused = names, fused
+
+if compiles:
+    @compiles( _FusedValue)
+    def _compile_fused_value( element, compiler, **kw):
+        return _FUSED + '(' + compiler.process( element.select) + ')'
+
+    @compiles( _FusedUpdate)
+    def _compile_fused_update( element, compiler, **kw):
+        #plain UPDATE, then x=<mark>(SELECT ..) turned into (x,y,z) = (SELECT ..)
+        table = element.table
+        names = element.fused[0]
+        quote = compiler.preparer.quote
+        columns = [ quote( table.c[ n].name, table.c[ n].quote) for n in names ]
+        text = compiler.visit_update( element)      #+postgres_returning, if any
+        mark = columns[0] + '=' + _FUSED
+        assert mark in text, text
+        text = text.replace( mark, '(%s) = ' % ', '.join( columns), 1)
+        if element.returning_cols and 'postgres_returning' not in element.kwargs:
+            text += ' RETURNING ' + ', '.join( compiler.process( c) for c in element.returning_cols)
+        return text
+
+class _Upsert( Insert):
+    '''INSERT of a target row, or if its key is already there, UPDATE of that row:
+        INSERT INTO t (k,a) VALUES (:k,:a) ON CONFLICT (k) DO UPDATE SET a = t.a + excluded.a
+    (ON DUPLICATE KEY UPDATE on mysql). Without sets, only ensures the row is there.'''
+    returning_cols = None
+    def __init__( self, table, values, keys, sets):
+        Insert.__init__( self, table, values= values)
+        self.conflict = keys, sets
+
+if compiles:
+    @compiles( _Upsert)
+    def _compile_upsert( element, compiler, **kw):
+        table = element.table
+        keys, sets = element.conflict
+        quote = compiler.preparer.quote
+        text = compiler.visit_insert( element)
+        if compiler.dialect.name == 'mysql':
+            text += ' ON DUPLICATE KEY UPDATE '
+            if not sets: sets = { keys[0].name: keys[0] }   #k=k, i.e. nothing
+        else:
+            text += ' ON CONFLICT (%s) DO ' % ', '.join( quote( c.name, c.quote) for c in keys)
+            if not sets: return text + 'NOTHING'
+            text += 'UPDATE SET '
+        compiler.stack.append( {'from': set([ table ])})
+        text += ', '.join( quote( table.c[ n].name, table.c[ n].quote) + '=' + compiler.process( v)
+                            for n,v in sorted( sets.iteritems()))
+        compiler.stack.pop( -1)
+        if element.returning_cols:
+            text += ' RETURNING ' + ', '.join( compiler.process( c) for c in element.returning_cols)
+        return text
+
+def _upserted( column, dialect):
+    'the value being inserted into column, inside the update-if-there part of _Upsert'
+    name = dialect.identifier_preparer.quote( column.name, column.quote)
+    fmt = dialect.name == 'mysql' and 'VALUES(%s)' or 'excluded.%s'
+    return literal_column( fmt % name, type_= column.type)
+
+def _unique_keys( table):
+    'column sets of primary key, unique constraints and unique indexes'
+    keys = [ set( table.primary_key.columns) ]
+    for c in table.constraints:
+        if isinstance( c, sqlalchemy.schema.UniqueConstraint):
+            keys.append( set( c.columns))
+    for i in table.indexes:
+        if i.unique:
+            keys.append( set( i.columns))
+    return keys
+
+def _upsert_keys( ag):
+    '''[(target column, value expression)..] identifying the target row of aggregation
+    group ag (the values with bindparams as of _filter4mapper), if its filter is only
+    equalities of a unique key of the target table to source values; else None'''
+    fexpr = ag._filter4mapper[0]
+    if callable( fexpr): return None
+    split = split_equijoin( fexpr, ag.target_table)
+    if not split or split[1]: return None
+    keys = [ (t, s) for s,t in split[0] ]
+    columns = set( t for t,s in keys)
+    if len( columns) != len( keys) or columns not in _unique_keys( ag.target_table): return None
+    return keys
+
+def _is_postgres( dialect):
+    return dialect.name in ('postgres', 'postgresql')
+
+_dialect_keys = weakref.WeakKeyDictionary()     #dialect -> _dialect_key
+def _dialect_key( dialect):
+    '''what the compiled statements are cached by, instead of the dialect itself:
+    a compiled statement refers to its dialect, so a dialect as (weak) key would
+    never go, and they may be made per engine, or per call (see triggers).
+    Same key - same sql text and binds'''
+    try:
+        return _dialect_keys[ dialect]
+    except KeyError: pass
+    version = getattr( dialect, 'server_version_info', None)
+    if callable( version): version = None      #SA0.5 - a method, needs a connection
+    r = _dialect_keys[ dialect] = (dialect.__class__, dialect.paramstyle,
+                getattr( dialect.dbapi, 'sqlite_version_info', None), version)
+    return r
+
+_upserts = weakref.WeakKeyDictionary()       #dialect -> bool
+def _supports_upsert( dialect):
+    try:
+        return _upserts[ dialect]
+    except KeyError: pass
+    if not compiles:
+        r = False
+    elif _is_postgres( dialect) or dialect.name == 'mysql':
+        r = True    #postgres >= 9.5
+    elif dialect.name == 'sqlite':
+        r = getattr( dialect.dbapi, 'sqlite_version_info', ()) >= (3,24)
+    else:
+        r = False
+    _upserts[ dialect] = r
+    return r
+
+_returning = weakref.WeakKeyDictionary()     #dialect -> bool
+def _supports_returning( dialect):
+    try:
+        return _returning[ dialect]
+    except KeyError: pass
+    if _is_postgres( dialect):
+        r = True
+    elif dialect.name == 'sqlite':
+        r = bool( compiles) and getattr( dialect.dbapi, 'sqlite_version_info', ()) >= (3,35)
+    else:
+        r = False
+    _returning[ dialect] = r
+    return r
+
+_rowvalue = weakref.WeakKeyDictionary()     #dialect -> bool
+def _supports_rowvalue( dialect):
+    'UPDATE .. SET (a,b) = (SELECT ..)'
+    try:
+        return _rowvalue[ dialect]
+    except KeyError: pass
+    if not compiles:
+        r = False
+    elif _is_postgres( dialect):
+        r = True
+    elif dialect.name == 'sqlite':
+        r = getattr( dialect.dbapi, 'sqlite_version_info', ()) >= (3,15)
+    else:
+        r = False
+    _rowvalue[ dialect] = r
+    return r
+
+_funcs4db_replacement = dict(
+    mysql= dict(
+        min= 'least',       #use None if no such func
+        max= 'greatest',    #funcs not in here are considered available
+    ),
+    sqlite  = {
+        'if' : None,        #iif() since 3.32, see _func_checker4dialect
+        #min/max( a,b,..) are scalar there, as least/greatest
+    },
+    postgres= {
+        'if' : None,
+        'min': 'least',       #use None if no such func
+        'max': 'greatest',    #funcs not in here are considered available
+    },
+)
+
+_func_checkers = weakref.WeakKeyDictionary()    #dialect -> func_checker; dialects may be made per call, see triggers
+def _func_checker4dialect( dialect):
+    '''the func_checker( funcname) for dialect: the name of the db function to use,
+    or None if there is no such - to be replaced by an expression, see Func.
+    Made once per dialect, i.e. per engine.'''
+    try:
+        return _func_checkers[ dialect]
+    except KeyError: pass
+    name = _is_postgres( dialect) and 'postgres' or dialect.name
+    frepl = dict( _funcs4db_replacement.get( name) or ())
+    if name == 'sqlite' and getattr( dialect.dbapi, 'sqlite_version_info', ()) >= (3,32):
+        frepl[ 'if'] = 'iif'
+    def func_checker( funcname):
+        return frepl.get( funcname, funcname)
+    func_checker.dialect = name
+    _func_checkers[ dialect] = func_checker
+    return func_checker
+
+def _update_returning( table, whereclause, values, columns, dialect, fused =None):
+    if fused:
+        kwargs = _is_postgres( dialect) and dict( postgres_returning= columns) or {}
+        u = _FusedUpdate( table, whereclause, values, *fused, **kwargs)
+    elif _is_postgres( dialect):
+        u = table.update( whereclause, values= values, postgres_returning= columns)
+    else:
+        return _UpdateReturning( table, whereclause, values, columns)
+    u.returning_cols = columns
+    return u
+
+#connection: True while the statements on it are maintained already
+#(of mapper flush, or of the maintenance itself) - see intercept
+_flushing = weakref.WeakKeyDictionary()
+
+_mappers = dict()       #table -> primary mapper
+def _mapper4table( table):
+    try:
+        return _mappers[ table]
+    except KeyError: pass
+    for m in list( mapperlib._mapper_registry):
+        if m.local_table is table and not m.non_primary:
+            break
+    else:
+        m = None
+    _mappers[ table] = m
+    return m
+
+def _populate( session, table, columns, rows, dialect):
+    '''put returned rows of (primary key + target columns) into the target
+    instances present in the session'''
+    mapper = _mapper4table( table)
+    npk = len( mapper.primary_key)
+    procs = [ c.type.dialect_impl( dialect).result_processor( dialect) for c in columns ]
+    keys = [ mapper._columntoproperty[ c].key for c in columns[ npk:] ]
+    identity_map = session.identity_map
+    for row in rows:
+        row = [ v if p is None else p( v) for p,v in zip( procs, row) ]
+        obj = identity_map.get( mapper.identity_key_from_primary_key( row[ :npk]))
+        if obj is None: continue
+        for key,v in zip( keys, row[ npk:]):
+            sqlalchemy.orm.attributes.set_committed_value( obj, key, v)
+
+################ instrumentation - see Quick.instrument()
+import time as _time
+import random as _random
+import logging
+log = logging.getLogger( 'aggregator')
+
+class Counter( object):
+    __slots__ = 'updates recalcs rows seconds'.split()
+    def __init__( self):
+        self.updates = self.recalcs = self.rows = 0
+        self.seconds = 0.0
+    def as_dict( self):
+        return dict( (k, getattr( self, k)) for k in self.__slots__)
+    def __repr__( self):
+        return 'Counter(%s)' % ', '.join( '%s=%s' % kv for kv in sorted( self.as_dict().iteritems()))
+
+_recalc_kinds = ('recalc', 'recalc_if')
+
+class Stats( object):
+    '''counters of the statements issued by one extension:
+        aggregations:   { aggregation: Counter }
+        groups:         { (target_table name, filter): Counter }
+    per statement: updates/recalcs - 1 if it holds atomic update/(any) recalc,
+    rows - its rowcount, seconds - its wall time if timing (shared by all
+    aggregations in it); callback( ext, aggs, kinds, action, rowcount, seconds) if given;
+    action is the mapper one (oninsert, ...), or None for the deferred/set-based'''
+    def __init__( self, timing =False, callback =None):
+        self.timing = timing
+        self.callback = callback
+        self.aggregations = dict()
+        self.groups = dict()
+        self._labels = dict()     #id(aggs): group key
+
+    def start( self):
+        if self.timing: return _time.time()
+        return None
+
+    def group_key( self, aggs):
+        try:
+            return self._labels[ id(aggs)]
+        except KeyError: pass
+        ag = aggs[0]
+        fexpr = ag._filter4mapper[0]
+        key = self._labels[ id(aggs)] = (ag.target_table.name, callable( fexpr) and 'callable' or str( fexpr))
+        return key
+
+    def record( self, ext, aggs, kinds, result, t0, action =None):
+        seconds = t0 is not None and _time.time() - t0 or 0.0
+        rows = getattr( result, 'rowcount', 0) or 0
+        if rows < 0: rows = 0
+        anyrecalc = False
+        for a,kind in zip( aggs, kinds):
+            if kind is None: continue   #not in this statement
+            c = self.aggregations.get( a)
+            if c is None: c = self.aggregations[ a] = Counter()
+            if kind in _recalc_kinds:
+                c.recalcs += 1
+                anyrecalc = True
+            else:
+                c.updates += 1
+            c.rows += rows
+            c.seconds += seconds
+        key = self.group_key( aggs)
+        c = self.groups.get( key)
+        if c is None: c = self.groups[ key] = Counter()
+        if anyrecalc: c.recalcs += 1
+        else: c.updates += 1
+        c.rows += rows
+        c.seconds += seconds
+        if self.callback:
+            self.callback( ext, aggs, kinds, action, rows, seconds)
+
+    def reset( self):
+        self.aggregations.clear()
+        self.groups.clear()
+
+    @staticmethod
+    def name( a):
+        target = getattr( a, 'target', None)
+        if target is None: target = a.target_table
+        return '%s(%s)' % (a.__class__.__name__, target)
+
+    def report( self):
+        'plain dict, e.g. for json'
+        return dict(
+            aggregations= dict( (self.name( a), c.as_dict()) for a,c in self.aggregations.iteritems()),
+            groups= dict( ('%s: %s' % k, c.as_dict()) for k,c in self.groups.iteritems()),
+        )
+
+def _merge_change( pending, ext, aggs, bindings, deltas, recalcs =()):
+    '''merge a change of one target row into pending, a dict
+        (id(aggs), bindings) -> [ ext, aggs, bindings, {agg:delta}, set( aggs to recalc) ]
+    return True if the target row was not pending yet'''
+    key = (id(aggs), tuple( sorted( bindings.iteritems() )))
+    entry = pending.get( key)
+    if entry is None:
+        pending[ key] = [ ext, aggs, bindings, dict( deltas), set( recalcs) ]
+        return True
+    combined = entry[3]
+    for a,d in deltas.iteritems():
+        if a in combined:
+            d = a._delta_combine( combined[a], d)
+        combined[a] = d
+    entry[4].update( recalcs)
+    return False
+
+def _lock_key( aggs, values):
+    '''order of target rows for locking, same in all sessions/processes:
+    (target table name, values of the filter bindings)'''
+    return aggs[0].target_table.name, tuple( values)
+
+def _lock_order( entry):
+    'of a pending entry - see _merge_change()'
+    aggs, bindings = entry[1], entry[2]
+    return _lock_key( aggs, [ bindings.get( k) for k in aggs[0]._filter4mapper[1] ])
+
+#mysql deadlock; postgres deadlock, serialization failure
+_deadlock_codes = set([ 1213, '40P01', '40001' ])
+def is_deadlock( exc):
+    'is exc (DBAPIError or the dbapi one) a deadlock - the transaction is aborted'
+    orig = getattr( exc, 'orig', exc)
+    code = getattr( orig, 'pgcode', None)
+    if code is None:
+        args = getattr( orig, 'args', None) or (None,)
+        code = args[0]
+    try:
+        return code in _deadlock_codes
+    except TypeError:   #unhashable
+        return False
+
+def retry_deadlocks( func, tries =3, delay =0.05, rollback =None):
+    '''call func() - a whole transaction, e.g. changes + session.flush() + commit -
+    and again if it fails on deadlock, up to tries times in all; before each
+    retry, rollback() is called (e.g. session.rollback) and it waits
+    delay * attempt, randomized. Other errors, or the last deadlock, propagate.'''
+    for attempt in range( 1, tries+1):
+        try:
+            return func()
+        except Exception, e:
+            if attempt >= tries or not is_deadlock( e): raise
+            log.info( 'deadlock, retry %d of %d: %s', attempt, tries-1, e)
+            if rollback is not None: rollback()
+            _time.sleep( delay * attempt * (0.5 + _random.random()))
+
+class _FlushState( SessionExtension):
+    """Per-session collector of aggregation deltas pending until the flush ends;
+    then each distinct target row gets one combined update.
+    Installed into session.extensions on first use - see Quick coalesce=
+    """
+    def __init__( self):
+        self.reset()
+    def reset( self, *a, **k):
+        self.pending = dict()   #see _merge_change()
+        self.connection = None
+        self.refs = dict()      #id -> target instance, to reload after flush
+    before_flush = after_rollback = reset
+
+    @classmethod
+    def of( klas, session):
+        'find or install the one for session; None if no session or it has no extensions'
+        extensions = getattr( session, 'extensions', None)
+        if extensions is None: return None
+        for e in extensions:
+            if e.__class__ is klas: return e
+        e = klas()
+        extensions.append( e)
+        return e
+
+    def add( self, ext, aggs, bindings, deltas, connection, session =None):
+        if _merge_change( self.pending, ext, aggs, bindings, deltas):
+            self.connection = connection
+            if len( self.pending) >= ext.max_pending:
+                self.emit( session)     #spill
+
+    def emit( self, session =None):
+        pending = self.pending
+        self.pending = dict()
+        for ext, aggs, bindings, deltas, recalcs in sorted( pending.itervalues(), key= _lock_order):
+            ext._apply_deltas( aggs, deltas, bindings, self.connection, session)
+
+    def after_flush( self, session, flush_context):
+        self.emit( session)
+
+    _refs_chunk = 500
+    def after_flush_postexec( self, session, flush_context):
+        'reload the collected targets, with one select per class (and chunk)'
+        refs = self.refs
+        self.refs = dict()
+        by_class = dict()
+        for g in refs.itervalues():
+            by_class.setdefault( g.__class__, []).append( g)
+        for klas,objs in by_class.iteritems():
+            mapper = sqlalchemy.orm.object_mapper( objs[0])
+            pk = mapper.primary_key
+            keys = [ mapper.primary_key_from_instance( g) for g in objs ]
+            for i in range( 0, len( keys), self._refs_chunk):
+                part = keys[ i:i+self._refs_chunk]
+                if len( pk) == 1:
+                    where = pk[0].in_( [ k[0] for k in part ])
+                else:
+                    where = or_( *[ and_( *[ c == v for c,v in zip( pk, k) ]) for k in part ])
+                session.query( klas).populate_existing().filter( where).all()
+
+
+def _overridden( a, name):
+    'the bound method of a, if its class overloads that of _Aggregation; else None'
+    if getattr( a.__class__, name).im_func is getattr( _Aggregation, name).im_func: return None
+    return getattr( a, name)
+
+class _GroupPlan( object):
+    '''the per-group part of Quick._make_change1, precomputed once (at _setup):
+    filter binding names and their bindparam names (with Converter._pfx),
+    the target row key if upsertable (see _upsert_keys), the side tables of
+    distinct counts, and per action, what each aggregation does - see steps()'''
+    __slots__ = ( 'aggs', 'static', 'bindings', 'striped', 'keys', 'cascade', 'distinct', '_steps')
+    def __init__( self, aggs, striped =None, distinct =True):
+        ag = aggs[0]
+        pfx = Converter._pfx
+        self.aggs = aggs
+        self.static = not callable( ag._filter4mapper[0])
+        self.bindings = tuple( (pfx+k, k) for k in ag._filter4mapper[1])
+        self.striped = striped
+        self.keys = _upsert_keys( ag)
+        self.cascade = ()   #_CascadeSteps, see Quick cascade=
+        self.distinct = dict( (a, DistinctSide( a, self)) for a in aggs if distinct and a.distinct)
+        self._steps = dict()
+
+    def steps( self, action):
+        '''per aggregation: (agg, delta or None, recalc_old, conditional_recalc or None,
+        recalc bindings, delta key, old key, striped, DistinctSide or None) - as of Quick._make_change1'''
+        try:
+            return self._steps[ action]
+        except KeyError: pass
+        pfx = Converter._pfx
+        steps = []
+        for a in self.aggs:
+            recalc_old = a.recalc4action( action)
+            rbindings = ()
+            if a._filter4recalc and not callable( a._filter4recalc[0]):
+                rbindings = tuple( (pfx+k, k) for k in a._filter4recalc[1])
+            steps.append( (a,
+                _overridden( a, 'delta'),
+                recalc_old,
+                recalc_old is None and _overridden( a, 'conditional_recalc') or None,
+                rbindings,
+                pfx + Quick._delta_key( a),
+                pfx + Quick._old_key( a),
+                self.striped is not None and bool( a.stripes),
+                action in DistinctSide.actions and self.distinct.get( a) or None,
+                ))
+        r = self._steps[ action] = tuple( steps)
+        return r
+
+def _upper_groups( table):
+    '(ext, aggs) of the aggregation groups of the Quick extensions of the mapper of table'
+    mapper = _mapper4table( table)
+    if mapper is None: return []
+    r = []
+    for ext in mapper.extension:
+        if isinstance( ext, Quick):
+            ext._setup( mapper)
+            r += [ (ext, aggs) for aggs in ext.aggregations.itervalues() ]
+    return r
+
+class _CascadeStep( object):
+    '''propagation of the changes of one (lower) aggregation group into a group
+    of an upper extension, which source table is the lower target table:
+        UPDATE upper SET .. WHERE EXISTS (SELECT 1 FROM lower WHERE <the lower
+                target row> AND <upper filter, correlated>)
+    feeds - per upper aggregation, the lower one which target is its source, or None'''
+    __slots__ = ( 'ext', 'aggs', 'feeds', 'where', 'steps', '_statements')
+    def __init__( self, ext, aggs, feeds, where):
+        self.ext = ext
+        self.aggs = aggs
+        self.feeds = feeds
+        self.where = where
+        self.steps = ()
+        self._statements = dict()
+
+    @staticmethod
+    def _key( a):
+        return Converter._pfx + '_c_' + a.target.name
+
+    def changes( self, lower):
+        '''kinds, {agg: (kind, delta)} of the upper aggregations, from the
+        lower changes {agg: (kind, delta)}: a delta if the upper one cascades it,
+        else recalc'''
+        kinds = []
+        changes = dict()
+        for a,f in zip( self.aggs, self.feeds):
+            c = f is not None and lower.get( f) or None
+            if c is not None:
+                kind, d = c
+                if kind != 'delta' or not a.cascades( f):
+                    c = 'recalc', None
+                changes[ a] = c
+                kinds.append( c[0])
+            else:
+                kinds.append( None)
+        return tuple( kinds), changes
+
+    def statement( self, kinds, dialect):
+        key = (kinds, _dialect_key( dialect))
+        try:
+            return self._statements[ key]
+        except KeyError: pass
+        func_checker = _func_checker4dialect( dialect)
+        values = dict()
+        for a,kind in zip( self.aggs, kinds):
+            if kind == 'delta':
+                values[ a.target.name] = a.apply_delta( func_checker,
+                                            _bindparam( self._key( a), type_= a.target.type))
+            elif kind == 'recalc':
+                values.update( a.recalc4set())
+        stmt = self.aggs[0].target_table.update( self.where, values= values)
+        r = self._statements[ key] = stmt.compile( dialect= dialect, column_keys= [])
+        return r
+
+def _cascade_steps( aggs, where, path):
+    '''the _CascadeSteps propagating the changes of group aggs (which target
+    rows are selected by where) upwards; raises ValueError on cycles'''
+    table = aggs[0].target_table
+    path = path + [ table ]
+    if table in path[:-1]:
+        raise ValueError( 'cascading aggregations make a cycle: ' + ' -> '.join( t.name for t in path))
+    targets = dict( (getattr( a, 'target', None), a) for a in aggs)
+    steps = []
+    for ext, uaggs in _upper_groups( table):
+        feeds = [ targets.get( getattr( a, 'source', None)) for a in uaggs ]
+        if not [ f for f in feeds if f is not None ]: continue
+        uwhere = exists( [ literal_column( '1') ],
+                    and_( *[ c for c in (where, uaggs[0]._filter4set) if c is not None ]))
+        step = _CascadeStep( ext, uaggs, feeds, uwhere)
+        step.steps = _cascade_steps( uaggs, uwhere, path)
+        if step.steps and ext._plans[ id( uaggs)].keys is None:
+            raise NotImplementedError( 'cascade through %s: its rows are not one per source row' % uaggs[0].target_table)
+        steps.append( step)
+    return tuple( steps)
+
+_running_combine = (operator.add, max, min)
+def _running( a):
+    'is aggregation over range filter, rebuildable as running total/extreme'
+    return bool( getattr( a, '_range', None)) and a._delta_combine in _running_combine
 
 class Quick( MapperExtension):
     """Mapper extension which maintains aggregations.
@@ -211,15 +923,56 @@ class Quick( MapperExtension):
     see Accurate for those
 
     XXX Quick vs Accurate vs None may have to be switched at runtime ?
-    e.g. mass updates may need one Accurate at the end
+    e.g. mass updates may need one Accurate at the end - see bulk_load()
+
+    With coalesce=True, the delta-able changes (Count, Sum, growing Max/Min)
+    are not issued per instance but combined, and each distinct target row
+    gets one update at the end of the flush. Other changes (recalcs) go
+    immediately as usual. Over max_pending distinct target rows, the
+    collected ones are issued earlier (spilled) to keep memory bounded.
     """
     _insert_method = 'oninsert'
     _delete_method = 'ondelete'
+    _distinct_sides = True      #CountDistinct via its side table; else recalc
+    _stripes = True             #deltas of striped Count/Sum into their stripes; else as usual
 
     def __init__( self, *aggregations, **kargs):
         """ *aggregations - _Aggregation-subclass instances, to be maintained for this mapper
+        kargs: mapper/class_, auto_expire_refs, refresh_refs, coalesce, max_pending, returning
+        auto_expire_refs - names of (relation) attributes of the instance, which
+            target instances are expired after each change
+        refresh_refs - instead of expiring each, collect the targets (only those
+            already loaded), and reload them after the flush, one select per class
+        returning - updates get RETURNING of the target columns they change
+            (on sqlite >= 3.35, postgres), and the values go straight into
+            the target instances in the session if any - no need of expire/refresh.
+            On other dialects nothing changes.
+        fuse - (default True) recalcs of several columns of one group share one
+            subselect, i.e. one scan of the source rows (on sqlite >= 3.15, postgres)
+        lock_order - (default True) the target rows changed by one instance are
+            updated in order of (target table, key) - as the coalesced ones at
+            flush end always are - so concurrent transactions lock them in same
+            order and do not deadlock on each other. See also retry_deadlocks().
+        cascade - the changes of the target rows are propagated, in the same
+            flush, to the aggregations having them as source (Quick extensions
+            of the target mapper, e.g. Line -> Block -> Document): deltas go up
+            as deltas (Sum of Count/Sum, Max of Max, Min of Min), anything else
+            as recalc of the upper row. The chain is checked at setup - cycles
+            raise ValueError. Each level but the last must be grouped by a
+            unique key of its target (one target row per source row).
+        upsert - a missing target row is created by its first contribution:
+            INSERT .. ON CONFLICT DO UPDATE (sqlite >= 3.24, postgres >= 9.5)
+            or ON DUPLICATE KEY UPDATE (mysql), seeded from the deltas; before
+            recalcs, the row is ensured by an INSERT .. DO NOTHING. Only for
+            groups whose filter is a unique key of the target == source values;
+            not on delete. The other target columns get their defaults.
         """
         self.off = False
+        self._statements = dict()   #compiled, see _statement()
+        self._loads = dict()        #scope: touched, while inside bulk_load()
+        self.cascade = kargs.get( 'cascade', False)
+        self.coalesce = kargs.get( 'coalesce', False)
+        self.max_pending = kargs.get( 'max_pending', 10000)
         self.aggregations_by_table = groups = dict()
 
         #here combined by target table, then target column
@@ -236,9 +989,33 @@ class Quick( MapperExtension):
                 mapper.extension.append( self)
 
         self.auto_expire_refs = kargs.get( 'auto_expire_refs', () )
+        self.refresh_refs = kargs.get( 'refresh_refs', False)
+        self.returning = kargs.get( 'returning', False)
+        self.fuse = kargs.get( 'fuse', True)
+        self.lock_order = kargs.get( 'lock_order', True)
+        self.upsert = kargs.get( 'upsert', False)
+
 
+    stats = None    #see instrument()
+    def instrument( self, timing =False, callback =None):
+        '''start counting the issued statements, per aggregation and per group
+        (target table, filter): atomic updates, recalcs, rows affected and,
+        if timing, wall time; callback( ext, aggs, kinds, action, rowcount, seconds)
+        is called after each statement. Returns the Stats.
+        Not instrumented (the default) costs one attribute check per statement.'''
+        self.stats = Stats( timing= timing, callback= callback)
+        return self.stats
+    def uninstrument( self):
+        self.stats = None
+
+    mapper = None
+    _striped = {}   #id(aggs): StripedGroup - see stripes.py
+    def instrument_class( self, mapper, class_):
+        self.mapper = mapper
+        return EXT_CONTINUE
 
     def _setup( self, mapper):
+        self.mapper = mapper
         self.local_table = table = mapper.local_table
         self.aggregations = groups = dict()     #combined by table,filter
         for (target_table, aggs) in self.aggregations_by_table.iteritems():
@@ -261,8 +1038,27 @@ class Quick( MapperExtension):
                     # into one super-select / single update. This may not be 100% automatic,
                     # the way of bundling should be pre-specified - is it a+b or a/b or..
                 used_columns.add( target)
+        self._striped = dict( (id( aggs), StripedGroup( aggs, mapper))
+                            for aggs in groups.itervalues() if self._stripes and [ a for a in aggs if a.stripes ])
+        self._plans = dict( (id( aggs), _GroupPlan( aggs, self._striped.get( id( aggs)), self._distinct_sides))
+                            for aggs in groups.itervalues())
         #suicide
         self._setup = lambda *a,**k: None
+        if self.cascade:
+            try:
+                self._setup_cascade()
+            except:
+                del self._setup     #not set up
+                raise
+
+    def _setup_cascade( self):
+        for aggs in self.aggregations.itervalues():
+            plan = self._plans[ id( aggs)]
+            where = None
+            if plan.keys is not None: where = aggs[0]._filter4mapper[0]
+            plan.cascade = _cascade_steps( aggs, where, [ self.local_table ])
+            if plan.cascade and where is None:
+                raise NotImplementedError( 'cascade from %s: its rows are not one per source row' % aggs[0].target_table)
 
     def find_fkey( self, table, target_table, mapper):
         for k in table.foreign_keys:
@@ -286,59 +1082,291 @@ class Quick( MapperExtension):
 
 
     def _make_updates( self, instance, connection, action):
-        if not self.off:
-            for aggs in self.aggregations.itervalues():
+        touched = self._touched4( instance, connection)
+        if touched is not None:
+            self._touch( touched, instance, old=False)
+        elif not self.off:
+            changes = [ (aggs, action, False) for aggs in self.aggregations.itervalues() ]
+            for aggs, action, old in self._lock_ordered( changes, instance):
                 self._make_change1( aggs, instance, connection, action)
 
+    def _lock_ordered( self, changes, instance):
+        '''changes [(aggs, action, old)..] of instance, sorted by the target row
+        they change - see lock_order'''
+        if not self.lock_order or len( changes) < 2: return changes
+        get = _Aggregation._get_current_or_orig
+        def key( (aggs, action, old)):
+            return _lock_key( aggs, [ get( instance, k, old) for k in aggs[0]._filter4mapper[1] ])
+        return sorted( changes, key= key)
+
     def _make_change1( self, aggs, instance, connection, action, old =False):
-        updates = dict()
-        bindings = dict()
-        func_checker = self._db_func_translator
-        for a in aggs:
-            u = getattr( a, action)( func_checker, instance)
-            if u is (): continue
-            if isinstance( u,tuple) and len(u)==2 and isinstance( u[1],dict):
-                expr,vbindings = u
-                u = expr
-                bindings.update( vbindings)
+        plan = self._plans[ id( aggs)]
+        get = _Aggregation._get_current_or_orig
+        session = None
+        if self.coalesce or self.returning:
+            session = sqlalchemy.orm.object_session( instance)
+        pending = None
+        if self.coalesce and plan.static:
+            pending = _FlushState.of( session)
+        bindings = dict()   #by bindparam name, i.e. with Converter._pfx
+        updates = None      #built per instance, not cachable
+        sdeltas = dict()
+        deltas = dict()
+        kinds = []
+        for a, delta, recalc_old, conditional, rbindings, dkey, okey, striped, distinct in plan.steps( action):
+            kind = None
+            d = None
+            if distinct is not None:
+                d = distinct.apply( action, instance, old, connection,
+                                    self._executor( connection, aggs, (a,), 'distinct', action))
+                if not d:
+                    kinds.append( None)
+                    continue
+            elif delta is not None:
+                d = delta( action, instance)
+            if d is not None:
+                if striped:
+                    sdeltas[ a] = d
+                elif pending is not None:
+                    deltas[ a] = d
+                else:
+                    kind = 'delta'
+                    bindings[ dkey] = d
+            else:
+                cond = conditional is not None and conditional( action, instance) or None
+                if recalc_old is not None:
+                    kind = 'recalc'
+                    for b,k in rbindings: bindings[ b] = get( instance, k, recalc_old)
+                elif cond is not None:
+                    kind = 'recalc_if'
+                    value, recalc_old = cond
+                    for b,k in rbindings: bindings[ b] = get( instance, k, recalc_old)
+                    bindings[ okey] = value
+                else:
+                    u = getattr( a, action)( _func_checker4dialect( connection.dialect), instance)
+                    if u is not ():
+                        kind = action in ('onrecalc', 'onrecalc_old') and 'recalc' or 'update'    #for stats only
+                        if isinstance( u,tuple) and len(u)==2 and isinstance( u[1],dict):
+                            expr,vbindings = u
+                            u = expr
+                            for k,v in vbindings.iteritems(): bindings[ Converter._pfx+k] = v
+
+                        if updates is None: updates = dict()
+                        if isinstance( u, dict): updates.update( u)
+                        else: updates[ a.target.name ] = u
+            kinds.append( kind)
 
-            if isinstance( u, dict): updates.update( u)
-            else: updates[ a.target.name ] = u
+        if sdeltas:
+            plan.striped.apply( sdeltas, instance, old, connection,
+                                self._executor( connection, aggs, sdeltas, 'stripe', action))
+        if deltas:
+            vbindings = dict( (k, get( instance, k, old)) for b,k in plan.bindings)
+            pending.add( self, aggs, vbindings, deltas, connection, session)
 
-        if updates:
+        kinds = tuple( kinds)
+        if updates or kinds.count( None) < len( kinds):
             ag = aggs[0]    # They all have same table/filters
-            fexpr,vbindings = ag.get_filter_and_bindings( ag._filter4mapper, instance, old)
-            bindings.update( vbindings)
-            if Converter._pfx:
-                bindings = dict( (Converter._pfx+k,v) for k,v in bindings.items() )
-            if 0:
-                print 'UUUUUUUU'
-                for k,v in updates.items(): print k,v
-                print bindings
+            upsert = None
+            if self.upsert and plan.keys is not None and action != self._delete_method:
+                for b,k in plan.bindings: bindings[ b] = get( instance, k, old)
+                upsert = self._upsert4( plan, connection, [ bindings[ b] for b,k in plan.bindings ])
+            if upsert is not None and (updates or [ k for k in kinds if k not in (None, 'delta') ]):
+                #not seedable - ensure the row, then update as usual
+                self._execute( connection, self._statement( aggs, None, connection, upsert), bindings,
+                        aggs= aggs, kinds= tuple( k is not None and 'ensure' or None for k in kinds),
+                        action= action, prefixed= True)
+                upsert = None
+            if updates or not plan.static:
+                fexpr,vbindings = ag.get_filter_and_bindings( ag._filter4mapper, instance, old)
+                for k,v in vbindings.iteritems(): bindings[ Converter._pfx+k] = v
+                if updates is None: updates = dict()
+                updates.update( self._values4kinds( aggs, kinds, connection.dialect))
+                stmt = self._update( ag.target_table, fexpr, updates, connection.dialect)
+            else:
+                for b,k in plan.bindings: bindings[ b] = get( instance, k, old)
+                stmt = self._statement( aggs, kinds, connection, upsert)
 #            ag.target_table.update( fexpr, values=updates ).execute( **bindings)   #own transaction+commit
-            connection.execute( ag.target_table.update( fexpr, values=updates ), **bindings)    #part of overall transaction
-
-    _funcs4db_replacement = dict(
-        mysql= dict(
-            min= 'least',       #use None if no such func
-            max= 'greatest',    #funcs not in here are considered available
-        ),
-        sqlite  = {
-            #'if' : None,
-        },
-        postgres= {
-            'if' : None,
-            'min': 'least',       #use None if no such func
-            'max': 'greatest',    #funcs not in here are considered available
-        },
-    )
+            self._execute( connection, stmt, bindings, session, aggs, kinds, action, prefixed= True)
+            if plan.cascade:
+                changes = dict( (a, (kind, bindings.get( Converter._pfx + self._delta_key( a))))
+                                for a,kind in zip( aggs, kinds) if kind is not None)
+                self._cascade( plan.cascade, changes, bindings, connection, session)
+
+    def _apply_deltas( self, aggs, deltas, bindings, connection, session =None):
+        'one update of the target row(s) with the combined deltas of many instances'
+        bindings = bindings.copy()
+        kinds = []
+        for a in aggs:
+            if a in deltas:
+                bindings[ self._delta_key( a)] = deltas[ a]
+                kinds.append( 'delta')
+            else:
+                kinds.append( None)
+        kinds = tuple( kinds)
+        plan = self._plans[ id( aggs)]
+        upsert = None
+        if self.upsert:
+            upsert = self._upsert4( plan, connection, bindings.values())
+        self._execute( connection, self._statement( aggs, kinds, connection, upsert), bindings, session, aggs, kinds)
+        if plan.cascade:
+            bindings = dict( (Converter._pfx+k, v) for k,v in bindings.iteritems())
+            changes = dict( (a, ('delta', d)) for a,d in deltas.iteritems())
+            self._cascade( plan.cascade, changes, bindings, connection, session)
+
+    def _cascade( self, steps, changes, bindings, connection, session =None):
+        '''propagate the changes {agg: (kind, delta)} of a target row (selected by
+        prefixed bindings) to the upper aggregations - see cascade='''
+        for step in steps:
+            kinds, uchanges = step.changes( changes)
+            if not uchanges: continue
+            b = bindings.copy()
+            for a,(kind,d) in uchanges.iteritems():
+                if kind == 'delta': b[ step._key( a)] = d
+            stmt = step.statement( kinds, connection.dialect)
+            step.ext._execute( connection, stmt, b, session, step.aggs, kinds, 'cascade', prefixed= True)
+            self._cascade( step.steps, uchanges, b, connection, session)
+
+    def _upsert4( self, plan, connection, keyvalues):
+        'the upsert keys of the group plan, if the target row can be upserted'
+        if plan.keys is None or None in keyvalues or not _supports_upsert( connection.dialect):
+            return None
+        return plan.keys
+
+    @staticmethod
+    def _delta_key( a):
+        return '_d_' + a.target.name
+    @staticmethod
+    def _old_key( a):
+        return '_o_' + a.target.name
+
+    def _values4kinds( self, aggs, kinds, dialect):
+        '''target-column values for the aggs of one group, with bindparams instead of
+        literal values - hence same shape for all instances:
+            'delta':  apply_delta over bindparam( _delta_key)
+            'recalc': the recalc subselect, bindings as of _filter4recalc
+            'recalc_if': recalc_if the target holds bindparam( _old_key)
+        '''
+        func_checker = _func_checker4dialect( dialect)
+        values = dict()
+        for a,kind in zip( aggs, kinds):
+            if kind == 'delta':
+                value = _bindparam( Converter._pfx + self._delta_key( a), type_= a.target.type)
+                values[ a.target.name ] = a.apply_delta( func_checker, value)
+            elif kind == 'recalc':
+                values[ a.target.name ] = select( [a.sqlfunc4column( a.source) ], a._filter4recalc[0] )
+            elif kind == 'recalc_if':
+                value = _bindparam( Converter._pfx + self._old_key( a), type_= a.target.type)
+                recalc = select( [a.sqlfunc4column( a.source) ], a._filter4recalc[0] )
+                values[ a.target.name ] = a.recalc_if( func_checker, value, recalc)
+        return values
+
+    def _statement( self, aggs, kinds, connection, upsert =None):
+        '''the compiled update for group aggs, with kinds (None/'delta'/'recalc'/'recalc_if') per agg.
+        Cached by (group, kinds, _dialect_key); kinds reflect the action, and same
+        kinds of different actions (e.g. oninsert/ondelete of Count) share one statement.
+        upsert - the keys of the target row (see _upsert_keys): an upsert instead,
+            of kinds None/'delta' only; or with kinds None, the insert ensuring the row
+        '''
+        dialect = connection.dialect
+        key = (id( aggs), kinds, _dialect_key( dialect), upsert is not None)
+        try:
+            return self._statements[ key]
+        except KeyError: pass
+        ag = aggs[0]
+        if upsert is not None:
+            stmt = self._upsert( aggs, kinds, dialect, upsert)
+        else:
+            values = self._values4kinds( aggs, kinds, dialect)
+            recalcs = [ a for a,kind in zip( aggs, kinds) if kind == 'recalc' ]
+            fused = self._fused( recalcs, values, dialect, recalcs and recalcs[0]._filter4recalc[0])
+            stmt = self._update( ag.target_table, ag._filter4mapper[0], values, dialect, fused)
+        compiled = self._statements[ key] = stmt.compile( dialect= dialect, column_keys= [])
+        return compiled
+
+    def _executor( self, connection, aggs, which, kind, action):
+        '''connection.execute for the side tables (stripes, distinct) - if instrumented,
+        one recording its statements as of kind for the aggregations which of group aggs'''
+        stats = self.stats
+        if stats is None: return connection.execute
+        kinds = tuple( a in which and kind or None for a in aggs)
+        def execute( stmt, **bindings):
+            t0 = stats.start()
+            result = connection.execute( stmt, **bindings)
+            stats.record( self, aggs, kinds, result, t0, action)
+            return result
+        return execute
+
+    def _execute( self, connection, stmt, bindings, session =None, aggs =None, kinds =None, action =None, prefixed =False):
+        if Converter._pfx and not prefixed:
+            bindings = dict( (Converter._pfx+k,v) for k,v in bindings.iteritems() )
+        stats = self.stats
+        if stats is not None and aggs is not None:
+            t0 = stats.start()
+            result = connection.execute( stmt, **bindings)
+            stats.record( self, aggs, kinds, result, t0, action)
+        else:
+            result = connection.execute( stmt, **bindings)    #part of overall transaction
+        columns = getattr( getattr( stmt, 'statement', stmt), 'returning_cols', None)
+        if columns:
+            rows = result.fetchall()
+            if session is not None:
+                _populate( session, stmt.statement.table, columns, rows, connection.dialect)
+        return result
+
+    def _fused( self, aggs, values, dialect, fexpr):
+        '''takes the recalcs of aggs (sharing filter fexpr) out of values, into one
+        row-value subselect: returns (target names, select) or None if not fused'''
+        if not self.fuse or len( aggs) < 2 or not _supports_rowvalue( dialect):
+            return None
+        names = [ a.target.name for a in aggs ]
+        for n in names: del values[ n]
+        return names, select( [ a.sqlfunc4column( a.source) for a in aggs ], fexpr)
+
+    def _upsert( self, aggs, kinds, dialect, keys):
+        '''the insert of the target row of group aggs, seeded with the deltas of kinds,
+        or if the row is there, applying them to it; kinds None - only ensure the row'''
+        table = aggs[0].target_table
+        values = dict( (c.name, v) for c,v in keys)
+        sets = dict()
+        func_checker = _func_checker4dialect( dialect)
+        for a,kind in zip( aggs, kinds or ()):
+            if kind is None: continue
+            assert kind == 'delta', kind
+            name = a.target.name
+            values[ name] = _bindparam( Converter._pfx + self._delta_key( a), type_= a.target.type)
+            sets[ name] = a.apply_delta( func_checker, _upserted( a.target, dialect))
+        stmt = _Upsert( table, values, [ c for c,v in keys ], sets)
+        if sets:
+            stmt.returning_cols = self._returning_columns( table, list( sets), dialect)
+        return stmt
+
+    def _returning_columns( self, table, names, dialect):
+        'primary key and target columns names, if returning=True and the dialect supports it; else None'
+        if self.returning:
+            mapper = _mapper4table( table)
+            if mapper is not None and _supports_returning( dialect):
+                pk = list( mapper.primary_key)
+                if [ c for c in pk if c.table is table ] == pk:
+                    return pk + [ table.c[ name] for name in names ]
+        return None
+
+    def _update( self, table, whereclause, values, dialect, fused =None):
+        '''the update of target table, with RETURNING of changed target columns
+        (and primary key) if returning=True and the dialect supports it;
+        fused - (names, select) to set from one row-value subselect, see _fused()'''
+        columns = self._returning_columns( table, list( values) + (fused and fused[0] or []), dialect)
+        if columns:
+            return _update_returning( table, whereclause, values, columns, dialect, fused)
+        if fused:
+            return _FusedUpdate( table, whereclause, values, *fused)
+        return table.update( whereclause, values= values)
+
+    _funcs4db_replacement = _funcs4db_replacement
     def _db_func_translator( self, funcname):
-        'called by aggregation-calculators'
-        db_drv = self.local_table.metadata.bind.url.drivername
-        frepl = self._funcs4db_replacement.get( db_drv)
-        if frepl:
-            return frepl.get( funcname, funcname)
-        return funcname
+        'func_checker of the metadata.bind - for calls without connection; see _func_checker4dialect'
+        bind = self.local_table.metadata.bind
+        if bind is None: return funcname
+        return _func_checker4dialect( bind.dialect)( funcname)
 
     #mapperExtension protocol - these are called after the instance is ins/upd/del-eted
     def after_insert( self, mapper, connection, instance):
@@ -351,7 +1379,12 @@ class Quick( MapperExtension):
         return self._after_all( mapper, connection, instance)
     def after_update( self, mapper, connection, instance):
         self._setup( mapper)
-        if not self.off:
+        touched = self._touched4( instance, connection)
+        if touched is not None:
+            self._touch( touched, instance, old=False)
+            self._touch( touched, instance, old=True)
+        elif not self.off:
+            changes = []
             for aggs in self.aggregations.itervalues():
                 ag = aggs[0]    # They all have same table/filters
                 #XXX BUT there will be conflict onrecalc if same column in several ag's
@@ -359,15 +1392,251 @@ class Quick( MapperExtension):
                 same = ag._same_binding_values( bindings, instance)
 
                 if same:
-                    self._make_change1( aggs, instance, connection, 'onupdate')
+                    changes.append( (aggs, 'onupdate', False))
                 else:
-                    self._make_change1( aggs, instance, connection,  self._delete_method, old=True)
-                    self._make_change1( aggs, instance, connection,  self._insert_method)
+                    changes.append( (aggs, self._delete_method, True))
+                    changes.append( (aggs, self._insert_method, False))
+            for aggs, action, old in self._lock_ordered( changes, instance):
+                self._make_change1( aggs, instance, connection, action, old=old)
         return self._after_all( mapper, connection, instance)
 
+    ########## bulk loads
+    _bulk_chunk = 200   #target rows per one set-based recalc
+
+    @contextmanager
+    def bulk_load( self, bind =None):
+        '''suspend the per-instance maintenance; inside, only the touched target
+        rows are recorded, and recalculated set-based at exit, i.e.
+            UPDATE target SET col = (SELECT agg(...) WHERE ...correlated) WHERE touched
+        bind - Session (it is flushed first), Connection or Engine to use;
+            default is the metadata.bind.
+        Only the changes of the load itself are recorded - flushed by that
+        Session, or issued on that Connection, else flushed from this thread;
+        all others (other sessions/threads) are maintained as usual meanwhile.
+        A nested bulk_load() of same scope recalculates its own rows at its exit.
+        Nothing is recalculated if the block raises.
+        '''
+        scope = self._load_scope( bind)
+        outer = self._loads.get( scope)
+        touched = self._loads[ scope] = dict()
+        try:
+            yield self
+            if hasattr( bind, 'flush'): bind.flush()
+        finally:
+            if outer is None: del self._loads[ scope]
+            else: self._loads[ scope] = outer
+        self.recalc_touched( touched, bind)
+
+    def _dialect4bind( self, bind):
+        'the dialect of what bind (Connection, Engine or Session) executes on'
+        dialect = getattr( bind, 'dialect', None)
+        if dialect is None:     #Session
+            dialect = bind.get_bind( self.mapper).dialect
+        return dialect
+
+    @staticmethod
+    def _load_scope( bind):
+        'what bulk_load( bind) records the changes of: the Session or Connection, else the thread'
+        if isinstance( bind, (sqlalchemy.orm.session.Session, sqlalchemy.engine.base.Connection)):
+            return bind
+        return threading.currentThread()
+
+    def _touched4( self, instance, connection):
+        'the touched rows of the bulk_load() recording this change, if any'
+        loads = self._loads
+        if not loads: return None
+        for scope in (sqlalchemy.orm.object_session( instance), connection, threading.currentThread()):
+            touched = loads.get( scope)
+            if touched is not None: return touched
+        return None
+
+    def _touch( self, touched, instance, old):
+        for aggs in self.aggregations.itervalues():
+            ag = aggs[0]
+            fexpr,vbindings = ag.get_filter_and_bindings( ag._filter4mapper, instance, old)
+            key = (id(fexpr), tuple( sorted( vbindings.iteritems() )))
+            rows = touched.setdefault( id(aggs), (aggs, dict()))[1]
+            rows[ key] = fexpr,vbindings
+
+    def recalc_touched( self, touched, bind =None):
+        '''set-based recalc of touched target rows, per aggregation group:
+        touched = { id(aggs): (aggs, { key: (filter4mapper, bindings) }) }'''
+        if bind is None: bind = self.local_table.metadata.bind
+        pfx = Converter._pfx
+        dialect = self._dialect4bind( bind)
+        plain = _Agg_1Target_1Source.recalc4set.im_func
+        for aggs,rows in touched.itervalues():
+            ag = aggs[0]
+            if rows and not [ a for a in aggs if not _running( a) ]:
+                #running totals - one merge over the touched rows, not a subselect per row
+                self._rebuild_running( aggs, bind, or_( *[
+                            fexpr.unique_params( dict( (pfx+k,v) for k,v in bindings.iteritems() ))
+                            for fexpr,bindings in rows.itervalues() ]))
+                continue
+            values = dict()
+            for a in aggs: values.update( a.recalc4set())
+            recalcs = [ a for a in aggs if getattr( a.recalc4set, 'im_func', None) is plain ]
+            fused = self._fused( recalcs, values, dialect, recalcs and recalcs[0]._filter4set)
+            rows = rows.values()
+            for i in range( 0, len( rows), self._bulk_chunk):
+                where = or_( *[
+                            fexpr.unique_params( dict( (pfx+k,v) for k,v in bindings.iteritems() ))
+                            for fexpr,bindings in rows[ i:i+self._bulk_chunk] ])
+                striped = self._striped.get( id( aggs))
+                if striped is not None: striped.clear( bind, where)
+                for side in self._plans[ id( aggs)].distinct.itervalues():
+                    side.rebuild( bind, where)
+                if fused:
+                    update = _FusedUpdate( ag.target_table, where, values, *fused)
+                else:
+                    update = ag.target_table.update( where, values= values)
+                self._execute( bind, update, {},
+                                aggs= aggs, kinds= ('recalc',)*len( aggs))
+
+    ########## full rebuild
+    _rebuild_chunk = 10000  #grouped rows fetched/updated at once
+
+    def rebuild( self, bind =None):
+        '''recalculate all target columns from scratch, set-based. Per aggregation group:
+         - if the filter is equality(-ies) between target columns and source
+           expressions (e.g. foreign key), one grouped select over the source
+           table, then executemany of updates to target rows found there
+           (with upsert=True, missing ones are inserted);
+           all other target rows get the aggregate-of-nothing (e.g. count=0).
+         - else, one correlated update over the whole target table.
+        bind - Connection, Engine or Session to use; default is the metadata.bind.
+        '''
+        if bind is None: bind = self.local_table.metadata.bind
+        if self.mapper: self._setup( self.mapper)
+        for aggs in self.aggregations.itervalues():
+            self._rebuild_group( aggs, bind)
+
+    def _rebuild_group( self, aggs, bind):
+        target = aggs[0].target_table
+        grouped = [ a for a in aggs if a._equijoin ]
+        running = [ a for a in aggs if _running( a) ]
+        correlated = dict()
+        for a in aggs:
+            if a not in grouped and a not in running: correlated.update( a.recalc4set())
+        striped = self._striped.get( id( aggs))
+        if striped is not None: striped.clear( bind)
+        for side in self._plans[ id( aggs)].distinct.itervalues():
+            side.rebuild( bind)
+        if correlated:
+            bind.execute( target.update( values= correlated))
+        if running:
+            self._rebuild_running( running, bind)
+        if not grouped: return
+
+        pairs,rest = grouped[0]._equijoin     #same filter for all in group
+        keys = [ s for s,t in pairs ]
+        columns = [ a.sqlfunc4column( a.source) for a in grouped ]
+        names = [ a.target.name for a in grouped ]
+
+        #aggregate-of-nothing for all, then the real ones where any
+        empty = bind.execute( select( columns, text( '1=0'), from_obj= [ self.local_table ] )).fetchone()
+        bind.execute( target.update( values= dict( zip( names, empty))))
+
+        where = rest and and_( *rest) or None
+        upd = self._rebuild_upsert( aggs, bind, pairs, names)
+        if upd is None:
+            upd = target.update(
+                and_( *[ t == bindparam( 'agk%d' % i, type_= t.type) for i,(s,t) in enumerate( pairs) ]),
+                values= dict( (n, bindparam( 'agv_'+n, type_= target.c[ n].type)) for n in names) )
+        pnames = [ 'agk%d' % i for i in range( len( keys)) ] + [ 'agv_'+n for n in names ]
+        result = bind.execute( select( keys + columns, where, group_by= keys))
+        while True:
+            rows = result.fetchmany( self._rebuild_chunk)
+            if not rows: break
+            bind.execute( upd, [ dict( zip( pnames, row)) for row in rows ])
+
+    def _rebuild_upsert( self, aggs, bind, pairs, names):
+        '''with upsert=True, the insert-or-update of the grouped rows in rebuild - so
+        missing target rows are made too (e.g. rollup buckets); None if not upsertable'''
+        if not self.upsert or self._plans[ id( aggs)].keys is None: return None
+        dialect = self._dialect4bind( bind)
+        if not _supports_upsert( dialect): return None
+        target = aggs[0].target_table
+        values = [ (t.name, bindparam( 'agk%d' % i, type_= t.type)) for i,(s,t) in enumerate( pairs) ]
+        values += [ (n, bindparam( 'agv_'+n, type_= target.c[ n].type)) for n in names ]
+        return _Upsert( target, dict( values), [ t for s,t in pairs ],
+                    dict( (n, _upserted( target.c[ n], dialect)) for n in names ))
+
+    def _rebuild_running( self, aggs, bind, touched =None):
+        '''aggregations over range filter (e.g. Target(stats.date) >= Source(blog.date),
+        see split_range) - by one sorted merge instead of a subselect per target row:
+        the source rows grouped by (equality keys, range value), and the distinct
+        target (keys, range value), are sorted; each target gets the running
+        combination (_delta_combine) of the groups before it. Sorting is done
+        here, as of python comparison.
+        touched - filter of the target rows to update, default all'''
+        target = aggs[0].target_table
+        pairs, (src, op, tcol), rest = aggs[0]._range     #same filter for all in group
+        keys = [ s for s,t in pairs ]
+        tkeys = [ t for s,t in pairs ] + [ tcol ]
+        columns = [ a.sqlfunc4column( a.source) for a in aggs ]
+        names = [ a.target.name for a in aggs ]
+        n = len( keys)
+
+        #aggregate-of-nothing for all, then the real ones where any
+        empty = list( bind.execute( select( columns, text( '1=0'), from_obj= [ self.local_table ] )).fetchone())
+        bind.execute( target.update( touched, values= dict( zip( names, empty))))
+
+        where = rest and and_( *rest) or None
+        sources = dict()    #keys: [(range value, aggregates)..]
+        for row in bind.execute( select( keys + [ src ] + columns, where, group_by= keys + [ src ])):
+            if row[ n] is not None:
+                sources.setdefault( tuple( row[ :n]), []).append( (row[ n], row[ n+1:]))
+        targets = dict()    #keys: [range value..]
+        for row in bind.execute( select( tkeys, touched, distinct= True)):
+            if row[ n] is not None:
+                targets.setdefault( tuple( row[ :n]), []).append( row[ n])
+
+        upd = target.update(
+                and_( *[ t == bindparam( 'agk%d' % i, type_= t.type) for i,t in enumerate( tkeys) ]),
+                values= dict( (a.target.name, bindparam( 'agv_'+a.target.name, type_= a.target.type)) for a in aggs ))
+        pnames = [ 'agk%d' % i for i in range( len( tkeys)) ] + [ 'agv_'+n for n in names ]
+        backward = op in (operator.le, operator.lt)     #target <= source: the sources after it
+        rows = []
+        for key,tvalues in targets.iteritems():
+            svalues = sorted( sources.get( key, ()), reverse= backward)
+            tvalues.sort( reverse= backward)
+            acc = list( empty)
+            i = 0
+            for tv in tvalues:
+                while i < len( svalues) and op( tv, svalues[ i][0]):
+                    for j,(a,v) in enumerate( zip( aggs, svalues[ i][1])):
+                        if v is None: continue
+                        if acc[ j] is None: acc[ j] = v
+                        else: acc[ j] = a._delta_combine( acc[ j], v)
+                    i += 1
+                if acc != empty:
+                    rows.append( dict( zip( pnames, key + (tv,) + tuple( acc))))
+                if len( rows) >= self._rebuild_chunk:
+                    bind.execute( upd, rows)
+                    rows = []
+        if rows:
+            bind.execute( upd, rows)
+
     auto_expire_refs = ()
+    refresh_refs = False
+    #own statements of the flush, to be told from mass update/delete - see intercept
+    def before_update( self, mapper, connection, instance):
+        _flushing[ connection] = True
+        return EXT_CONTINUE
+    before_delete = before_update
+
     def _after_all( self, mapper, connection, instance):
-        if 10:
+        _flushing.pop( connection, None)
+        state = None
+        if self.auto_expire_refs and self.refresh_refs:
+            state = _FlushState.of( sqlalchemy.orm.object_session( instance))
+        if state is not None:
+            for name in self.auto_expire_refs:
+                g = instance.__dict__.get( name)    #not loaded - not needed
+                if g is not None:
+                    state.refs[ id(g)] = g
+        elif 10:
             session = sqlalchemy.orm.object_session( instance)
             for name in self.auto_expire_refs:
                 g = getattr( instance, name, None)
@@ -384,5 +1653,230 @@ class Accurate( Quick):
     """
     _insert_method = 'onrecalc'
     _delete_method = 'onrecalc_old'
+    _distinct_sides = False
+    _stripes = False    #recalcs go to the target column; deltas to stripes would add up twice
+
+
+################
+import threading
+import Queue
+import time
+import atexit
+
+def _real_transaction( tx):
+    'the transaction or savepoint which commit/rollback of tx is about (not a subtransaction)'
+    while tx is not None and tx._parent is not None and not tx.nested:
+        tx = tx._parent
+    return tx
+
+class _CommitState( _FlushState):
+    """Per-session collector for WriteBehind: changes are pending until the
+    transaction commits, then handed over to the extension(s) as one batch;
+    dropped on rollback. Changes inside a savepoint (begin_nested) are kept
+    apart, and go to the enclosing transaction when it is released, or are
+    dropped if it is rolled back.
+    """
+    def reset( self, *a, **k):
+        _FlushState.reset( self)
+        self.savepoints = dict()    #savepoint transaction: pending
+    def before_flush( self, *a, **k): pass
+    def after_flush( self, *a, **k): pass
+
+    def pending4( self, session):
+        'where the changes of the current transaction of session go'
+        tx = _real_transaction( session.transaction)
+        if tx is not None and tx.nested:
+            return self.savepoints.setdefault( tx, dict())
+        return self.pending
+
+    def after_rollback( self, session):
+        tx = _real_transaction( session.transaction)
+        if tx is None or not tx.nested:
+            self.reset()
+            return
+        for sp in list( self.savepoints):   #it and those inside it
+            t = sp
+            while t is not None and t is not tx:
+                t = t._parent
+            if t is tx:
+                del self.savepoints[ sp]
+
+    def after_commit( self, session):
+        tx = _real_transaction( session.transaction)
+        if tx is not None and tx.nested:    #savepoint released - to the enclosing one
+            part = self.savepoints.pop( tx, None)
+            if part:
+                outer = _real_transaction( tx._parent)
+                pending = outer.nested and self.savepoints.setdefault( outer, dict()) or self.pending
+                for entry in part.itervalues():
+                    _merge_change( pending, *entry)
+            return
+        pending = self.pending
+        self.reset()
+        batches = dict()
+        for entry in pending.itervalues():
+            batches.setdefault( entry[0], []).append( entry)
+        for ext,entries in batches.iteritems():
+            ext._enqueue( entries)
+
+_STOP = object()
+
+class WriteBehind( Quick):
+    """Mapper extension which maintains aggregations - with some delay.
+
+    The changes (as of Quick) are collected per session, and after commit are
+    queued. A background thread merges them per target row and applies them on
+    its own connection (from bind= , else metadata.bind) in its own
+    transaction, each interval seconds, or when max_batch target rows are pending.
+    Deltas (Count, Sum, growing Max/Min) are applied as such; other changes
+    (Max/Min extreme leaving, Average1, ..) become recalc of the target row,
+    done after the deltas. Hence user transactions do not lock target rows,
+    nor wait for their updates. Instances with callable filters, or in
+    sessions not supporting extensions, are handled immediately as in Quick.
+
+    drain() applies all queued so far and waits for it; shutdown() drains and
+    stops the thread; it is also registered to run atexit.
+
+    Crash safety: the queue is in memory only. If the process dies, changes
+    committed but not yet applied are lost and the targets are stale - do
+    rebuild() (or python -m aggregator.rebuild) after such crash.
+    A failed apply is rolled back, logged, and retried after interval;
+    on deadlock, it is retried at once, up to retries times (see retry_deadlocks()).
+    """
+    def __init__( self, *aggregations, **kargs):
+        """ kargs as of Quick, and bind, interval, max_batch, retries
+        """
+        self.bind = kargs.get( 'bind')
+        self.retries = kargs.get( 'retries', 3)
+        self.interval = kargs.get( 'interval', 2.0)
+        self.max_batch = kargs.get( 'max_batch', 1000)
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._atexit = False
+        Quick.__init__( self, *aggregations, **kargs)
+
+    _distinct_sides = False     #changes are merged, not applied one by one
+
+    def _make_change1( self, aggs, instance, connection, action, old =False):
+        ag = aggs[0]    # They all have same table/filters
+        state = None
+        session = sqlalchemy.orm.object_session( instance)
+        if not callable( ag._filter4mapper[0]):
+            state = _CommitState.of( session)
+        if state is None:
+            return Quick._make_change1( self, aggs, instance, connection, action, old)
+        func_checker = _func_checker4dialect( connection.dialect)
+        deltas = dict()
+        recalcs = []
+        for a in aggs:
+            d = a.delta( action, instance)
+            if d is not None:
+                deltas[ a] = d
+            elif (a.recalc4action( action) is not None
+                    or a.conditional_recalc( action, instance) is not None
+                    or getattr( a, action)( func_checker, instance) is not ()):
+                recalcs.append( a)
+        if deltas or recalcs:
+            fexpr,vbindings = ag.get_filter_and_bindings( ag._filter4mapper, instance, old)
+            _merge_change( state.pending4( session), self, aggs, vbindings, deltas, recalcs)
+
+    def _enqueue( self, entries):
+        self._lock.acquire()
+        try:
+            if self._thread is None:
+                t = self._thread = threading.Thread( target= self._run, name= 'aggregator.WriteBehind')
+                t.setDaemon( True)
+                t.start()
+                if not self._atexit:
+                    atexit.register( self.shutdown)
+                    self._atexit = True
+        finally:
+            self._lock.release()
+        self._queue.put( entries)
+
+    def drain( self, timeout =None):
+        'apply all queued so far, and wait for that'
+        if self._thread is None: return
+        done = threading.Event()
+        self._queue.put( done)
+        done.wait( timeout)
+
+    def shutdown( self, timeout =None):
+        'apply all queued so far, and stop the thread; it is started again if needed'
+        self._lock.acquire()
+        try:
+            t = self._thread
+            self._thread = None
+        finally:
+            self._lock.release()
+        if t is None: return
+        self._queue.put( _STOP)
+        t.join( timeout)
+
+    def _run( self):
+        pending = dict()
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max( 0, deadline - time.time())
+            try:
+                item = self._queue.get( True, timeout)
+            except Queue.Empty:
+                item = None
+            waiter = None
+            if isinstance( item, list):
+                for entry in item:
+                    _merge_change( pending, *entry)
+                if deadline is None:
+                    deadline = time.time() + self.interval
+            elif item is not None and item is not _STOP:
+                waiter = item
+            if pending and (item is _STOP or waiter
+                            or len( pending) >= self.max_batch or time.time() >= deadline):
+                if self._apply_queued( pending):
+                    pending = dict()
+                    deadline = None
+                else:
+                    deadline = time.time() + self.interval
+            if waiter: waiter.set()
+            if item is _STOP:
+                if pending:
+                    log.error( 'WriteBehind: %d target rows not updated at shutdown', len( pending))
+                return
+
+    def _apply_queued( self, pending):
+        bind = self.bind or self.local_table.metadata.bind
+        def apply():
+            connection = bind.connect()
+            try:
+                trans = connection.begin()
+                try:
+                    self._apply( pending, connection)
+                except:
+                    trans.rollback()
+                    raise
+                trans.commit()
+            finally:
+                connection.close()
+        try:
+            retry_deadlocks( apply, tries= 1 + self.retries)
+        except Exception:
+            log.exception( 'WriteBehind: applying %d target rows failed', len( pending))
+            return False
+        return True
+
+    def _apply( self, pending, connection):
+        for ext, aggs, bindings, deltas, recalcs in sorted( pending.itervalues(), key= _lock_order):
+            if deltas:
+                self._apply_deltas( aggs, deltas, bindings, connection)
+            if recalcs:
+                values = dict()
+                for a in aggs:
+                    if a in recalcs: values.update( a.recalc4set())
+                ag = aggs[0]
+                self._execute( connection, ag.target_table.update( ag._filter4mapper[0], values= values), bindings,
+                                aggs= aggs, kinds= tuple( a in recalcs and 'recalc' or None for a in aggs))
 
 # vim:ts=4:sw=4:expandtab
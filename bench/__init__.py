@@ -0,0 +1,7 @@
+#$Id$
+'''Benchmarks of the aggregating mapper extensions - flush throughput of
+inserts/updates/moves/deletes over the test schemas, for Quick, Accurate and off.
+See run.py:
+    python -m aggregator.bench.run --help
+'''
+# vim:ts=4:sw=4:expandtab
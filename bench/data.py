@@ -0,0 +1,43 @@
+#$Id$
+'''synthetic data: choosing of targets, uniform or skewed (Zipf)'''
+
+import random
+import bisect
+
+class Uniform( object):
+    def __init__( self, keys, seed =0):
+        self.keys = list( keys)
+        self.rng = random.Random( seed)
+    def __call__( self):
+        return self.rng.choice( self.keys)
+    def __str__( self): return 'uniform'
+
+class Zipf( object):
+    '''key of rank r is chosen with probability ~ 1/r**s;
+    ranks are given to keys at random, so hot keys are not the first ones'''
+    def __init__( self, keys, s =1.1, seed =0):
+        self.s = s
+        self.rng = random.Random( seed)
+        self.keys = list( keys)
+        self.rng.shuffle( self.keys)
+        total = 0.0
+        self.cumulative = cumulative = []
+        for r in range( 1, len( self.keys)+1):
+            total += 1.0 / r**s
+            cumulative.append( total)
+    def __call__( self):
+        x = self.rng.random() * self.cumulative[-1]
+        i = bisect.bisect_left( self.cumulative, x)
+        return self.keys[ min( i, len( self.keys)-1)]
+    def __str__( self): return 'zipf:%s' % self.s
+
+def chooser( skew, keys, seed =0):
+    'skew: uniform, zipf, zipf:<s>'
+    if skew == 'uniform':
+        return Uniform( keys, seed)
+    if skew.startswith( 'zipf'):
+        s = skew[ 5:]
+        return Zipf( keys, s and float( s) or 1.1, seed)
+    raise ValueError( 'unknown skew: %r' % skew)
+
+# vim:ts=4:sw=4:expandtab
@@ -0,0 +1,139 @@
+#$Id$
+'''python-side cost of the aggregating extensions, without db i/o:
+after_insert/after_update/after_delete are called directly over transient
+instances, with a NullConnection (see null.py) recording the statements.
+
+Usage:
+    python -m aggregator.bench.micro [options]
+Measured per schema, mode and action (insert, update, move, delete):
+instances/s, statements issued, distinct statement texts, and objects left
+allocated after (gc-tracked, e.g. caches growing). With --profile, the
+cProfile top functions of each run go to stderr.
+'''
+
+import sys
+import gc
+import json
+import random
+import optparse
+import cProfile
+import pstats
+from sqlalchemy import MetaData
+from sqlalchemy.orm import create_session, clear_mappers, object_mapper, attributes
+import aggregator as a
+from aggregator.bench import schemas, data, run
+from aggregator.bench.null import NullConnection
+
+timer = run.timer
+actions = ('insert', 'update', 'move', 'delete')
+
+def _commit( objs):
+    'make current values the committed ones - as after a flush'
+    for o in objs:
+        state = attributes.instance_state( o)
+        state.commit_all( state.dict)
+
+def _extension( mapper):
+    for ext in mapper.extension:
+        if isinstance( ext, a.Quick): return ext
+
+def run1( schema, mode, n, targets, skew, seed =0, profile =False):
+    meta = MetaData( bind= 'sqlite:///:memory:')
+    try:
+        schema.setup( meta, run.modes[ mode])
+        session = create_session()
+        keys = schema.targets( session, targets)
+        session.close()
+        choose = data.chooser( skew, keys, seed)
+        rng = random.Random( seed)
+        objs = [ schema.new( choose(), rng) for i in range( n) ]
+        mapper = object_mapper( objs[0])
+        ext = _extension( mapper)
+        pk = mapper.primary_key
+        if len( pk) == 1:
+            pkname = mapper._columntoproperty[ pk[0]].key
+            for i,o in enumerate( objs): setattr( o, pkname, i+1)
+        conn = NullConnection( meta.bind.dialect, record= True)
+
+        def do_insert():
+            for o in objs: ext.after_insert( mapper, conn, o)
+        def do_update():
+            for o in objs: ext.after_update( mapper, conn, o)
+        def do_delete():
+            for o in objs: ext.after_delete( mapper, conn, o)
+        prepare = dict(
+            insert= None,
+            update= lambda: [ schema.change( o, rng) for o in objs ],
+            move=   lambda: [ schema.move( o, choose()) for o in objs ],
+            delete= None,
+        )
+        todo = dict( insert= do_insert, update= do_update, move= do_update, delete= do_delete)
+
+        results = []
+        for action in actions:
+            if action != 'insert': _commit( objs)
+            if prepare[ action]: prepare[ action]()
+            conn.clear()
+            gc.collect()
+            before = len( gc.get_objects())
+            if profile:
+                prof = cProfile.Profile()
+                t = timer()
+                prof.runcall( todo[ action])
+                seconds = timer() - t
+                print >>sys.stderr, '\n#### %s %s %s' % (schema.name, mode, action)
+                pstats.Stats( prof, stream= sys.stderr).sort_stats( 'cumulative').print_stats( 25)
+            else:
+                t = timer()
+                todo[ action]()
+                seconds = timer() - t
+            statements = len( conn.statements)
+            shapes = len( conn.shapes())
+            conn.clear()
+            gc.collect()
+            r = dict( schema= schema.name, mode= mode, action= action, instances= n,
+                    seconds= seconds,
+                    instances_per_sec= seconds and n / seconds or None,
+                    statements= statements,
+                    shapes= shapes,
+                    objects_retained= len( gc.get_objects()) - before,
+                )
+            results.append( r)
+        return results
+    finally:
+        clear_mappers()
+        meta.drop_all()
+        meta.bind.dispose()
+
+def main( argv):
+    p = optparse.OptionParser( usage= __doc__)
+    p.add_option( '--schemas', default= ','.join( s.name for s in schemas.all), help= '[%default]')
+    p.add_option( '--modes', default= 'quick,accurate', help= '%s [%%default]' % ','.join( sorted( run.modes)))
+    p.add_option( '-n', type= int, default= 5000, help= 'instances [%default]')
+    p.add_option( '--targets', type= int, default= 100, help= '[%default]')
+    p.add_option( '--skew', default= 'uniform', help= 'uniform, zipf, zipf:<s> [%default]')
+    p.add_option( '--seed', type= int, default= 0)
+    p.add_option( '--profile', action= 'store_true')
+    p.add_option( '--out', help= 'json file [stdout]')
+    o, args = p.parse_args( argv)
+
+    results = []
+    for name in o.schemas.split( ','):
+        for mode in o.modes.split( ','):
+            results += run1( schemas.by_name[ name](), mode, o.n, o.targets, o.skew, o.seed, o.profile)
+    text = json.dumps( dict(
+                config= dict( n= o.n, targets= o.targets, skew= o.skew, seed= o.seed),
+                results= results),
+            indent= 1, sort_keys= True)
+    if o.out:
+        f = open( o.out, 'w')
+        f.write( text)
+        f.close()
+    else:
+        print text
+    return 0
+
+if __name__ == '__main__':
+    sys.exit( main( sys.argv[1:]))
+
+# vim:ts=4:sw=4:expandtab
@@ -0,0 +1,50 @@
+#$Id$
+'''stand-in connection without db: execute() records the statement and the
+bindings, and returns at once - to measure the python side of the extensions.
+
+    conn = NullConnection( engine.dialect)
+    ext.after_insert( mapper, conn, instance)
+    conn.shapes()   # { statement text: count }
+'''
+
+class NullResult( object):
+    rowcount = 1
+    def fetchall( self): return []
+    def fetchone( self): return None
+    def close( self): pass
+    def __iter__( self): return iter( ())
+
+_result = NullResult()
+
+class NullConnection( object):
+    def __init__( self, dialect, record =True):
+        self.dialect = dialect
+        self.record = record
+        self.statements = []    #(statement, params)
+
+    def execute( self, stmt, *multiparams, **params):
+        if self.record:
+            self.statements.append( (stmt, multiparams or params))
+        return _result
+
+    def shapes( self):
+        'how many times each statement text was executed'
+        r = dict()
+        for stmt, params in self.statements:
+            key = unicode( stmt)
+            r[ key] = r.get( key, 0) + 1
+        return r
+
+    def clear( self):
+        del self.statements[:]
+
+    #enough of Connection for the extensions
+    def in_transaction( self): return True
+    def begin( self): return self
+    def commit( self): pass
+    def rollback( self): pass
+    def close( self): pass
+    def contextual_connect( self): return self
+    engine = property( lambda self: self)
+
+# vim:ts=4:sw=4:expandtab
@@ -0,0 +1,193 @@
+#$Id$
+'''flush throughput of the aggregating extensions.
+
+Usage:
+    python -m aggregator.bench.run [options]
+For each schema and mode (quick, accurate, coalesce, off), makes --targets
+target rows, then in flushes of --batch instances: inserts --scale source rows
+(targets chosen by --skew: uniform, zipf or zipf:<s>), updates them, moves them
+to other targets, deletes them. Measured: per operation - ops/s and p50/p99
+flush latency. Results go as JSON to --out (default stdout); with --baseline,
+the ops/s are compared against a previous result.
+'''
+
+import sys
+import os
+import time
+import json
+import random
+import tempfile
+import optparse
+import sqlalchemy
+from sqlalchemy import MetaData
+from sqlalchemy.orm import create_session, clear_mappers
+import aggregator as a
+from aggregator.bench import schemas, data
+
+timer = time.time
+if sys.platform == 'win32': timer = time.clock
+
+def _off( *aggs, **kargs):
+    ext = a.Quick( *aggs, **kargs)
+    ext.off = True
+    return ext
+def _coalesce( *aggs, **kargs):
+    return a.Quick( coalesce=True, *aggs, **kargs)
+
+modes = dict(
+    quick= a.Quick,
+    accurate= a.Accurate,
+    coalesce= _coalesce,
+    off= _off,
+)
+
+def percentile( values, p):
+    if not values: return None
+    values = sorted( values)
+    i = int( round( p/100.0 * (len( values)-1)))
+    return values[ i]
+
+class Timings( object):
+    'flush latencies of one operation'
+    def __init__( self, op):
+        self.op = op
+        self.ops = 0
+        self.flushes = []
+    def flush( self, session, n):
+        t = timer()
+        session.flush()
+        self.flushes.append( timer() - t)
+        self.ops += n
+    def result( self):
+        seconds = sum( self.flushes)
+        return dict( op= self.op, ops= self.ops,
+                seconds= seconds,
+                ops_per_sec= seconds and self.ops / seconds or None,
+                flush_p50_ms= 1000 * percentile( self.flushes, 50),
+                flush_p99_ms= 1000 * percentile( self.flushes, 99),
+            )
+
+def _batches( objs, batch):
+    for i in range( 0, len( objs), batch):
+        yield objs[ i:i+batch]
+
+def run1( url, schema, mode, scale, targets, skew, batch, seed =0):
+    'one schema+mode; returns list of per-operation results'
+    meta = MetaData( bind= url)
+    try:
+        schema.setup( meta, modes[ mode])
+        session = create_session()
+        keys = schema.targets( session, targets)
+        choose = data.chooser( skew, keys, seed)
+        rng = random.Random( seed)
+        results = []
+
+        t = Timings( 'insert')
+        objs = []
+        for b in range( 0, scale, batch):
+            chunk = [ schema.new( choose(), rng) for i in range( min( batch, scale-b)) ]
+            for o in chunk: session.save( o)
+            t.flush( session, len( chunk))
+            objs += chunk
+        results.append( t)
+
+        t = Timings( 'update')
+        for chunk in _batches( objs, batch):
+            for o in chunk: schema.change( o, rng)
+            t.flush( session, len( chunk))
+        results.append( t)
+
+        t = Timings( 'move')
+        for chunk in _batches( objs, batch):
+            for o in chunk: schema.move( o, choose())
+            t.flush( session, len( chunk))
+        results.append( t)
+
+        t = Timings( 'delete')
+        for chunk in _batches( objs, batch):
+            for o in chunk: session.delete( o)
+            t.flush( session, len( chunk))
+        results.append( t)
+
+        session.close()
+        r = []
+        for t in results:
+            t = t.result()
+            t.update( schema= schema.name, mode= mode)
+            r.append( t)
+        return r
+    finally:
+        clear_mappers()
+        meta.drop_all()
+        meta.bind.dispose()
+
+def compare( results, baseline):
+    'lines of ops/s ratio current/baseline'
+    def key( r): return (r['schema'], r['mode'], r['op'])
+    base = dict( (key( r), r) for r in baseline[ 'results'])
+    lines = []
+    for r in results[ 'results']:
+        b = base.get( key( r))
+        if not b or not b[ 'ops_per_sec'] or not r[ 'ops_per_sec']: continue
+        lines.append( '%-8s %-9s %-7s %10.1f %10.1f  x%.2f' % (key( r) + (
+                b[ 'ops_per_sec'], r[ 'ops_per_sec'], r[ 'ops_per_sec'] / b[ 'ops_per_sec'] )))
+    return lines
+
+def main( argv):
+    p = optparse.OptionParser( usage= __doc__)
+    p.add_option( '--db', default= 'memory',
+        help= 'memory, file (a temporary sqlite file) or a db url [%default]')
+    p.add_option( '--schemas', default= ','.join( s.name for s in schemas.all),
+        help= '[%default]')
+    p.add_option( '--modes', default= 'quick,accurate,off', help= '%s [%%default]' % ','.join( sorted( modes)))
+    p.add_option( '--scale', type= int, default= 2000, help= 'source rows [%default]')
+    p.add_option( '--targets', type= int, default= 100, help= 'target rows [%default]')
+    p.add_option( '--skew', default= 'uniform', help= 'uniform, zipf, zipf:<s> [%default]')
+    p.add_option( '--batch', type= int, default= 100, help= 'instances per flush [%default]')
+    p.add_option( '--seed', type= int, default= 0)
+    p.add_option( '--out', help= 'json file [stdout]')
+    p.add_option( '--baseline', help= 'json file of previous run, to compare with')
+    o, args = p.parse_args( argv)
+
+    dbfile = None
+    if o.db == 'memory':
+        url = 'sqlite:///:memory:'
+    elif o.db == 'file':
+        fd, dbfile = tempfile.mkstemp( suffix= '.db')
+        os.close( fd)
+        url = 'sqlite:///' + dbfile
+    else:
+        url = o.db
+
+    results = []
+    try:
+        for name in o.schemas.split( ','):
+            for mode in o.modes.split( ','):
+                results += run1( url, schemas.by_name[ name](), mode,
+                                o.scale, o.targets, o.skew, o.batch, o.seed)
+    finally:
+        if dbfile: os.remove( dbfile)
+
+    r = dict(
+        config= dict( db= o.db, scale= o.scale, targets= o.targets, skew= o.skew,
+                    batch= o.batch, seed= o.seed,
+                    python= sys.version.split()[0], sqlalchemy= sqlalchemy.__version__),
+        results= results)
+    text = json.dumps( r, indent= 1, sort_keys= True)
+    if o.out:
+        f = open( o.out, 'w')
+        f.write( text)
+        f.close()
+    else:
+        print text
+    if o.baseline:
+        f = open( o.baseline)
+        baseline = json.load( f)
+        f.close()
+        print >>sys.stderr, '\n'.join( compare( r, baseline))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit( main( sys.argv[1:]))
+
+# vim:ts=4:sw=4:expandtab
@@ -0,0 +1,209 @@
+#$Id$
+'''the benchmarked schemas - as in tests/: blocks/lines (SimpleTest),
+users/blocks/lines (ComplexTest), polymorphic tagging (TagsPerMovie),
+inequality counts (TestBlog).
+
+Each schema has:
+    setup( meta, aggregator_class)  - tables, classes and mappers
+    targets( session, k)            - makes k target rows, returns their keys
+    new( key, rng)                  - new source instance for the target key
+    change( obj, rng)               - changes a non-key aggregated value
+    move( obj, key)                 - moves the source to another target
+'''
+
+import datetime
+from sqlalchemy import Table, Column, Integer, String, Date, ForeignKey
+from sqlalchemy.orm import mapper
+import aggregator as a
+
+class Simple( object):
+    name = 'simple'
+    def setup( self, meta, aggregator_class):
+        blocks = Table( 'blocks', meta,
+            Column( 'id', Integer, primary_key=True, autoincrement=True),
+            Column( 'lines', Integer),
+            Column( 'lastline', Integer),
+            Column( 'length', Integer),
+            )
+        lines = Table( 'lines', meta,
+            Column( 'id', Integer, primary_key=True, autoincrement=True),
+            Column( 'block', Integer, ForeignKey( blocks.c.id)),
+            Column( 'length', Integer, default=10),
+            )
+        class Block( object): pass
+        class Line( object): pass
+        self.Block, self.Line = Block, Line
+        meta.create_all()
+        mapper( Block, blocks)
+        mapper( Line, lines,
+            extension= aggregator_class(
+                a.Max( blocks.c.lastline, lines.c.id),
+                a.Count( blocks.c.lines),
+                a.Sum( blocks.c.length, lines.c.length),
+            ))
+
+    def targets( self, session, k):
+        blocks = [ self.Block() for i in range( k) ]
+        for b in blocks: session.save( b)
+        session.flush()
+        return [ b.id for b in blocks ]
+    def new( self, key, rng):
+        l = self.Line()
+        l.block = key
+        l.length = rng.randint( 1, 100)
+        return l
+    def change( self, obj, rng):
+        obj.length = rng.randint( 1, 100)
+    def move( self, obj, key):
+        obj.block = key
+
+class Complex( Simple):
+    name = 'complex'
+    def setup( self, meta, aggregator_class):
+        users = Table( 'users', meta,
+            Column( 'id', Integer, primary_key=True, autoincrement=True),
+            Column( 'name', String(30)),
+            Column( 'blocks', Integer),
+            Column( 'lines', Integer),
+            )
+        blocks = Table( 'blocks', meta,
+            Column( 'id', Integer, primary_key=True, autoincrement=True),
+            Column( 'author', Integer, ForeignKey( users.c.id)),
+            Column( 'lines', Integer),
+            Column( 'lastline', Integer),
+            )
+        lines = Table( 'lines', meta,
+            Column( 'id', Integer, primary_key=True, autoincrement=True),
+            Column( 'block', Integer, ForeignKey( blocks.c.id)),
+            Column( 'author', Integer, ForeignKey( users.c.id)),
+            )
+        class Block( object): pass
+        class Line( object): pass
+        class User( object): pass
+        self.Block, self.Line, self.User = Block, Line, User
+        meta.create_all()
+        mapper( Block, blocks,
+            extension= aggregator_class(
+                a.Count( users.c.blocks),
+            ))
+        mapper( User, users)
+        mapper( Line, lines,
+            extension= aggregator_class(
+                a.Max( blocks.c.lastline, lines.c.id),
+                a.Count( blocks.c.lines),
+                a.Count( users.c.lines),
+            ))
+
+    def targets( self, session, k):
+        users = [ self.User() for i in range( max( 1, k/10)) ]
+        for u in users: session.save( u)
+        session.flush()
+        self.users = [ u.id for u in users ]
+        blocks = []
+        for i in range( k):
+            b = self.Block()
+            b.author = self.users[ i % len( self.users)]
+            session.save( b)
+            blocks.append( b)
+        session.flush()
+        return [ b.id for b in blocks ]
+    def new( self, key, rng):
+        l = self.Line()
+        l.block = key
+        l.author = rng.choice( self.users)
+        return l
+    def change( self, obj, rng):
+        obj.author = rng.choice( self.users)
+
+class Tags( object):
+    name = 'tags'
+    def setup( self, meta, aggregator_class):
+        tagging = Table( 'tagging', meta,
+            Column( 'id', Integer, primary_key=True),
+            Column( 'name', String(50)),
+            Column( 'tbl', String(50)),
+            Column( 'object_id', Integer),
+            )
+        movies = Table( 'movies', meta,
+            Column( 'id', Integer, primary_key=True),
+            Column( 'tag_count', Integer),
+            )
+        events = Table( 'events', meta,
+            Column( 'id', Integer, primary_key=True),
+            Column( 'tag_count', Integer),
+            )
+        class Tagging( object): pass
+        class Movie( object): pass
+        class Event( object): pass
+        self.Tagging, self.Movie, self.Event = Tagging, Movie, Event
+        meta.create_all()
+        mapper( Tagging, tagging,
+            extension= aggregator_class(
+                a.Count( movies.c.tag_count,
+                    (a.Target( movies.c.id) == a.Source( tagging.c.object_id)) & (a.Source( tagging.c.tbl) == 'movies')),
+                a.Count( events.c.tag_count,
+                    (a.Target( events.c.id) == a.Source( tagging.c.object_id)) & (a.Source( tagging.c.tbl) == 'events')),
+            ))
+        mapper( Movie, movies)
+        mapper( Event, events)
+
+    def targets( self, session, k):
+        objs = [ (i%2 and self.Event or self.Movie)() for i in range( k) ]
+        for o in objs: session.save( o)
+        session.flush()
+        return [ (isinstance( o, self.Movie) and 'movies' or 'events', o.id) for o in objs ]
+    def new( self, key, rng):
+        t = self.Tagging()
+        t.name = 'tag%d' % rng.randint( 1, 1000)
+        t.tbl, t.object_id = key
+        return t
+    def change( self, obj, rng):
+        obj.name = 'tag%d' % rng.randint( 1, 1000)
+    def move( self, obj, key):
+        obj.tbl, obj.object_id = key
+
+class Blog( object):
+    name = 'blog'
+    def setup( self, meta, aggregator_class):
+        stats = Table( 'stats', meta,
+            Column( 'date', Date, primary_key=True),
+            Column( 'posts_so_far', Integer),
+            )
+        blog = Table( 'blog', meta,
+            Column( 'id', Integer, primary_key=True),
+            Column( 'date', Date, index=True),
+            Column( 'text', String(100)),
+            )
+        class BlogEntry( object): pass
+        class StatRow( object): pass
+        self.BlogEntry, self.StatRow = BlogEntry, StatRow
+        meta.create_all()
+        mapper( BlogEntry, blog,
+            extension= aggregator_class(
+                a.Count( stats.c.posts_so_far, a.Target( stats.c.date) >= a.Source( blog.c.date)),
+            ))
+        mapper( StatRow, stats)
+
+    def targets( self, session, k):
+        start = datetime.date( 2001, 1, 1)
+        keys = [ start + datetime.timedelta( days=i) for i in range( k) ]
+        for d in keys:
+            s = self.StatRow()
+            s.date = d
+            session.save( s)
+        session.flush()
+        return keys
+    def new( self, key, rng):
+        e = self.BlogEntry()
+        e.date = key
+        e.text = 'post %d' % rng.randint( 1, 1000)
+        return e
+    def change( self, obj, rng):
+        obj.text = 'post %d' % rng.randint( 1, 1000)
+    def move( self, obj, key):
+        obj.date = key
+
+all = [ Simple, Complex, Tags, Blog ]
+by_name = dict( (s.name, s) for s in all)
+
+# vim:ts=4:sw=4:expandtab
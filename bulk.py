@@ -0,0 +1,189 @@
+#$Id$
+
+'''Core-level bulk insert of source rows, maintaining the aggregations of a
+Quick/Accurate mapper extension - as plain executemany bypasses the mapper.
+
+Usage:
+    bulk_insert( extension, rows, bind =None)
+rows - list of dicts (keyed by source column keys, as for table.insert()),
+    or a numpy structured array with fields named so (numpy is optional).
+The source rows are inserted with one executemany; then the delta-able
+aggregations (Count, Sum, Max, Min) are combined per target row - in python,
+grouped by the filter bindings; for arrays, grouped by numpy.unique over the
+binding fields and combined by ufunc.at - and applied with one update per
+touched target row. Aggregations/filters that cannot be
+expressed as deltas get a set-based recalc of the touched target rows, see
+Quick.recalc_touched(). All is done in one transaction.
+'''
+
+import operator
+from sqlalchemy.sql.expression import ClauseElement
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class _Row( object):
+    'instance-like view of a row, for filters/deltas: attributes by column name, key and mapper property'
+    def __init__( self, values):
+        self.__dict__.update( values)
+
+def _scalar_defaults( table):
+    'python-side constant defaults - as executemany takes the columns of first row only'
+    defaults = dict()
+    for c in table.columns:
+        default = getattr( c.default, 'arg', None)
+        if default is not None and not callable( default) and not isinstance( default, ClauseElement):
+            defaults[ c.key] = default
+    return defaults
+
+def _columns( ext):
+    'per column: (name, key, mapper-attribute)'
+    mapper = ext.mapper
+    columns = []
+    for c in ext.local_table.columns:
+        try:
+            attr = mapper._columntoproperty[ c].key
+        except KeyError:
+            attr = c.key
+        columns.append( (c.name, c.key, attr))
+    return columns
+
+def _row_maker( ext):
+    columns = _columns( ext)
+    def make( row):
+        values = dict()
+        for name, key, attr in columns:
+            values[ name] = values[ key] = values[ attr] = row.get( key)
+        return _Row( values)
+    return make
+
+def _is_array( rows):
+    return getattr( getattr( rows, 'dtype', None), 'names', None) is not None
+
+def bulk_insert( ext, rows, bind =None):
+    '''insert rows into the source table of ext, and maintain the aggregations;
+    bind - Connection or Engine; default is the metadata.bind'''
+    ext._setup( ext.mapper)
+    table = ext.local_table
+    if bind is None: bind = table.metadata.bind
+    array = None
+    if _is_array( rows):
+        array = rows
+        names = array.dtype.names
+        rows = [ dict( zip( names, r)) for r in array.tolist() ]
+    if not rows: return
+    defaults = _scalar_defaults( table)
+    if defaults:
+        rows = [ _with_defaults( defaults, r) for r in rows ]
+
+    connection = bind.contextual_connect()
+    trans = connection.begin()
+    try:
+        connection.execute( table.insert(), rows)    #executemany takes dicts
+        if not ext.off:
+            fields = None
+            if array is not None and numpy is not None:
+                fields = dict( (n, key) for name, key, attr in _columns( ext) for n in (name, key, attr))
+            instances = None    #made only if needed
+            for aggs in ext.aggregations.itervalues():
+                combined = None
+                if fields is not None:
+                    combined = _combine_array( aggs, array, fields)
+                if combined is None:
+                    if instances is None:
+                        make = _row_maker( ext)
+                        instances = [ make( r) for r in rows ]
+                    combined = _combine( aggs, instances)
+                _apply( ext, aggs, combined, connection)
+    except:
+        trans.rollback()
+        raise
+    trans.commit()
+
+def _with_defaults( defaults, row):
+    r = dict( defaults)
+    r.update( row)
+    return r
+
+def _bindings( ag, instance):
+    fexpr,bindings = ag.get_filter_and_bindings( ag._filter4mapper, instance, False)
+    return tuple( sorted( bindings.iteritems() ))
+
+def _combine( aggs, instances):
+    '''group-by target row (filter bindings), combining the deltas of each aggregation;
+    returns ( { binding-items: {agg:delta} }, { key: instance } needing recalc )'''
+    by_key = dict()
+    recalc = dict()
+    static = not callable( aggs[0]._filter4mapper[0])
+    for instance in instances:
+        key = _bindings( aggs[0], instance)
+        if not static:
+            recalc[ (key, id(instance))] = instance     #filter is per instance
+            continue
+        if key in recalc: continue
+        deltas = by_key.setdefault( key, dict())
+        for a in aggs:
+            d = a.delta( 'oninsert', instance)
+            if d is None:
+                del by_key[ key]
+                recalc[ key] = instance
+                break
+            if a in deltas:
+                d = a._delta_combine( deltas[ a], d)
+            deltas[ a] = d
+    return by_key, recalc
+
+_ufuncs = { operator.add: 'add', max: 'maximum', min: 'minimum' }
+
+def _combine_array( aggs, array, fields):
+    '''as _combine, vectorized over a numpy structured array; None if not possible.
+    fields - the array field of each column name/key/mapper-attribute'''
+    fexpr, names = aggs[0]._filter4mapper
+    if callable( fexpr) or not names: return None
+    try:
+        kfields = [ str( fields[ n]) for n in names ]
+    except KeyError:
+        return None
+    if [ f for f in kfields if f not in array.dtype.names ]: return None
+    columns = []
+    for a in aggs:
+        ufunc = _ufuncs.get( a._delta_combine)
+        try:
+            values = ufunc and a.delta4array( array)
+        except (KeyError, ValueError):     #no such field
+            values = None
+        if values is None: return None
+        columns.append( (a, getattr( numpy, ufunc), values))
+
+    #the filter bindings of each row, as one compact structured array
+    keys = numpy.empty( len( array), dtype= [ (f, array.dtype[ f]) for f in kfields ])
+    for f in kfields:
+        keys[ f] = array[ f]
+    uniq, first, inverse = numpy.unique( keys, return_index= True, return_inverse= True)
+    inverse = inverse.reshape( -1)
+    uniq = [ tuple( sorted( zip( names, k))) for k in uniq.tolist() ]
+    by_key = dict( (k, dict()) for k in uniq)
+    for a, ufunc, values in columns:
+        values = numpy.broadcast_to( values, (len( array),))
+        if ufunc is numpy.add:
+            combined = numpy.zeros( len( uniq), dtype= values.dtype)
+        else:
+            combined = values[ first].copy()
+        ufunc.at( combined, inverse, values)
+        for k,v in zip( uniq, combined.tolist()):
+            by_key[ k][ a] = v
+    return by_key, {}
+
+def _apply( ext, aggs, (by_key, recalc), connection):
+    for key, deltas in by_key.iteritems():
+        ext._apply_deltas( aggs, deltas, dict( key), connection)
+    if recalc:
+        ag = aggs[0]
+        rows = dict()
+        for key, instance in recalc.iteritems():
+            fexpr,bindings = ag.get_filter_and_bindings( ag._filter4mapper, instance, False)
+            rows[ key] = fexpr, bindings
+        ext.recalc_touched( { id(aggs): (aggs, rows) }, connection)
+
+# vim:ts=4:sw=4:expandtab
@@ -140,6 +140,86 @@ if _v03:
             expr = c.traverse( expr.copy_container() )    #sa0.3->copy_container etc..
             return expr, c.src_attrs4mapper
 
+def _columns( c):
+    if isinstance( c, sqlalchemy.Column): yield c
+    for x in c.get_children():
+        for y in _columns( x): yield y
+
+def _uses( expr, table):
+    for c in _columns( expr):
+        if c.table is table: return True
+    return False
+
+def _conjuncts( expr):
+    'the clauses of an and_() conjunction, flattened'
+    from sqlalchemy.sql import operators
+    clauses = [ expr ]
+    while clauses:
+        c = clauses.pop(0)
+        while c.__class__.__name__ == '_Grouping': c = c.element
+        if getattr( c, 'operator', None) is operators.and_ and hasattr( c, 'clauses'):
+            clauses[:0] = list( c.clauses)
+            continue
+        yield c
+
+def _target_source( c, target_tbl):
+    '(target_col, source_expr, reversed) of a comparison between them, or None'
+    for t,s,rev in ((c.left, c.right, False), (c.right, c.left, True)):
+        if isinstance( t, sqlalchemy.Column) and t.table is target_tbl and not _uses( s, target_tbl):
+            return t,s,rev
+    return None
+
+def split_equijoin( expr, target_tbl):
+    '''Splits a filter expression into ( [(source_expr, target_col)..], [source-only clauses..] )
+    if it is a conjunction of equalities between target columns and source-only
+    expressions, and of source-only conditions; else returns None.
+    The pairs can be used as GROUP BY keys for recalculating many target rows at once.
+    '''
+    from sqlalchemy.sql import operators
+    pairs = []
+    rest = []
+    for c in _conjuncts( expr):
+        if not _uses( c, target_tbl):
+            rest.append( c)
+            continue
+        if getattr( c, 'operator', None) is not operators.eq: return None
+        ts = _target_source( c, target_tbl)
+        if not ts: return None
+        pairs.append( ts[1::-1])
+    if not pairs: return None
+    return pairs, rest
+
+def split_range( expr, target_tbl):
+    '''Splits a filter expression into
+        ( [(source_expr, target_col)..], (source_expr, op, target_col), [source-only clauses..] )
+    if it is a conjunction of one inequality between a target column and a
+    source-only expression (i.e. target_col op source_expr, op one of operator.ge/gt/le/lt),
+    of equalities as of split_equijoin, and of source-only conditions; else returns None.
+    Such filter makes running (cumulative) aggregation - e.g. posts-so-far by date.
+    '''
+    from sqlalchemy.sql import operators
+    import operator
+    ops = { operators.ge: (operator.ge, operator.le), operators.gt: (operator.gt, operator.lt),
+            operators.le: (operator.le, operator.ge), operators.lt: (operator.lt, operator.gt), }
+    pairs = []
+    ranges = []
+    rest = []
+    for c in _conjuncts( expr):
+        if not _uses( c, target_tbl):
+            rest.append( c)
+            continue
+        op = getattr( c, 'operator', None)
+        if op is not operators.eq and op not in ops: return None
+        ts = _target_source( c, target_tbl)
+        if not ts: return None
+        t,s,rev = ts
+        if op is operators.eq:
+            pairs.append( (s,t))
+        else:
+            ranges.append( (s, ops[ op][ rev], t))
+    if len( ranges) != 1: return None
+    return pairs, ranges[0], rest
+
 def Source( col, **k):
     col._ag_mark = _Source( col,**k)
     return col
@@ -0,0 +1,149 @@
+#$Id$
+
+'''Exact distinct counts, maintained incrementally. CountDistinct( target, source)
+keeps a side table <target table>_<target>_distinct( <target key columns>, value, refs)
+- how many source rows of each target row have each value. An insert increments
+refs, and the target only when the value is new there (refs 0->1); a delete
+decrements refs, and the target only when it was the last one (1->0) - i.e. a
+few statements per source row instead of count(distinct) over all of them.
+
+The side table is in the metadata of the target table; create it with the
+rest (metadata.create_all()). rebuild() and bulk_load() refill it set-based.
+Only for aggregations grouped by a unique key of the target (e.g. foreign
+key, or equality to source columns), and with Quick - Accurate, and
+WriteBehind, recalc count(distinct) as usual and do not use the side table.
+'''
+
+from sqlalchemy import Table, Column, Integer, select, func, and_, exists, literal_column, bindparam, exc
+from convert_expr import split_equijoin
+
+def key_columns( target, filter_expr =None):
+    'the target columns identifying the target row of a source row - see CountDistinct'
+    if filter_expr is None:
+        return list( target.table.primary_key.columns)   #by foreign key
+    split = split_equijoin( filter_expr, target.table)
+    if not split:
+        raise NotImplementedError( 'distinct count needs a filter of target columns == source values: %s' % target)
+    return [ t for s,t in split[0] ]
+
+def distinct_table( target, source, keys):
+    'the side table of target column (made if not yet)'
+    table = target.table
+    name = '%s_%s_distinct' % (table.name, target.name)
+    st = table.metadata.tables.get( name)
+    if st is None:
+        st = Table( name, table.metadata,
+            *[ Column( c.name, c.type, primary_key=True, autoincrement=False) for c in keys ] + [
+            Column( 'value', source.type, primary_key=True, autoincrement=False),
+            Column( 'refs', Integer, nullable=False),
+            ])
+    return st
+
+class DistinctSide( object):
+    'the side table of one CountDistinct, within its aggregation group (_GroupPlan)'
+    actions = ('oninsert', 'ondelete', 'onupdate')
+    def __init__( self, agg, plan):
+        self.agg = agg
+        self.table = st = distinct_table( agg.target, agg.source, agg.keys)
+        if plan.keys is None or set( c for c,v in plan.keys) != set( agg.keys):
+            raise NotImplementedError( 'distinct count needs grouping by a unique key of the target: %s' % agg.target)
+        self.keys = plan.keys
+        self.bindings = plan.bindings
+        value = bindparam( 'd_value', type_= agg.source.type)
+        self.where = and_( st.c.value == value, *[ st.c[ c.name] == v for c,v in plan.keys ])
+        self.values = dict( [ (c.name, v) for c,v in plan.keys ] + [ ('value', value), ('refs', 1) ])
+        self._statements = dict()
+
+    def statements( self, dialect):
+        '''(increment, insert, decrement, delete-if-none) compiled; where the dialect
+        has upsert and can tell a new row from it, the increment is an upsert
+        (refs+1, or a row of refs=1), and no insert'''
+        from aggregation import _dialect_key, _Upsert, _supports_upsert, _supports_returning   #it imports this module
+        k = _dialect_key( dialect)
+        try:
+            return self._statements[ k]
+        except KeyError: pass
+        st = self.table
+        inc = st.update( self.where, values= dict( refs= st.c.refs + 1))
+        ins = st.insert( values= self.values)
+        if _supports_upsert( dialect) and (_supports_returning( dialect) or dialect.name == 'mysql'):
+            inc = _Upsert( st, self.values, [ st.c[ c.name] for c,v in self.keys ] + [ st.c.value ],
+                        dict( refs= st.c.refs + 1))
+            if _supports_returning( dialect):
+                inc.returning_cols = [ st.c.refs ]
+            ins = None
+        r = self._statements[ k] = tuple( s is not None and s.compile( dialect= dialect, column_keys= []) or None
+                for s in (
+                    inc,
+                    ins,
+                    st.update( self.where, values= dict( refs= st.c.refs - 1)),
+                    st.delete( and_( self.where, st.c.refs <= 0)),
+                ))
+        return r
+
+    def apply( self, action, instance, old, connection, execute =None):
+        '''count the value(s) of instance for action into the side table of its
+        target row; returns the change of the distinct count: -1, 0, +1.
+        execute - of the statements, default connection.execute (see Quick._executor)'''
+        a = self.agg
+        get = a._get_current_or_orig
+        bindings = dict( (b, get( instance, k, old)) for b,k in self.bindings)
+        if None in bindings.values(): return 0
+        new = gone = None
+        if action != 'ondelete': new = a.value( instance)
+        if action != 'oninsert': gone = a.oldv( instance)
+        if new == gone: return 0
+        inc, ins, dec, delete = self.statements( connection.dialect)
+        if execute is None: execute = connection.execute
+        d = 0
+        if gone is not None:
+            bindings[ 'd_value'] = gone
+            execute( dec, **bindings)
+            d -= execute( delete, **bindings).rowcount
+        if new is not None:
+            bindings[ 'd_value'] = new
+            d += self._increment( inc, ins, bindings, execute)
+        return d
+
+    def _increment( self, inc, ins, bindings, execute):
+        '''refs+1 of the value in the target row; 1 if the value is new there (refs 0->1).
+        Without upsert: increment, or insert if no row; if another writer inserted
+        it meanwhile, increment that'''
+        if ins is None:
+            r = execute( inc, **bindings)
+            if inc.statement.returning_cols:
+                return int( r.scalar() == 1)
+            return int( r.rowcount == 1)   #mysql: 1 inserted, 2 updated
+        while True:
+            if execute( inc, **bindings).rowcount: return 0
+            try:
+                execute( ins, **bindings)
+                return 1
+            except exc.IntegrityError:
+                pass
+
+    _chunk = 10000  #rows fetched/inserted at once
+    def rebuild( self, bind, where =None):
+        '''refill the side table of target rows matching where (default all), by one
+        grouped select over the source table'''
+        st = self.table
+        a = self.agg
+        pairs, rest = a._equijoin
+        sources = dict( (t, s) for s,t in pairs)
+        keys = [ sources[ c] for c in a.keys ]
+        cond = list( rest) + [ a.source != None ]
+        gone = None
+        if where is not None:
+            one = [ literal_column( '1') ]
+            gone = exists( one, and_( where, *[ c == st.c[ c.name] for c in a.keys ])).correlate( st)
+            cond.append( exists( one, and_( where, *[ c == s for c,s in zip( a.keys, keys) ])))
+        bind.execute( st.delete( gone))
+        names = [ c.name for c in a.keys ] + [ 'value', 'refs' ]
+        result = bind.execute( select( keys + [ a.source, func.count() ], and_( *cond),
+                                group_by= keys + [ a.source ]))
+        while True:
+            rows = result.fetchmany( self._chunk)
+            if not rows: break
+            bind.execute( st.insert(), [ dict( zip( names, row)) for row in rows ])
+
+# vim:ts=4:sw=4:expandtab
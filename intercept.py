@@ -0,0 +1,221 @@
+#$Id$
+
+'''Set-based maintenance of aggregations for mass UPDATE/DELETE statements over
+source tables - query.delete(), query.update(), table.delete().where(..).execute()
+- which do not go through the mapper extension (after_delete/after_update).
+
+Usage:
+    engine = create_engine( url, proxy= AggregatorProxy())
+then, for each Quick/Accurate extension maintaining a source table:
+ - DELETE: before it, the contribution of the rows to go is taken by one
+   grouped select, keyed by the filter bindings (e.g. foreign key) of each
+   aggregation group; after it, the targets get the opposite deltas as one
+   executemany (Count, Sum), or set-based recalc of the touched target rows
+   (others, see Quick.recalc_touched()).
+ - UPDATE: only if it changes columns used by the aggregations; the keys of
+   touched target rows are taken before and after it, and recalculated.
+Groups with filters computed per instance are fully rebuilt (Quick.rebuild()).
+'''
+
+import operator
+import sqlalchemy
+from sqlalchemy import select, func, literal_column
+from sqlalchemy.sql.expression import Delete, Update, ClauseElement
+from sqlalchemy.interfaces import ConnectionProxy
+from sqlalchemy.orm import mapperlib
+from aggregation import Quick, Converter, _flushing
+from convert_expr import _columns
+
+_chunk = 500    #rows per in_()
+
+class _ColumnRow( object):
+    'instance-like view of the source table: attributes are the columns themselves'
+    def __init__( self, ext):
+        for c in ext.local_table.columns:
+            setattr( self, c.name, c)
+            setattr( self, c.key, c)
+        for p in ext.mapper.iterate_properties:
+            if isinstance( p, sqlalchemy.orm.properties.ColumnProperty):
+                setattr( self, p.key, p.columns[0])
+
+def _params( multiparams, params):
+    'list of param dicts, as Connection.execute() gets them'
+    if not multiparams: return [ params ]
+    if len( multiparams) == 1 and isinstance( multiparams[0], (list, tuple)):
+        return multiparams[0] or [ {} ]
+    return multiparams
+
+class AggregatorProxy( ConnectionProxy):
+    'the engine proxy doing the above - see create_engine( proxy=)'
+    def __init__( self):
+        self._extensions = dict()   #source table: [extensions]
+        self._nmappers = None
+
+    def extensions( self, table):
+        if self._nmappers != len( mapperlib._mapper_registry):
+            sqlalchemy.orm.compile_mappers()
+            self._nmappers = len( mapperlib._mapper_registry)
+            exts = self._extensions = dict()
+            for mapper in list( mapperlib._mapper_registry):
+                for ext in mapper.extension:
+                    if isinstance( ext, Quick):
+                        ext._setup( mapper)
+                        l = exts.setdefault( ext.local_table, [])
+                        if ext not in l: l.append( ext)
+        return [ e for e in self._extensions.get( table, ()) if not e.off ]
+
+    def execute( self, conn, execute, clauseelement, *multiparams, **params):
+        exts = None
+        if (isinstance( clauseelement, (Delete, Update))
+                and not _flushing.get( conn)):     #own or of mapper flush
+            exts = self.extensions( clauseelement.table)
+        if not exts:
+            return execute( clauseelement, *multiparams, **params)
+
+        if conn.in_transaction():
+            trans = None
+        else:   #implicit execution - conn is closed with the first result; all in own transaction
+            conn = conn.engine.contextual_connect()
+            trans = conn.begin()
+            execute = conn.execute
+        _flushing[ conn] = True
+        try:
+            r = self._execute( conn, execute, exts, clauseelement, multiparams, params)
+        except:
+            if trans: trans.rollback()
+            raise
+        finally:
+            _flushing.pop( conn, None)
+        if trans: trans.commit()
+        return r
+
+    def _execute( self, conn, execute, exts, clauseelement, multiparams, params):
+        paramsets = _params( multiparams, params)
+        if isinstance( clauseelement, Delete):
+            groups = [ _DeleteGroup( ext, aggs, clauseelement, conn, paramsets)
+                        for ext in exts for aggs in ext.aggregations.itervalues() ]
+        else:
+            changed = _changed_columns( clauseelement, paramsets)
+            groups = [ _UpdateGroup( ext, aggs, clauseelement, conn, paramsets)
+                        for ext in exts for aggs in ext.aggregations.itervalues()
+                        if _used_columns( ext, aggs) & changed ]
+        r = execute( clauseelement, *multiparams, **params)
+        for g in groups: g.apply()
+        return r
+
+def _binding_columns( ext, aggs):
+    'the source columns of the filter bindings of aggs (instance attribute names)'
+    row = _ColumnRow( ext)
+    names = aggs[0]._filter4mapper[1]
+    return names, [ getattr( row, n) for n in names ]
+
+def _used_columns( ext, aggs):
+    names, used = _binding_columns( ext, aggs)
+    used = set( used)
+    for a in aggs:
+        for expr in a.recalc4set().itervalues():
+            used.update( c for c in _columns( expr) if c.table is ext.local_table)
+    return used
+
+def _changed_columns( stmt, paramsets):
+    table = stmt.table
+    keys = set( getattr( k, 'key', k) for k in stmt.parameters or ())    #names or columns
+    for p in paramsets: keys.update( p)
+    return set( c for c in table.columns if c.key in keys)
+
+def _add( x, y):
+    if x is None or y is None: return None
+    return x+y
+
+class _Group( object):
+    'the maintenance of one aggregation group for one statement'
+    def __init__( self, ext, aggs, stmt, conn, paramsets):
+        self.ext = ext
+        self.aggs = aggs
+        self.conn = conn
+        self.static = not callable( aggs[0]._filter4mapper[0])
+        if self.static:
+            self.names, self.columns = _binding_columns( ext, aggs)
+            self.before( stmt, paramsets)
+
+    def recalc( self, keys):
+        if not self.static:
+            return self.ext._rebuild_group( self.aggs, self.conn)
+        ag = self.aggs[0]
+        fexpr = ag._filter4mapper[0]
+        rows = dict()
+        for key in keys:
+            rows[ key] = fexpr, dict( zip( self.names, key))
+        if rows:
+            self.ext.recalc_touched( { id( self.aggs): (self.aggs, rows) }, self.conn)
+
+class _DeleteGroup( _Group):
+    def before( self, stmt, paramsets):
+        row = _ColumnRow( self.ext)
+        self.summed = summed = []
+        for a in self.aggs:
+            d = a._delta_combine is operator.add and a.delta( 'oninsert', row)
+            if d is None or d is False:
+                self.summed = None
+                break
+            if not isinstance( d, ClauseElement): d = literal_column( repr( d))
+            summed.append( func.sum( d))
+        n = len( self.columns)
+        q = select( self.columns + (self.summed or []), stmt._whereclause, group_by= self.columns)
+        self.rows = rows = dict()
+        for p in paramsets:
+            for r in self.conn.execute( q, p):
+                key = tuple( r[ :n])
+                sums = list( r[ n:])
+                if key in rows and self.summed:
+                    sums = [ _add( x,y) for x,y in zip( rows[ key], sums) ]
+                rows[ key] = sums
+
+    def apply( self):
+        if not self.static or not self.summed:
+            return self.recalc( getattr( self, 'rows', ()))
+        recalc = []
+        bindings = []
+        for key, sums in self.rows.iteritems():
+            if None in sums:
+                recalc.append( key)
+                continue
+            b = dict( zip( self.names, key))
+            for a,v in zip( self.aggs, sums):
+                b[ self.ext._delta_key( a)] = -v
+            bindings.append( dict( (Converter._pfx+k, v) for k,v in b.iteritems() ))
+        if bindings:
+            kinds = tuple( 'delta' for a in self.aggs)
+            self.conn.execute( self.ext._statement( self.aggs, kinds, self.conn), bindings)
+        self.recalc( recalc)
+
+class _UpdateGroup( _Group):
+    def before( self, stmt, paramsets):
+        table = self.ext.local_table
+        self.pk = pk = list( table.primary_key.columns)
+        q = select( pk + self.columns, stmt._whereclause)
+        n = len( pk)
+        self.keys = keys = set()
+        self.pks = pks = set()
+        for p in paramsets:
+            for r in self.conn.execute( q, p):
+                pks.add( tuple( r[ :n]))
+                keys.add( tuple( r[ n:]))
+
+    def apply( self):
+        if not self.static:
+            return self.recalc( ())
+        keys = self.keys
+        pks = list( self.pks)
+        pk = self.pk
+        for i in range( 0, len( pks), _chunk):
+            chunk = pks[ i:i+_chunk]
+            if len( pk) == 1:
+                where = pk[0].in_( [ k[0] for k in chunk ])
+            else:
+                where = sqlalchemy.or_( *[ sqlalchemy.and_( *[ c == v for c,v in zip( pk, k) ]) for k in chunk ])
+            for r in self.conn.execute( select( self.columns, where, distinct= True)):
+                keys.add( tuple( r))
+        self.recalc( keys)
+
+# vim:ts=4:sw=4:expandtab
@@ -2,6 +2,7 @@
 
 from aggregation import _Aggregation, _Agg_1Target_1Source, Func, _func_ifnull, case
 from sqlalchemy import func
+from distinct import key_columns, distinct_table
 import operator
 
 class Count( _Agg_1Target_1Source):
@@ -10,11 +11,14 @@ class Count( _Agg_1Target_1Source):
     Special case, no real source column needed (issues count(*) which matches
     all corresponding rows. But column can be specified, then it will count
     non-null values.
+    stripes=N - deltas go to N rows of a side table, see stripes.py
 
     XXX Need support of latter in atomic updates
     """
-    def __init__( self, target, filter_expr=None, source=None):
+    __slots__ = ()
+    def __init__( self, target, filter_expr=None, source=None, stripes=None):
         _Agg_1Target_1Source.__init__( self, target, source=source, filter_expr=filter_expr)
+        self._set_stripes( stripes)
     def setup_fkey( self, key, grouping_attribute):
         if self.source is None: self.source = key.parent
         _Agg_1Target_1Source.setup_fkey( self, key, grouping_attribute)
@@ -30,8 +34,46 @@ class Count( _Agg_1Target_1Source):
     def onupdate( self, func_checker, instance):
         return ()
 
+    _delta_combine = operator.add
+    def delta( self, action, instance):
+        if action == 'oninsert': return 1
+        if action == 'ondelete': return -1
+        return None
+    def delta4array( self, array):
+        return 1
+    def apply_delta( self, func_checker, value):
+        return self.target_or_0( func_checker) + value
+
+
+class CountDistinct( Count):
+    """Count of distinct non-null values of source column
+
+    With Quick, kept exact by the refcounts of a side table (see distinct.py):
+    the target changes only when a value appears or disappears; else, as
+    count(distinct source) recalc.
+    """
+    __slots__ = ( 'keys',)
+    distinct = True
+    def __init__( self, target, source, filter_expr=None):
+        Count.__init__( self, target, filter_expr=filter_expr, source=source)
+        self.keys = key_columns( self.target, filter_expr)
+        distinct_table( self.target, self.source, self.keys)     #in the metadata from now on
+
+    def sqlfunc4column( self, arg):
+        return self._sqlfunc4column( arg.distinct())
+    oninsert = ondelete = onupdate = _Agg_1Target_1Source.onrecalc
+    def delta( self, action, instance):
+        return None     #only via the side table
+    def delta4array( self, array):
+        return None
 
 class Sum( _Agg_1Target_1Source):
+    'stripes=N - deltas go to N rows of a side table, see stripes.py'
+    __slots__ = ()
+    def __init__( self, target, source, filter_expr=None, corresp_src_cols={}, stripes=None):
+        _Agg_1Target_1Source.__init__( self, target, source, filter_expr=filter_expr, corresp_src_cols=corresp_src_cols)
+        self._set_stripes( stripes)
+
     _sqlfunc4column = func.sum
     def oninsert( self, func_checker, instance):
         return self.target_or_0( func_checker) + self.value( instance)
@@ -40,11 +82,35 @@ class Sum( _Agg_1Target_1Source):
     def onupdate( self, func_checker, instance):
         return self.target_or_0( func_checker) - self.oldv( instance) + self.value( instance)
 
+    _delta_combine = operator.add
+    def delta( self, action, instance):
+        #None-values are left to the action-methods, as before
+        if action == 'oninsert':
+            return self.value( instance)
+        if action not in ('ondelete', 'onupdate'): return None
+        old = self.oldv( instance)
+        if old is None: return None
+        if action == 'ondelete':
+            return -old
+        if action == 'onupdate':
+            new = self.value( instance)
+            if new is None: return None
+            return new - old
+        return None
+    def delta4array( self, array):
+        return array[ self.source.key]
+    def apply_delta( self, func_checker, value):
+        return self.target_or_0( func_checker) + value
+    def cascades( self, lower):
+        'sum of counts/sums'
+        return lower._delta_combine is operator.add
+
 _func_if = Func( name= 'if',
                  replacement_expr= lambda a,b,c, **kignore: case( [(a, b)], else_=c)
             )
 
 class Max( _Agg_1Target_1Source):
+    __slots__ = ()
     _sqlfunc4column = func.max
 
     def _func_as_expr( a,b, **kargs):
@@ -66,23 +132,58 @@ class Max( _Agg_1Target_1Source):
                         func_checker= func_checker,
                         type= self.target.type )
     def onupdate( self, func_checker, instance):
-        if self._comparator4updins( self.value( instance), self.oldv( instance)):
+        if self.delta( 'onupdate', instance) is not None:
             return self.oninsert( func_checker, instance)
-        return self.onrecalc( func_checker, instance, old=False)
+        return self._recalc_if_was( func_checker, instance, old=False)
     def ondelete( self, func_checker, instance):
-        return self.onrecalc( func_checker, instance, old=True)
-        #XXX is recalc needed only if curvalue==maxvalue, else nothing ?
-        #e.g. if self.oldv( instance) == current_target_value: then onrecalc()
-        #but no way to gt current_target_value...
+        return self._recalc_if_was( func_checker, instance, old=True)
+
+    #recalc is needed only if the old value is the current extreme (target),
+    #else the target stays as is - decided inside the db
+    def recalc_if( self, func_checker, value, recalc):
+        'sql: recalc only if target holds value, i.e. the extreme is leaving'
+        return case( [ (self.target == value, recalc.as_scalar()) ], else_= self.target)
+    def _recalc_if_was( self, func_checker, instance, old):
+        recalc,vbindings = self.onrecalc( func_checker, instance, old=old)
+        return self.recalc_if( func_checker, self.oldv( instance), recalc), vbindings
+    def conditional_recalc( self, action, instance):
+        if callable( self._filter4recalc[0]): return None
+        if self.oldv( instance) is None: return None    #NULL was no extreme; target = NULL never holds
+        if action == 'ondelete': return self.oldv( instance), True
+        if action == 'onupdate': return self.oldv( instance), False    #not a delta, i.e. moving away
+        return None
+
+    _delta_combine = max
+    def delta( self, action, instance):
+        'only growing values are deltas - candidates for the new extreme'
+        if action == 'oninsert':
+            return self.value( instance)
+        if action == 'onupdate':
+            new = self.value( instance)
+            old = self.oldv( instance)
+            if new is not None and (old is None or self._comparator4updins( new, old)):
+                return new      #not by python ordering of None - it is below all for Min too
+        return None
+    def delta4array( self, array):
+        return array[ self.source.key]
+    def apply_delta( self, func_checker, value):
+        return self.sqlfunc4args( self.target, value,
+                        func_checker= func_checker,
+                        type= self.target.type )
+    def cascades( self, lower):
+        'max of maxes, min of mins - the growing extremes'
+        return lower._delta_combine is self._delta_combine
 
 
 class Min( Max):
+    __slots__ = ()
     _sqlfunc4column = func.min
     def _func_as_expr( a,b, **kargs):
         return _func_if( (a == None) | (a > b), b, a, **kargs)
         #return _func_if( (a == None) | (b != None) & (a > b), b, a, **kargs)
     _sqlfunc4args = Func( 'min', _func_as_expr)
     _comparator4updins = operator.le
+    _delta_combine = min
 
 
 def AverageSimple( target, source, target_count, filter_expr =None):
@@ -104,6 +205,7 @@ class Average( _Aggregation):
     This same thing with Accurate mapping-method needs only one column -
     the average value - and no properties.
     """
+    __slots__ = ( 'sum', 'count')
     def __init__( self, target, source, target_count):
         self.sum = Sum( target, source)
         self.count = Count( target_count)
@@ -131,12 +233,17 @@ class Average( _Aggregation):
         return self._combined( 'onupdate', *a,**k)
     def onrecalc( self, *a,**k):
         return self._combined( 'onrecalc', *a,**k)
+    def recalc4set( self):
+        r = self.sum.recalc4set()
+        r.update( self.count.recalc4set())
+        return r
 
 class Average1( _Agg_1Target_1Source):
     """Average aggregation, always accurate = full sqlfunc
     source - Column object which value will be aggregated
     target - Column object where to store value of aggregation
     """
+    __slots__ = ()
     _sqlfunc4column = func.avg
     oninsert = ondelete = onupdate = _Agg_1Target_1Source.onrecalc
 
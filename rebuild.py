@@ -0,0 +1,56 @@
+#$Id$
+
+'''Full set-based rebuild of all aggregations maintained by Quick/Accurate
+mapper extensions, e.g. after restoring a backup or fixing an aggregation.
+See Quick.rebuild().
+
+Usage:
+    python -m aggregator.rebuild dburl module [module ...]
+the modules are imported to get the mappers (with their aggregating extensions)
+made; all is done in one transaction.
+'''
+
+import sys
+import sqlalchemy
+import sqlalchemy.orm
+from sqlalchemy.orm import mapperlib
+from aggregation import Quick
+
+def extensions():
+    'yield (mapper, extension) for all Quick/Accurate extensions of all mappers'
+    sqlalchemy.orm.compile_mappers()
+    seen = set()
+    for mapper in list( mapperlib._mapper_registry):
+        for ext in mapper.extension:
+            if isinstance( ext, Quick) and ext not in seen:
+                seen.add( ext)
+                yield mapper, ext
+
+def rebuild_all( bind):
+    for mapper,ext in extensions():
+        ext._setup( mapper)
+        ext.rebuild( bind)
+
+def main( argv):
+    if len( argv) < 2:
+        print __doc__
+        return 2
+    dburl = argv[0]
+    for name in argv[1:]:
+        __import__( name)
+    engine = sqlalchemy.create_engine( dburl)
+    connection = engine.connect()
+    trans = connection.begin()
+    try:
+        rebuild_all( connection)
+    except:
+        trans.rollback()
+        raise
+    trans.commit()
+    connection.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit( main( sys.argv[1:]))
+
+# vim:ts=4:sw=4:expandtab
@@ -0,0 +1,106 @@
+#$Id$
+
+'''Time-bucketed rollups - aggregations kept per hour/day/month.. of a source
+datetime column, in a summary table keyed by the start of the bucket
+(plus optional dimension columns):
+
+    hourly = Table( 'hourly', meta,
+        Column( 'hour', DateTime, primary_key=True),
+        Column( 'host', String(20), primary_key=True),
+        Column( 'requests', Integer),
+        Column( 'bytes', Integer),
+        Column( 'biggest', Integer),
+        )
+    mapper( Request, requests, extension= Quick( upsert=True,
+        *Rollup( hourly.c.hour, requests.c.time, 'hour',
+            Count( hourly.c.requests),
+            Sum( hourly.c.bytes, requests.c.bytes),
+            Max( hourly.c.biggest, requests.c.bytes),
+            dimensions= [ (hourly.c.host, requests.c.host) ],
+        )))
+
+The filter of the aggregations is  key == bucket( source, unit) and the
+dimensions equal; the bucket is computed inside the db, hence usual
+updates, recalcs and rebuild() work as with any other filter. With upsert=True
+the bucket rows are made by their first source row - the key and dimension
+columns must be the primary key (or unique) of the summary table.
+The initial fill of existing data is one rebuild().
+
+bucket() compiles to date_trunc() on postgres, strftime() on sqlite and
+DATE_FORMAT() on mysql; needs sqlalchemy.ext.compiler (SA >= 0.5.4).
+'''
+
+from sqlalchemy import and_
+from sqlalchemy.sql.expression import Function, _BindParamClause
+from sqlalchemy import types
+from aggregation import compiles, _is_postgres
+
+_formats = dict(    #start of the bucket, as of strftime
+    minute= '%Y-%m-%d %H:%M:00',
+    hour=   '%Y-%m-%d %H:00:00',
+    day=    '%Y-%m-%d',
+    month=  '%Y-%m-01',
+    year=   '%Y-01-01',
+)
+units = tuple( sorted( _formats))
+
+class bucket( Function):
+    '''the start of the time bucket of datetime expression expr: unit is one of
+    minute, hour, day, month, year; the result is of type_ (Date or DateTime),
+    default as of expr'''
+    def __init__( self, expr, unit, type_ =None):
+        if unit not in _formats:
+            raise ValueError( 'bucket unit must be one of %s: %r' % (', '.join( units), unit))
+        if not compiles:
+            raise NotImplementedError( 'bucket() needs sqlalchemy.ext.compiler')
+        Function.__init__( self, 'bucket', expr, type_= type_ or getattr( expr, 'type', None))
+        self.unit = unit
+
+def _is_date( type):
+    'Date but not DateTime'
+    return isinstance( type, types.Date) and not isinstance( type, types.DateTime)
+
+def _string( compiler, s):
+    'sql string literal, with % escaped as needed by the paramstyle'
+    if compiler.dialect.paramstyle in ('format', 'pyformat'):
+        s = s.replace( '%', '%%')
+    return "'" + s + "'"
+
+if compiles:
+    @compiles( bucket)
+    def _compile_bucket( element, compiler, **kw):
+        expr, = element.clauses
+        arg = compiler.process( expr)
+        date = _is_date( element.type)
+        fmt = _formats[ element.unit]
+        if not date and len( fmt) < 11:
+            fmt += ' 00:00:00'
+        dialect = compiler.dialect
+        if _is_postgres( dialect):
+            if isinstance( expr, _BindParamClause):
+                arg = 'CAST(%s AS TIMESTAMP)' % arg
+            text = 'date_trunc(%s, %s)' % (_string( compiler, element.unit), arg)
+            return date and 'CAST(%s AS DATE)' % text or text
+        if dialect.name == 'sqlite':
+            if not date: fmt += '.000000'     #as SA stores DateTime there
+            return 'strftime(%s, %s)' % (_string( compiler, fmt), arg)
+        if dialect.name == 'mysql':
+            return 'CAST(DATE_FORMAT(%s, %s) AS %s)' % (
+                    arg, _string( compiler, fmt.replace( '%M', '%i')), date and 'DATE' or 'DATETIME')
+        raise NotImplementedError( 'bucket() on %s' % dialect.name)
+
+def Rollup( key, source, unit, *aggregations, **kargs):
+    '''aggregations (Count, Sum, Max, Min..) of the target table of key column,
+    per bucket( source, unit) in key; dimensions= [(target column, source column)..]
+    are further key columns. Returns the aggregations with their filter set.'''
+    dimensions = kargs.get( 'dimensions', ())
+    fexpr = and_( key == bucket( source, unit, type_= key.type),
+                *[ t == s for t,s in dimensions ])
+    for a in aggregations:
+        if a.target.table is not key.table:
+            raise ValueError( 'rollup of %s into %s' % (a.target, key.table))
+        assert a.filter_expr is None, a
+        a.filter_expr = fexpr
+    return aggregations
+
+# vim:ts=4:sw=4:expandtab
@@ -0,0 +1,181 @@
+#$Id$
+
+'''Striped counters - for hot target rows, on which the Quick atomic updates
+serialize (row lock) under many concurrent writers.
+
+A Count/Sum with stripes=N does not update its target column; its deltas go
+to one of N rows of a side table <target>_stripes( <target pk>, stripe, <column>..),
+the stripe chosen per thread - so concurrent writers touch different rows.
+The real value is the target column plus the sum of its stripes:
+    striped( blocks.c.lines)        #sql expression, correlated to blocks
+or, moved into the target column once in a while (the stripes are zeroed):
+    fold_stripes( ext, bind)
+The side table is in the metadata of the target table; create it with the
+rest (metadata.create_all()), or with stripes_table( column).create().
+
+Only for aggregations grouped by the target primary key (single column) being
+equal to a source column - e.g. by foreign key. rebuild() zeroes the stripes.
+Accurate does not use the stripes: it recalculates the target columns as usual,
+and striped() is just the target column then.
+'''
+
+import threading
+import itertools
+import random
+from sqlalchemy import Table, Column, Integer, ForeignKey, select, func, and_, bindparam, exc
+
+_local = threading.local()
+_next = itertools.count( random.randint( 0, 1<<16))     #differ between processes
+def stripe( n):
+    'the stripe of the current thread, of n'
+    try:
+        s = _local.stripe
+    except AttributeError:
+        s = _local.stripe = _next.next()
+    return s % n
+
+def _pk( table):
+    pk = list( table.primary_key.columns)
+    if len( pk) != 1:
+        raise NotImplementedError( 'striped aggregation needs single-column primary key: %s' % table)
+    return pk[0]
+
+def stripes_table( target):
+    'the side table of target column (made if not yet), with a column for it'
+    table = target.table
+    pk = _pk( table)
+    name = table.name + '_stripes'
+    st = table.metadata.tables.get( name)
+    if st is None:
+        st = Table( name, table.metadata,
+            Column( pk.name, pk.type, ForeignKey( pk), primary_key=True),
+            Column( 'stripe', Integer, primary_key=True, autoincrement=False),
+            )
+    if target.name not in st.c:
+        st.append_column( Column( target.name, target.type))
+    return st
+
+def striped( target):
+    'sql expression of the real value of striped target column, correlated to its table'
+    st = stripes_table( target)
+    pk = _pk( target.table)
+    return (func.coalesce( target, 0) +
+            select( [ func.coalesce( func.sum( st.c[ target.name]), 0) ],
+                st.c[ pk.name] == pk ).as_scalar())
+
+def fold_stripes( ext, bind =None):
+    '''move the stripes of all striped aggregations of the extension into their
+    target columns. What is read is subtracted from the stripes, so concurrent
+    writers lose nothing. bind - Connection or Engine, default metadata.bind;
+    done in own transaction if not in one.'''
+    if bind is None: bind = ext.local_table.metadata.bind
+    if ext.mapper: ext._setup( ext.mapper)
+    for g in ext._striped.itervalues():
+        g.fold( bind)
+
+class StripedGroup( object):
+    'the striped aggregations of one aggregation group'
+    def __init__( self, aggs, mapper):
+        self.aggs = [ a for a in aggs if getattr( a, 'stripes', None) ]
+        a0 = aggs[0]
+        table = a0.target_table
+        pk = _pk( table)
+        pairs, rest = a0._equijoin or (None, None)
+        if not pairs or rest or len( pairs) != 1 or pairs[0][1] is not pk:
+            raise NotImplementedError( 'striped aggregation needs a filter target.pk == source.column: %s' % table)
+        self.attribute = mapper._columntoproperty[ pairs[0][0]].key
+        self.target = table
+        self.table = st = stripes_table( self.aggs[0].target)
+        self.n = max( a.stripes for a in self.aggs)
+        self.names = [ a.target.name for a in self.aggs ]
+        self.key = st.c[ pk.name]
+        self.where = and_( self.key == bindparam( 's_key'), st.c.stripe == bindparam( 's_stripe'))
+        self._statements = dict()
+
+    def statements( self, names, dialect):
+        '''the (update, insert) adding to the stripe for target columns names;
+        (upsert, None) if the dialect has it - the first writer of a stripe makes its row'''
+        from aggregation import _Upsert, _upserted, _supports_upsert, _dialect_key   #it imports this module
+        k = (names, _dialect_key( dialect))
+        try:
+            return self._statements[ k]
+        except KeyError: pass
+        st = self.table
+        values = { self.key.name: bindparam( 's_key'), 'stripe': bindparam( 's_stripe') }
+        for n in self.names:
+            values[ n] = n in names and bindparam( 's_'+n, type_= st.c[ n].type) or 0
+        if _supports_upsert( dialect):
+            ups = _Upsert( st, values, [ self.key, st.c.stripe ],
+                    dict( (n, st.c[ n] + _upserted( st.c[ n], dialect)) for n in names ))
+            r = ups.compile( dialect= dialect, column_keys= []), None
+        else:
+            upd = st.update( self.where, values= dict(
+                        (n, st.c[ n] + bindparam( 's_'+n, type_= st.c[ n].type)) for n in names ))
+            ins = st.insert( values= values)
+            r = ( upd.compile( dialect= dialect, column_keys= []),
+                  ins.compile( dialect= dialect, column_keys= []) )
+        self._statements[ k] = r
+        return r
+
+    def apply( self, deltas, instance, old, connection, execute =None):
+        '''add deltas {agg:value} of instance to its target row, in the stripe of this thread.
+        Without upsert: update, or insert if no row; if another writer inserted it
+        meanwhile, update again (stripe rows are never deleted).
+        execute - of the statements, default connection.execute (see Quick._executor)'''
+        key = self.aggs[0]._get_current_or_orig( instance, self.attribute, old)
+        if key is None: return None
+        names = tuple( a.target.name for a in self.aggs if a in deltas)
+        bindings = dict( ('s_'+a.target.name, d) for a,d in deltas.iteritems())
+        bindings.update( s_key= key, s_stripe= stripe( self.n))
+        upd, ins = self.statements( names, connection.dialect)
+        if execute is None: execute = connection.execute
+        r = execute( upd, **bindings)
+        if ins is not None and not r.rowcount:
+            try:
+                r = execute( ins, **bindings)
+            except exc.IntegrityError:
+                r = execute( upd, **bindings)
+        return r
+
+    def fold( self, bind):
+        st = self.table
+        names = self.names
+        if hasattr( bind, 'in_transaction'):
+            conn, close = bind, False
+        else:
+            conn, close = bind.connect(), True
+        trans = not conn.in_transaction() and conn.begin() or None
+        try:
+            rows = conn.execute( select( [ self.key, st.c.stripe ] + [ st.c[ n] for n in names ])).fetchall()
+            rows = [ r for r in rows if [ v for v in r[2:] if v ] ]
+            if rows:
+                conn.execute( st.update( self.where, values= dict(
+                            (n, st.c[ n] - bindparam( 's_'+n, type_= st.c[ n].type)) for n in names )),
+                        [ dict( [ ('s_key', r[0]), ('s_stripe', r[1]) ] +
+                                [ ('s_'+n, v or 0) for n,v in zip( names, r[2:]) ]) for r in rows ])
+                sums = dict()
+                for r in rows:
+                    s = sums.setdefault( r[0], [0]*len( names))
+                    for i,v in enumerate( r[2:]):
+                        s[ i] += v or 0
+                pk = _pk( self.target)
+                conn.execute( self.target.update( pk == bindparam( 's_key'), values= dict(
+                            (n, func.coalesce( self.target.c[ n], 0) + bindparam( 's_'+n, type_= self.target.c[ n].type))
+                            for n in names )),
+                        [ dict( [ ('s_key', k) ] + [ ('s_'+n, v) for n,v in zip( names, s) ])
+                            for k,s in sums.iteritems() ])
+            if trans: trans.commit()
+        except:
+            if trans: trans.rollback()
+            raise
+        finally:
+            if close: conn.close()
+
+    def clear( self, bind, where =None):
+        '''zero the stripes of target rows matching where (default all) -
+        their target columns are recalculated'''
+        if where is not None:
+            where = self.key.in_( select( [ _pk( self.target) ], where))
+        bind.execute( self.table.update( where, values= dict( (n, 0) for n in self.names)))
+
+# vim:ts=4:sw=4:expandtab
@@ -0,0 +1,50 @@
+import testbase
+import unittest
+from aggregator.bench import run, schemas, data, micro
+from aggregator.bench.null import NullConnection
+
+class BenchTest(unittest.TestCase):
+    'smoke test of the benchmark - all schemas and modes, small scale'
+    def testRun(self):
+        for schema in schemas.all:
+            for mode in sorted(run.modes):
+                r = run.run1(testbase.dburl, schema(), mode, scale=30, targets=5, skew='zipf', batch=10)
+                self.assertEquals([x['op'] for x in r], ['insert', 'update', 'move', 'delete'])
+                for x in r:
+                    self.assertEquals(x['ops'], 30)
+                    self.assertEquals((x['schema'], x['mode']), (schema.name, mode))
+                    self.assert_(x['flush_p50_ms'] <= x['flush_p99_ms'])
+
+    def testMicro(self):
+        'no db i/o: one statement per instance for the one group of simple'
+        r = micro.run1(schemas.Simple(), 'quick', 20, targets=5, skew='uniform')
+        self.assertEquals([x['action'] for x in r], list(micro.actions))
+        for x in r:
+            if x['action'] != 'move':
+                self.assertEquals(x['statements'], 20)
+                self.assertEquals(x['shapes'], 1)
+        r = micro.run1(schemas.Simple(), 'off', 20, targets=5, skew='uniform')
+        self.assertEquals([x['statements'] for x in r], [0]*4)
+
+    def testNullConnection(self):
+        import sqlalchemy
+        t = sqlalchemy.Table('t', sqlalchemy.MetaData(), sqlalchemy.Column('a', sqlalchemy.Integer))
+        conn = NullConnection(sqlalchemy.create_engine(testbase.dburl).dialect)
+        conn.execute(t.update(), a=1)
+        conn.execute(t.update(), [dict(a=2), dict(a=3)])
+        self.assertEquals(len(conn.statements), 2)
+        self.assertEquals(conn.shapes().values(), [2])
+        self.assertEquals(conn.statements[0][1], dict(a=1))
+        conn.clear()
+        self.assertEquals(conn.statements, [])
+
+    def testZipf(self):
+        choose = data.chooser('zipf:2', range(100))
+        counts = {}
+        for i in range(1000):
+            k = choose()
+            counts[k] = counts.get(k, 0) + 1
+        self.assert_(max(counts.values()) > 400)    #~1/zeta(2) = 0.61
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import testbase
+import unittest
+import aggregator as a
+from sqlalchemy import *
+from sqlalchemy.orm import mapper
+
+class BudgetTest(testbase.TestBase):
+    'statements issued per flush, not only the final values'
+    N = 12  #lines
+    K = 3   #blocks
+
+    def setUp(self):
+        super(BudgetTest, self).setUp()
+        blocks = Table('blocks', self.meta,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('lines', Integer),
+            Column('lastline', Integer),
+            Column('length', Integer),
+            )
+        lines = Table('lines', self.meta,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('block', Integer, ForeignKey(blocks.c.id)),
+            Column('length', Integer, default=10),
+            )
+        class Block(object):
+            pass
+        class Line(object):
+            pass
+        self.Block = Block
+        self.Line = Line
+        self.meta.create_all()
+        mapper(Block, blocks)
+        mapper(Line, lines,
+            extension=self.aggregator_class(
+                a.Max(blocks.c.lastline, lines.c.id),
+                a.Count(blocks.c.lines),
+                a.Sum(blocks.c.length, lines.c.length),
+            ))
+        self.blocks = [self.Block() for i in range(self.K)]
+        self.save(*self.blocks)
+
+    def insert(self):
+        lines = []
+        for i in range(self.N):
+            l = self.Line()
+            l.block = self.blocks[i % self.K].id
+            l.length = i
+            self.session.save(l)
+            lines.append(l)
+        self.session.flush()
+        return lines
+
+    def check(self):
+        for b in self.blocks:
+            self.refresh(b)
+            self.assertEquals(b.lines, self.N / self.K)
+        self.assertEquals(sum(b.length for b in self.blocks), sum(range(self.N)))
+
+    def testInsert(self):
+        with self.budget(self.Line, self.N) as rec:    #one fused update per line
+            self.insert()
+        self.assertEquals(rec.count(action=self._insert_method), rec.count())
+        self.assertEquals(rec.count(aggregation='Count(blocks.lines)'), rec.count())
+        self.check()
+
+    def testUpdateValue(self):
+        lines = self.insert()
+        with self.budget(self.Line, self.N):
+            for l in lines: l.length += 100
+            self.session.flush()
+
+    def testMove(self):
+        lines = self.insert()
+        with self.budget(self.Line, self.move_budget):
+            lines[0].block = self.blocks[1].id
+            self.session.flush()
+
+    def testDelete(self):
+        lines = self.insert()
+        with self.budget(self.Line, self.delete_budget):
+            for l in lines: self.session.delete(l)
+            self.session.flush()
+
+    def testBulkInsert(self):
+        with self.budget(self.Line, self.K):    #one per block
+            a.bulk_insert(self.extension(self.Line),
+                [dict(block=self.blocks[i % self.K].id, length=i) for i in range(self.N)])
+        self.check()
+
+    _insert_method = 'oninsert'
+    move_budget = 2     #from one block, into another
+    delete_budget = N
+
+class BudgetTest2(BudgetTest, testbase.TestAccurateMixin):
+    _insert_method = 'onrecalc'
+    def testBulkInsert(self):
+        with self.budget(self.Line, 1):    #one set-based recalc
+            a.bulk_insert(self.extension(self.Line),
+                [dict(block=self.blocks[i % self.K].id, length=i) for i in range(self.N)])
+        self.check()
+
+class BudgetTest5(BudgetTest, testbase.TestCoalesceMixin):
+    #Max leaving recalcs go per instance, the deltas per block
+    move_budget = 3
+    delete_budget = BudgetTest.N + BudgetTest.K
+    def testInsert(self):
+        with self.budget(self.Line, self.K) as rec:    #one per block, at end of flush
+            self.insert()
+        self.assertEquals(rec.count(action=None), rec.count())
+        self.check()
+    def testUpdateValue(self):
+        lines = self.insert()
+        with self.budget(self.Line, self.K):
+            for l in lines: l.length += 100
+            self.session.flush()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import testbase
+import unittest
+import aggregator as a
+from sqlalchemy import *
+from sqlalchemy.orm import mapper
+
+class CascadeTest(testbase.TestBase):
+    'Line -> Block -> Document, the document totals kept by the block updates'
+    def setUp(self):
+        super(CascadeTest, self).setUp()
+        docs = self.docs = Table('docs', self.meta,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('blocks', Integer),
+            Column('lines', Integer),
+            Column('length', Integer),
+            Column('lastline', Integer),
+            )
+        blocks = self.blocks = Table('blocks', self.meta,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('doc', Integer, ForeignKey(docs.c.id)),
+            Column('lines', Integer),
+            Column('length', Integer),
+            Column('lastline', Integer),
+            )
+        lines = self.lines = Table('lines', self.meta,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('block', Integer, ForeignKey(blocks.c.id)),
+            Column('length', Integer, default=10),
+            )
+        self.meta.create_all()
+        class Doc(object): pass
+        class Block(self.EasyInit): pass
+        class Line(self.EasyInit): pass
+        self.Doc, self.Block, self.Line = Doc, Block, Line
+        mapper(Doc, docs)
+        mapper(Block, blocks,
+            extension=self.aggregator_class(
+                a.Count(docs.c.blocks),
+                a.Sum(docs.c.lines, blocks.c.lines),
+                a.Sum(docs.c.length, blocks.c.length),
+                a.Max(docs.c.lastline, blocks.c.lastline),
+            ))
+        mapper(Line, lines,
+            extension=self.aggregator_class(
+                a.Count(blocks.c.lines),
+                a.Sum(blocks.c.length, lines.c.length),
+                a.Max(blocks.c.lastline, lines.c.id),
+                cascade=True,
+            ))
+        self.d1, self.d2 = Doc(), Doc()
+        self.save(self.d1, self.d2)
+        self.b1 = Block(doc=self.d1.id, lines=0, length=0, lastline=0)
+        self.b2 = Block(doc=self.d1.id, lines=0, length=0, lastline=0)
+        self.b3 = Block(doc=self.d2.id, lines=0, length=0, lastline=0)
+        self.save(self.b1, self.b2, self.b3)
+
+    def check(self):
+        self.session.expire_all()
+        lines = self.session.query(self.Line).all()
+        blocks = self.session.query(self.Block).all()
+        for b in blocks:
+            mine = [ l for l in lines if l.block == b.id ]
+            self.assertEquals((b.lines, b.length or 0, b.lastline or 0),
+                (len(mine), sum(l.length for l in mine), max([ l.id for l in mine ] or [0])))
+        for d in self.session.query(self.Doc).all():
+            mine = [ b for b in blocks if b.doc == d.id ]
+            self.assertEquals((d.blocks, d.lines, d.length or 0, d.lastline or 0),
+                (len(mine), sum(b.lines for b in mine), sum(b.length or 0 for b in mine),
+                 max([ b.lastline or 0 for b in mine ] or [0])))
+
+    def makeLines(self):
+        lines = [ self.Line(block=b.id, length=n)
+                  for b,n in [ (self.b1,1), (self.b1,2), (self.b2,3), (self.b3,4) ] ]
+        for l in lines:
+            self.save(l)
+        return lines
+
+    def testInsert(self):
+        with self.budget(self.Block) as rec:
+            self.makeLines()
+        self.check()
+        self.assertEquals(rec.count(action='cascade'), 4)
+        self.failIf([ k for g,n,kinds,act in rec.statements for k in kinds if k and k != 'delta' ], str(rec))
+
+    def testUpdateMove(self):
+        lines = self.makeLines()
+        lines[0].length = 10
+        self.session.flush()
+        self.check()
+        lines[1].block = self.b3.id     #to another doc
+        self.session.flush()
+        self.check()
+
+    def testDelete(self):
+        lines = self.makeLines()
+        self.session.delete(lines[3])
+        self.session.delete(lines[1])
+        self.session.flush()
+        self.check()
+
+    def testBlockMove(self):
+        'the block level is maintained by its own extension as usual'
+        self.makeLines()
+        self.session.expire_all()
+        b = self.session.query(self.Block).get(self.b1.id)
+        b.doc = self.d2.id
+        self.session.flush()
+        self.check()
+
+    def testCycle(self):
+        t1 = Table('t1', self.meta,
+            Column('id', Integer, primary_key=True),
+            Column('t2', Integer, ForeignKey('t2.id')),
+            Column('total', Integer),
+            )
+        t2 = Table('t2', self.meta,
+            Column('id', Integer, primary_key=True),
+            Column('t1', Integer, ForeignKey(t1.c.id)),
+            Column('total', Integer),
+            )
+        class T1(object): pass
+        class T2(object): pass
+        m1 = mapper(T1, t1, extension=self.aggregator_class(a.Sum(t2.c.total, t1.c.total), cascade=True))
+        mapper(T2, t2, extension=self.aggregator_class(a.Sum(t1.c.total, t2.c.total)))
+        self.assertRaises(ValueError, self.extension(T1)._setup, m1)
+        self.meta.remove(t1)
+        self.meta.remove(t2)
+
+class CascadeTest2(CascadeTest, testbase.TestAccurateMixin):
+    def testInsert(self):
+        self.makeLines()
+        self.check()
+class CascadeTest5(CascadeTest, testbase.TestCoalesceMixin):
+    pass
+
+if __name__ == '__main__':
+    unittest.main()
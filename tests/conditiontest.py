@@ -192,6 +192,124 @@ class TestBlog(testbase.TestBase):
         d3 = self.session.query(self.StatRow).get(date(2001,01,03))
         self.assertEquals((1,3,4), (d1.posts_so_far, d2.posts_so_far, d3.posts_so_far))
 
+    def testRebuild(self):
+        from datetime import date
+        self.save(
+            self.StatRow(date=date(2001,01,01)),
+            self.StatRow(date=date(2001,01,02)),
+            self.StatRow(date=date(2001,01,03)),
+            )
+        ext = self.extension(self.BlogEntry)
+        ext.off = True
+        self.save(
+            self.BlogEntry(date=date(2001,01,02), text="I can speak"),
+            self.BlogEntry(date=date(2001,01,02), text="Wow, I can walk too!"),
+            self.BlogEntry(date=date(2001,01,03), text="I'm not human :)"),
+            )
+        ext.off = False
+        ext.rebuild(self.session)
+        self.session.clear()
+        d1 = self.session.query(self.StatRow).get(date(2001,01,01))
+        d2 = self.session.query(self.StatRow).get(date(2001,01,02))
+        d3 = self.session.query(self.StatRow).get(date(2001,01,03))
+        self.assertEquals((0,2,3), (d1.posts_so_far, d2.posts_so_far, d3.posts_so_far))
+
+    def testRebuildRunning(self):
+        'range filter - rebuilt by one sorted merge'
+        import operator
+        from datetime import date, timedelta
+        from aggregator.convert_expr import split_range
+        pairs, (src, op, tcol), rest = split_range(self.blog.c.date <= self.stats.c.date, self.stats)
+        self.assertEquals((pairs, src, op, tcol, rest), ([], self.blog.c.date, operator.ge, self.stats.c.date, []))
+        self.assertEquals(split_range(self.stats.c.date == self.blog.c.date, self.stats), None)
+
+        days = [ date(2001,01,01) + timedelta(days=i) for i in range(20) ]
+        self.save(*[ self.StatRow(date=d) for d in days ])
+        ext = self.extension(self.BlogEntry)
+        ext.off = True
+        posts = [ days[ (i*7) % 25 ] for i in range(50) if (i*7) % 25 < 20 ]
+        self.save(*[ self.BlogEntry(date=d, text='x') for d in posts ])
+        ext.off = False
+        ext.rebuild(self.session)
+        self.session.clear()
+        for d in days:
+            s = self.session.query(self.StatRow).get(d)
+            self.assertEquals(s.posts_so_far, len([ p for p in posts if p <= d ]))
+
+    def testBulkLoad(self):
+        from datetime import date
+        self.save(
+            self.StatRow(date=date(2001,01,01)),
+            self.StatRow(date=date(2001,01,02)),
+            self.StatRow(date=date(2001,01,03)),
+            )
+        with self.extension(self.BlogEntry).bulk_load(self.session):
+            self.session.save(self.BlogEntry(date=date(2001,01,02), text="I can speak"))
+            self.session.save(self.BlogEntry(date=date(2001,01,02), text="Wow, I can walk too!"))
+            self.session.save(self.BlogEntry(date=date(2001,01,03), text="I'm not human :)"))
+        self.session.clear()
+        d1 = self.session.query(self.StatRow).get(date(2001,01,01))
+        d2 = self.session.query(self.StatRow).get(date(2001,01,02))
+        d3 = self.session.query(self.StatRow).get(date(2001,01,03))
+        self.assertEquals((None,2,3), (d1.posts_so_far, d2.posts_so_far, d3.posts_so_far))
+
+    def testBulkInsert(self):
+        from datetime import date
+        self.save(
+            self.StatRow(date=date(2001,01,01)),
+            self.StatRow(date=date(2001,01,02)),
+            self.StatRow(date=date(2001,01,03)),
+            )
+        a.bulk_insert(self.extension(self.BlogEntry), [
+            dict(date=date(2001,01,02), text="I can speak"),
+            dict(date=date(2001,01,02), text="Wow, I can walk too!"),
+            dict(date=date(2001,01,03), text="I'm not human :)"),
+            ])
+        self.session.clear()
+        d1 = self.session.query(self.StatRow).get(date(2001,01,01))
+        d2 = self.session.query(self.StatRow).get(date(2001,01,02))
+        d3 = self.session.query(self.StatRow).get(date(2001,01,03))
+        self.assertEquals((None,2,3), (d1.posts_so_far, d2.posts_so_far, d3.posts_so_far))
+
+
+class TestRecent(testbase.TestBase):
+    'a datetime constant in the filter - compared as stored, same-day times too'
+    def setUp(self):
+        super(TestRecent, self).setUp()
+        users = self.users = Table('users', self.meta,
+            Column('id',  Integer, primary_key=True),
+            Column('recent', Integer),
+            )
+        posts = self.posts = Table('posts', self.meta,
+            Column('id', Integer, primary_key=True),
+            Column('uid', Integer),
+            Column('t', DateTime),
+            )
+        self.meta.create_all()
+        class User(self.EasyInit): pass
+        class Post(self.EasyInit): pass
+        self.User, self.Post = User, Post
+        from datetime import datetime
+        mapper(User, users)
+        mapper(Post, posts,
+            extension=self.aggregator_class(
+                a.Count(users.c.recent, (a.Target(users.c.id) == a.Source(posts.c.uid)) &
+                                        (a.Source(posts.c.t) >= datetime(2009,1,1,10,0))),
+            ))
+
+    def testInsert(self):
+        from datetime import datetime
+        u = self.User(recent=0)
+        self.save(u)
+        self.save(
+            self.Post(uid=u.id, t=datetime(2008,12,31,23,0)),
+            self.Post(uid=u.id, t=datetime(2009,1,1,9,0)),
+            self.Post(uid=u.id, t=datetime(2009,1,1,10,0)),
+            self.Post(uid=u.id, t=datetime(2009,1,1,12,0)),
+            self.Post(uid=u.id, t=datetime(2009,1,2,8,0)),
+            )
+        self.refresh(u)
+        self.assertEquals(u.recent, 3)
 
 class SimpleTest4(SimpleTest3, testbase.TestAccurateMixin):
     pass
@@ -199,8 +317,21 @@ class TagsPerMovie2(TagsPerMovie, testbase.TestAccurateMixin):
     pass
 class TestUserpics2(TestUserpics, testbase.TestAccurateMixin):
     pass
+class TestRecent2(TestRecent, testbase.TestAccurateMixin):
+    pass
 class TestBlog2(TestBlog, testbase.TestAccurateMixin):
     pass
 
+class SimpleTest5(SimpleTest3, testbase.TestCoalesceMixin):
+    pass
+class TagsPerMovie5(TagsPerMovie, testbase.TestCoalesceMixin):
+    pass
+class TestUserpics5(TestUserpics, testbase.TestCoalesceMixin):
+    pass
+class TestRecent5(TestRecent, testbase.TestCoalesceMixin):
+    pass
+class TestBlog5(TestBlog, testbase.TestCoalesceMixin):
+    pass
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,189 @@
+import testbase
+import unittest
+import aggregator as a
+from sqlalchemy import *
+from sqlalchemy.orm import mapper
+
+class DistinctTest(testbase.TestBase):
+    'how many different users wrote in each block'
+    def setUp(self):
+        super(DistinctTest, self).setUp()
+        blocks = self.blocks = Table('blocks', self.meta,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('lines', Integer),
+            Column('users', Integer),
+            )
+        lines = self.lines = Table('lines', self.meta,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('block', Integer, ForeignKey(blocks.c.id)),
+            Column('user', String(20)),
+            )
+        self.users = a.CountDistinct(blocks.c.users, lines.c.user)
+        self.meta.create_all()
+        class Block(self.EasyInit): pass
+        class Line(self.EasyInit): pass
+        self.Block, self.Line = Block, Line
+        mapper(Block, blocks)
+        mapper(Line, lines,
+            extension=self.aggregator_class(
+                a.Count(blocks.c.lines),
+                self.users,
+            ))
+        self.b1 = Block(lines=0, users=0)
+        self.b2 = Block(lines=0, users=0)
+        self.save(self.b1, self.b2)
+
+    def check(self):
+        self.session.expire_all()
+        lines = self.session.query(self.Line).all()
+        for b in self.session.query(self.Block).all():
+            mine = [ l for l in lines if l.block == b.id ]
+            self.assertEquals((b.lines, b.users),
+                (len(mine), len(set(l.user for l in mine if l.user is not None))))
+
+    def refs(self):
+        if not self.extension(self.Line)._distinct_sides:
+            return self.expected_refs()     #count(distinct) recalc, the side table unused
+        side = self.meta.tables['blocks_users_distinct']
+        return sorted(tuple(r) for r in self.meta.bind.execute(select([side.c.id, side.c.value, side.c.refs])))
+
+    def expected_refs(self):
+        lines = self.session.query(self.Line).all()
+        refs = dict()
+        for l in lines:
+            if l.user is not None:
+                refs[(l.block, l.user)] = refs.get((l.block, l.user), 0) + 1
+        return sorted((b,u,n) for (b,u),n in refs.items())
+
+    def makeLines(self):
+        lines = [ self.Line(block=b.id, user=u)
+                  for b,u in [ (self.b1,'ann'), (self.b1,'bob'), (self.b1,'ann'),
+                               (self.b2,'ann'), (self.b2,None) ] ]
+        self.save(*lines)
+        return lines
+
+    def testInsert(self):
+        self.makeLines()
+        self.check()
+
+    def testUpdateMove(self):
+        lines = self.makeLines()
+        lines[1].user = 'ann'       #bob gone
+        lines[3].user = 'cid'
+        self.session.flush()
+        self.check()
+        lines[2].block = self.b2.id
+        lines[4].user = 'bob'
+        self.session.flush()
+        self.check()
+
+    def testDelete(self):
+        lines = self.makeLines()
+        self.session.delete(lines[0])
+        self.session.flush()
+        self.check()
+        self.session.delete(lines[2])
+        self.session.delete(lines[3])
+        self.session.flush()
+        self.check()
+
+    def testRefs(self):
+        'the side table counts each (block, user); no rows of count 0'
+        lines = self.makeLines()
+        lines[0].user = 'cid'
+        self.session.delete(lines[3])
+        self.session.flush()
+        self.session.expire_all()
+        self.assertEquals(self.refs(), self.expected_refs())
+
+    def testRebuild(self):
+        ext = self.extension(self.Line)
+        ext.off = True
+        self.makeLines()
+        ext.off = False
+        ext.rebuild(self.session)
+        self.check()
+        self.assertEquals(self.refs(), self.expected_refs())
+        line = self.session.query(self.Line).filter_by(user='bob').one()
+        line.user = 'ann'
+        self.session.flush()
+        self.check()
+
+    def testBulkLoad(self):
+        ext = self.extension(self.Line)
+        self.makeLines()
+        with ext.bulk_load(self.session):
+            self.save(self.Line(block=self.b2.id, user='dan'), self.Line(block=self.b2.id, user='ann'))
+        self.check()
+        self.assertEquals(self.refs(), self.expected_refs())
+
+    def sides(self):
+        ext = self.extension(self.Line)
+        ext._setup(ext.mapper)
+        return [ s for p in ext._plans.values() for s in p.distinct.values() ]
+
+    def testUpsert(self):
+        'a new value is counted once by the upsert of its side row, where the dialect has it'
+        from aggregator.aggregation import _supports_upsert, _supports_returning
+        dialect = self.meta.bind.dialect
+        for side in self.sides():
+            inc, ins, dec, delete = side.statements(dialect)
+            self.assertEquals(ins is None, _supports_upsert(dialect) and _supports_returning(dialect))
+        self.makeLines()
+        self.check()
+        self.assertEquals(self.refs(), self.expected_refs())
+
+    def testRace(self):
+        'without upsert: a side row inserted meanwhile by another writer is incremented'
+        from aggregator.aggregation import _upserts
+        sides = self.sides()
+        if not sides: return    #count(distinct) recalc
+        side = self.meta.tables['blocks_users_distinct']
+        raced = []
+        class Racing(object):
+            'the connection, where another writer inserts the side row just before us'
+            def __init__(me, connection): me.connection = connection
+            def __getattr__(me, name): return getattr(me.connection, name)
+            def execute(me, stmt, **kargs):
+                if not raced and str(stmt).startswith('INSERT'):
+                    raced.append(me.connection.execute(side.insert(),
+                            id=self.b1.id, value=kargs['d_value'], refs=1).rowcount)
+                return me.connection.execute(stmt, **kargs)
+        apply = sides[0].apply
+        sides[0].apply = lambda action, instance, old, connection, execute=None: apply(action, instance, old, Racing(connection))
+        dialect = self.meta.bind.dialect
+        _upserts[dialect] = False
+        try:
+            self.save(self.Line(block=self.b1.id, user='ann'))
+        finally:
+            del _upserts[dialect]
+            del sides[0].apply
+        self.assertEquals(raced, [1])
+        self.assertEquals(self.refs(), [(self.b1.id, 'ann', 2)])
+        self.session.refresh(self.b1)
+        self.assertEquals((self.b1.lines, self.b1.users), (1, 0))     #the other writer counts it
+
+    def testBudget(self):
+        'the side table statements are in the budget too - O(1) per source row'
+        lines = self.makeLines()
+        sides = self.sides()
+        with self.budget(self.Line, 3) as rec:     #side: upsert, or increment+insert; the target
+            self.save(self.Line(block=self.b1.id, user='eve'))
+        self.assertEquals(bool(sides), bool([ act for g,n,kinds,act in rec.statements if 'distinct' in kinds ]), str(rec))
+        with self.budget(self.Line, 4):     #side: decrement, delete, increment; the target
+            lines[1].user = 'ann'       #bob gone
+            self.session.flush()
+        self.check()
+
+    def testNotUnique(self):
+        'the side table is per target row - no distinct count over a range'
+        self.assertRaises(NotImplementedError, a.CountDistinct, self.blocks.c.users, self.lines.c.user,
+                (a.Target(self.blocks.c.lines) > a.Source(self.lines.c.id)))
+
+class DistinctTest2(DistinctTest, testbase.TestAccurateMixin):
+    pass
+class DistinctTest5(DistinctTest, testbase.TestCoalesceMixin):
+    pass
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import testbase
+import unittest
+import aggregator as a
+from sqlalchemy import bindparam
+from aggregator.intercept import AggregatorProxy
+import simpletest
+import conditiontest
+
+class InterceptMixin(unittest.TestCase):
+    'mass update/delete statements maintained via the engine proxy'
+    def engine_options(self):
+        return dict(proxy=AggregatorProxy())
+
+class SimpleInterceptTest(InterceptMixin, simpletest.SimpleTest):
+    def makeLines(self):
+        b1 = self.Block()
+        b2 = self.Block()
+        self.save(b1, b2)
+        for i in range(10):
+            l = self.Line()
+            l.block = [b1,b2][i%2].id
+            l.length = i
+            self.session.save(l)
+        self.session.flush()
+        return b1, b2
+
+    def check(self, *blocks):
+        self.session.expire_all()
+        for b in blocks:
+            lines = self.session.query(self.Line).filter_by(block=b.id).all()
+            self.assertEquals(b.lines, len(lines))
+            self.assertEquals(b.length or 0, sum(l.length for l in lines))
+            self.assertEquals(b.lastline, lines and max(l.id for l in lines) or None)
+            if lines: self.avg(b)
+
+    def testQueryDelete(self):
+        b1, b2 = self.makeLines()
+        n = self.session.query(self.Line).filter(self.lines.c.length > 4).delete()
+        self.assertEquals(n, 5)
+        self.check(b1, b2)
+        self.assertEquals((b1.lines, b2.lines), (3, 2))
+
+    def testCoreDelete(self):
+        b1, b2 = self.makeLines()
+        self.lines.delete(self.lines.c.block == b2.id).execute()
+        self.check(b1, b2)
+        self.assertEquals(b2.lines, 0)
+
+    def testDeleteMany(self):
+        b1, b2 = self.makeLines()
+        self.meta.bind.execute(
+            self.lines.delete(self.lines.c.length == bindparam('l')),
+            [dict(l=1), dict(l=2), dict(l=3)])
+        self.check(b1, b2)
+        self.assertEquals((b1.lines, b2.lines), (4, 3))
+
+    def testQueryUpdate(self):
+        b1, b2 = self.makeLines()
+        self.session.query(self.Line).filter(self.lines.c.length < 4).update(
+            {'block': b1.id, 'length': self.lines.c.length + 100}, synchronize_session=False)
+        self.check(b1, b2)
+        self.assertEquals((b1.lines, b2.lines), (7, 3))
+
+    def testUpdateUnrelated(self):
+        b1, b2 = self.makeLines()
+        self.lines.update(values={'id': self.lines.c.id}).execute()
+        self.check(b1, b2)
+
+class TestBlogIntercept(InterceptMixin, conditiontest.TestBlog):
+    def testQueryDelete(self):
+        from datetime import date
+        self.save(
+            self.StatRow(date=date(2001,01,01)),
+            self.StatRow(date=date(2001,01,02)),
+            self.StatRow(date=date(2001,01,03)),
+            )
+        self.save(
+            self.BlogEntry(date=date(2001,01,02), text="I can speak"),
+            self.BlogEntry(date=date(2001,01,02), text="Wow, I can walk too!"),
+            self.BlogEntry(date=date(2001,01,03), text="I'm not human :)"),
+            )
+        self.session.query(self.BlogEntry).filter_by(text="I can speak").delete()
+        self.session.clear()
+        d1 = self.session.query(self.StatRow).get(date(2001,01,01))
+        d2 = self.session.query(self.StatRow).get(date(2001,01,02))
+        d3 = self.session.query(self.StatRow).get(date(2001,01,03))
+        self.assertEquals((None,1,2), (d1.posts_so_far, d2.posts_so_far, d3.posts_so_far))
+
+if __name__ == '__main__':
+    unittest.main()
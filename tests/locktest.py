@@ -0,0 +1,116 @@
+import testbase
+import unittest
+import aggregator as a
+from sqlalchemy import *
+from sqlalchemy.orm import mapper
+
+class FakeDeadlock(Exception):
+    'as of MySQLdb'
+    def __init__(self):
+        Exception.__init__(self, 1213, 'Deadlock found when trying to get lock')
+
+class LockOrderTest(testbase.TestBase):
+    'double entry - one item changes two stores, dt and kt'
+    def setUp(self):
+        super(LockOrderTest, self).setUp()
+        stores = Table('stores', self.meta,
+            Column('id', Integer, primary_key=True),
+            Column('total_dt', Integer),
+            Column('total_kt', Integer),
+            )
+        items = Table('items', self.meta,
+            Column('id', Integer, primary_key=True),
+            Column('dt', Integer, ForeignKey(stores.c.id)),
+            Column('kt', Integer, ForeignKey(stores.c.id)),
+            Column('value', Integer),
+            )
+        self.meta.create_all()
+        class Store(object): pass
+        class Item(self.EasyInit): pass
+        self.Store, self.Item = Store, Item
+        mapper(Store, stores)
+        mapper(Item, items,
+            extension=self.aggregator_class(
+                a.Sum(stores.c.total_dt, items.c.value, a.Target(stores.c.id) == a.Source(items.c.dt)),
+                a.Sum(stores.c.total_kt, items.c.value, a.Target(stores.c.id) == a.Source(items.c.kt)),
+            ))
+        self.stores = []
+        for i in range(3):
+            s = Store()
+            s.id = i+1
+            self.stores.append(s)
+        self.save(*self.stores)
+
+        ext = self.extension(Item)
+        self.order = order = []
+        execute = ext._execute
+        keys = [ pfx+k for pfx in ('', a.aggregation.Converter._pfx) for k in ('dt', 'kt') ]
+        def record(connection, stmt, bindings, *args, **kargs):
+            order.append([ v for k,v in sorted(bindings.items()) if k in keys ][0])
+            return execute(connection, stmt, bindings, *args, **kargs)
+        ext._execute = record
+
+    def check(self):
+        self.session.expire_all()
+        items = self.session.query(self.Item).all()
+        for s in self.stores:
+            self.assertEquals(s.total_dt or 0, sum(i.value for i in items if i.dt == s.id))
+            self.assertEquals(s.total_kt or 0, sum(i.value for i in items if i.kt == s.id))
+
+    def testInsert(self):
+        self.save(self.Item(dt=2, kt=1, value=5))
+        self.assertEquals(self.order, [1, 2])
+        del self.order[:]
+        self.save(self.Item(dt=1, kt=2, value=7))
+        self.assertEquals(self.order, [1, 2])
+        self.check()
+
+    def testMove(self):
+        i = self.Item(dt=3, kt=1, value=5)
+        self.save(i)
+        del self.order[:]
+        i.dt, i.kt = 1, 2
+        self.session.flush()
+        self.assertEquals(self.order, sorted(self.order))
+        self.check()
+
+    def testFlush(self):
+        for dt, kt in [(3, 1), (2, 3), (1, 2)]:
+            self.session.save(self.Item(dt=dt, kt=kt, value=1))
+        self.session.flush()
+        self.check()
+
+class LockOrderTest5(LockOrderTest, testbase.TestCoalesceMixin):
+    def testFlush(self):
+        LockOrderTest.testFlush(self)
+        self.assertEquals(self.order, [1, 1, 2, 2, 3, 3])
+
+class RetryTest(unittest.TestCase):
+    def testIsDeadlock(self):
+        self.assert_(a.is_deadlock(FakeDeadlock()))
+        class PgError(Exception):
+            pgcode = '40P01'
+        self.assert_(a.is_deadlock(PgError()))
+        self.failIf(a.is_deadlock(Exception('database is locked')))
+        self.failIf(a.is_deadlock(Exception()))
+
+    def testRetry(self):
+        calls = []
+        rollbacks = []
+        def work():
+            calls.append(1)
+            if len(calls) < 3: raise FakeDeadlock()
+            return 'done'
+        self.assertEquals(a.retry_deadlocks(work, tries=3, delay=0, rollback=lambda: rollbacks.append(1)), 'done')
+        self.assertEquals((len(calls), len(rollbacks)), (3, 2))
+        del calls[:]
+        self.assertRaises(FakeDeadlock, a.retry_deadlocks, work, tries=2, delay=0)
+        def fail():
+            calls.append(1)
+            raise ValueError()
+        del calls[:]
+        self.assertRaises(ValueError, a.retry_deadlocks, fail, delay=0)
+        self.assertEquals(len(calls), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import testbase
+import unittest
+import aggregator as a
+from datetime import datetime, date
+from sqlalchemy import *
+from sqlalchemy.orm import mapper
+
+def hour(t): return t.replace(minute=0, second=0, microsecond=0)
+
+class RollupTest(testbase.TestBase):
+    'requests per hour and host, and per day'
+    upsert = True
+    def setUp(self):
+        super(RollupTest, self).setUp()
+        hourly = self.hourly = Table('hourly', self.meta,
+            Column('hour', DateTime, primary_key=True),
+            Column('host', String(20), primary_key=True),
+            Column('requests', Integer),
+            Column('bytes', Integer),
+            Column('biggest', Integer),
+            )
+        daily = self.daily = Table('daily', self.meta,
+            Column('day', Date, primary_key=True),
+            Column('requests', Integer),
+            Column('smallest', Integer),
+            )
+        requests = self.requests = Table('requests', self.meta,
+            Column('id', Integer, primary_key=True),
+            Column('time', DateTime),
+            Column('host', String(20)),
+            Column('bytes', Integer),
+            )
+        self.meta.create_all()
+        class Request(self.EasyInit): pass
+        class Hourly(object): pass
+        class Daily(object): pass
+        self.Request, self.Hourly, self.Daily = Request, Hourly, Daily
+        aggs = a.Rollup(hourly.c.hour, requests.c.time, 'hour',
+                    a.Count(hourly.c.requests),
+                    a.Sum(hourly.c.bytes, requests.c.bytes),
+                    a.Max(hourly.c.biggest, requests.c.bytes),
+                    dimensions=[ (hourly.c.host, requests.c.host) ],
+                )
+        aggs += a.Rollup(daily.c.day, requests.c.time, 'day',
+                    a.Count(daily.c.requests),
+                    a.Min(daily.c.smallest, requests.c.bytes),
+                )
+        mapper(Request, requests, extension=self.aggregator_class(upsert=self.upsert, *aggs))
+        mapper(Hourly, hourly)
+        mapper(Daily, daily)
+
+    def check(self):
+        self.session.expire_all()
+        reqs = self.session.query(self.Request).all()
+        hours = dict(((r.hour, r.host), r) for r in self.session.query(self.Hourly).all())
+        days = dict((r.day, r) for r in self.session.query(self.Daily).all())
+        keys = set((hour(r.time), r.host) for r in reqs)
+        self.assert_(keys <= set(hours), (keys, hours.keys()))
+        for k in keys:
+            sizes = [ r.bytes for r in reqs if (hour(r.time), r.host) == k ]
+            h = hours[k]
+            self.assertEquals((h.requests, h.bytes, h.biggest), (len(sizes), sum(sizes), max(sizes)))
+        for d in set(r.time.date() for r in reqs):
+            sizes = [ r.bytes for r in reqs if r.time.date() == d ]
+            self.assertEquals((days[d].requests, days[d].smallest), (len(sizes), min(sizes)))
+        return hours, days
+
+    def makeRequests(self):
+        reqs = [ self.Request(time=datetime(2001,1,d,h,m,s), host=host, bytes=b)
+                 for d,h,m,s,host,b in [
+                    (1,10, 0, 0,'a',100), (1,10,59,59,'a',50), (1,10,30, 0,'b',70),
+                    (1,11, 5, 0,'a',10),  (2, 0, 0, 1,'a',20),
+                 ] ]
+        self.save(*reqs)
+        return reqs
+
+    def testInsert(self):
+        self.makeRequests()
+        hours, days = self.check()
+        self.assertEquals(sorted(hours), [
+            (datetime(2001,1,1,10), 'a'), (datetime(2001,1,1,10), 'b'),
+            (datetime(2001,1,1,11), 'a'), (datetime(2001,1,2,0), 'a') ])
+        self.assertEquals(sorted(days), [ date(2001,1,1), date(2001,1,2) ])
+
+    def testUpdateMove(self):
+        reqs = self.makeRequests()
+        reqs[0].bytes = 5
+        reqs[1].time = datetime(2001,1,3,12,0)      #new hour and day
+        reqs[2].host = 'c'
+        self.session.flush()
+        hours, days = self.check()
+        h = hours[(datetime(2001,1,1,10), 'a')]
+        self.assertEquals((h.requests, h.bytes, h.biggest), (1, 5, 5))
+
+    def testDelete(self):
+        reqs = self.makeRequests()
+        self.session.delete(reqs[0])
+        self.session.delete(reqs[4])
+        self.session.flush()
+        self.check()
+
+    def testRebuild(self):
+        'initial fill of existing rows - the buckets are made by the rebuild'
+        ext = self.extension(self.Request)
+        ext.off = True
+        self.makeRequests()
+        ext.off = False
+        self.assertEquals(self.session.query(self.Hourly).count(), 0)
+        ext.rebuild(self.session)
+        self.check()
+
+    def testBucket(self):
+        try:
+            from sqlalchemy.databases import mysql, postgres, sqlite
+        except ImportError:
+            from sqlalchemy.dialects import mysql, postgresql as postgres, sqlite
+        t = self.requests.c.time
+        for b, dialect, text in [
+                (a.bucket(t, 'hour'), postgres.dialect(), "date_trunc('hour', requests.time)"),
+                (a.bucket(t, 'month', Date), postgres.dialect(), "CAST(date_trunc('month', requests.time) AS DATE)"),
+                (a.bucket(t, 'minute'), mysql.dialect(), "CAST(DATE_FORMAT(requests.time, '%%Y-%%m-%%d %%H:%%i:00') AS DATETIME)"),
+                (a.bucket(t, 'day', Date), mysql.dialect(), "CAST(DATE_FORMAT(requests.time, '%%Y-%%m-%%d') AS DATE)"),
+                (a.bucket(t, 'hour'), sqlite.dialect(), "strftime('%Y-%m-%d %H:00:00.000000', requests.time)"),
+                ]:
+            self.assertEquals(str(b.compile(dialect=dialect)), text)
+        self.assertRaises(ValueError, a.bucket, t, 'fortnight')
+
+class RollupTest2(RollupTest, testbase.TestAccurateMixin):
+    pass
+class RollupTest5(RollupTest, testbase.TestCoalesceMixin):
+    pass
+
+if __name__ == '__main__':
+    unittest.main()
@@ -109,6 +109,261 @@ class SimpleTest(testbase.TestBase):
         self.assertEquals(b.length, 70)
         self.avg(b)
 
+    def testBulkLoad(self):
+        b1 = self.Block()
+        b2 = self.Block()
+        self.save(b1, b2)
+        l = self.Line()
+        l.block = b2.id
+        l.length = 5
+        self.save(l)
+        with self.extension(self.Line).bulk_load(self.session):
+            for i in range(10):
+                l = self.Line()
+                l.block = b1.id
+                l.length = i
+                self.session.save(l)
+            self.session.flush()
+            self.session.refresh(b1)
+            self.assertEquals(b1.lines, None)   #not maintained inside
+            l.length = 20
+            l.block = b2.id
+        self.refresh(b1, b2)
+        self.assertEquals(b1.lines, 9)
+        self.assertEquals(b1.length, 36)
+        self.assertEquals(b2.lines, 2)
+        self.assertEquals(b2.length, 25)
+        self.assertEquals(b2.lastline, l.id)
+        self.avg(b1)
+        self.avg(b2)
+
+    def testBulkLoadScope(self):
+        'only the changes of the loading session are deferred; a nested load keeps the outer ones'
+        b1 = self.Block()
+        b2 = self.Block()
+        self.save(b1, b2)
+        ext = self.extension(self.Line)
+        other = create_session()
+        with ext.bulk_load(self.session):
+            l = self.Line()
+            l.block = b1.id
+            l.length = 3
+            self.save(l)
+            o = self.Line()
+            o.block = b2.id
+            o.length = 4
+            other.save(o)
+            other.flush()
+            self.refresh(b1, b2)
+            self.assertEquals((b1.lines, b2.lines), (None, 1))  #other session maintained as usual
+            with ext.bulk_load(self.session):
+                l = self.Line()
+                l.block = b2.id
+                l.length = 5
+                self.save(l)
+            self.refresh(b1, b2)
+            self.assertEquals((b1.lines, b2.lines), (None, 2))  #inner done, outer still pending
+        other.close()
+        self.refresh(b1, b2)
+        self.assertEquals((b1.lines, b1.length, b2.lines, b2.length), (1, 3, 2, 9))
+
+    def testBulkInsert(self):
+        b1 = self.Block()
+        b2 = self.Block()
+        self.save(b1, b2)
+        l = self.Line()
+        l.block = b2.id
+        l.length = 5
+        self.save(l)
+        a.bulk_insert(self.extension(self.Line),
+            [dict(block=b1.id, length=i) for i in range(10)] +
+            [dict(block=b2.id)])    #default length
+        self.refresh(b1, b2)
+        self.assertEquals(b1.lines, 10)
+        self.assertEquals(b1.length, 45)
+        self.assertEquals(b2.lines, 2)
+        self.assertEquals(b2.length, 15)
+        lastline = self.session.query(self.Line).order_by(self.lines.c.id.desc()).first()
+        self.assertEquals(b2.lastline, lastline.id)
+        self.assertEquals(b1.lastline, lastline.id - 1)
+        self.avg(b1)
+        self.avg(b2)
+
+    def testRebuild(self):
+        b1 = self.Block()
+        b2 = self.Block()
+        b3 = self.Block()
+        self.save(b1, b2, b3)
+        ext = self.extension(self.Line)
+        ext.off = True
+        for i in range(10):
+            l = self.Line()
+            l.block = [b1,b2][i%2].id
+            l.length = i
+            self.session.save(l)
+        self.session.flush()
+        b3.lines = 5
+        b3.length = 5
+        self.save(b3)
+        ext.off = False
+        ext.rebuild(self.session)
+        self.refresh(b1, b2, b3)
+        self.assertEquals((b1.lines, b2.lines, b3.lines), (5, 5, 0))
+        self.assertEquals((b1.length, b2.length, b3.length), (20, 25, None))
+        self.assertEquals(b2.lastline, l.id)
+        self.assertEquals(b3.lastline, None)
+        self.avg(b1)
+        self.avg(b2)
+
+    def testStatementCache(self):
+        b1 = self.Block()
+        b2 = self.Block()
+        self.save(b1, b2)
+        l = self.Line()
+        l.block = b1.id
+        self.save(l)
+        statements = dict(self.extension(self.Line)._statements)
+        for i in range(10):
+            l = self.Line()
+            l.block = [b1,b2][i%2].id
+            l.length = i
+            self.save(l)
+        self.assertEquals(statements, self.extension(self.Line)._statements)
+
+    def testInstrument(self):
+        b = self.Block()
+        self.save(b)
+        ext = self.extension(self.Line)
+        calls = []
+        stats = ext.instrument(timing=True, callback=lambda *args: calls.append(args))
+        for i in range(3):
+            l = self.Line()
+            l.block = b.id
+            self.session.save(l)
+        self.session.flush()
+        counts = dict((stats.name(ag), c) for ag,c in stats.aggregations.iteritems())
+        self.assertEquals(counts['Average1(blocks.avg)'].recalcs, 3)
+        c = counts['Count(blocks.lines)']
+        self.assert_(c.updates + c.recalcs in (1,3), c)   #coalesced or not
+        self.assert_(c.rows >= 1 and c.seconds > 0, c)
+        group = stats.groups.values()[0]
+        self.assertEquals(len(stats.groups), 1)
+        self.assertEquals(group.updates + group.recalcs, len(calls))
+        self.assert_('blocks: ' in stats.report()['groups'].keys()[0])
+        ext.uninstrument()
+        l = self.Line()
+        l.block = b.id
+        self.save(l)
+        self.assertEquals(group.updates + group.recalcs, len(calls))
+
+    def testFuse(self):
+        'the recalcs of one update share one subselect'
+        from aggregator.aggregation import _supports_rowvalue
+        b = self.Block()
+        self.save(b)
+        ext = self.extension(self.Line)
+        for i in range(3):
+            l = self.Line()
+            l.block = b.id
+            l.length = i+1
+            self.save(l)
+        self.session.delete(l)
+        self.session.flush()
+        self.session.expire(b)
+        self.assertEquals((b.lines, b.length, b.lastline), (2, 3, l.id-1))
+        self.assertAlmostEqual(b.avg, 1.5)
+        if not _supports_rowvalue(self.meta.bind.dialect): return
+        fused = [ c for (aggs,kinds,dialect,upsert),c in ext._statements.iteritems() if kinds.count('recalc') > 1 ]
+        if self.aggregator_class is a.Accurate: self.assert_(fused)   #Quick recalcs only the Max here
+        for c in fused:
+            self.assert_(") = (SELECT" in str(c), str(c))
+            self.assertEquals(str(c).count('SELECT'), 1, str(c))
+
+    def testPlan(self):
+        'aggregations have no per-instance dict; the group plans are made once'
+        for ag in (a.Count(self.blocks.c.lines), a.Max(self.blocks.c.lastline, self.lines.c.id)):
+            self.failIf(hasattr(ag, '__dict__'))
+        b = self.Block()
+        self.save(b)
+        ext = self.extension(self.Line)
+        l = self.Line()
+        l.block = b.id
+        self.save(l)
+        plans = dict(ext._plans)
+        steps = [ p._steps.copy() for p in plans.itervalues() ]
+        l = self.Line()
+        l.block = b.id
+        self.save(l)
+        self.assertEquals(plans, ext._plans)
+        self.assertEquals(steps, [ p._steps for p in ext._plans.itervalues() ])
+
+    def testUnboundMetadata(self):
+        'the dialect is of the flush connection, not of metadata.bind'
+        engine = self.meta.bind
+        self.session = create_session(bind=engine)
+        self.meta.bind = None
+        try:
+            b = self.Block()
+            self.save(b)
+            for i in range(3):
+                l = self.Line()
+                l.block = b.id
+                self.save(l)
+            self.session.delete(l)
+            self.session.flush()
+        finally:
+            self.meta.bind = engine
+        self.session.refresh(b)
+        self.assertEquals((b.lines, b.length), (2, 20))
+        self.avg(b)
+
+    def testUnboundBulkLoad(self):
+        'bulk_load() and rebuild() through a session - the dialect is of its bind, not of metadata.bind'
+        engine = self.meta.bind
+        self.session = create_session(bind=engine)
+        ext = self.extension(self.Line)
+        self.meta.bind = None
+        try:
+            b = self.Block()
+            self.save(b)
+            with ext.bulk_load(self.session):
+                for i in range(3):
+                    l = self.Line()
+                    l.block = b.id
+                    l.length = i+1
+                    self.session.save(l)
+            self.session.refresh(b)
+            self.assertEquals((b.lines, b.length), (3, 6))
+            self.session.execute(self.blocks.update(values=dict(lines=0, length=0)))
+            ext.rebuild(self.session)
+        finally:
+            self.meta.bind = engine
+        self.session.refresh(b)
+        self.assertEquals((b.lines, b.length, b.lastline), (3, 6, l.id))
+        self.avg(b)
+
+    def testFuncChecker(self):
+        dialect = self.meta.bind.dialect
+        fc = a.aggregation._func_checker4dialect(dialect)
+        self.assert_(fc is a.aggregation._func_checker4dialect(dialect))
+        if dialect.name == 'sqlite':
+            self.assertEquals(fc('max'), 'max')     #scalar max(a,b) is native
+        elif dialect.name in ('postgres', 'postgresql', 'mysql'):
+            self.assertEquals((fc('max'), fc('min')), ('greatest', 'least'))
+
+    def testDialectCaches(self):
+        'the caches by dialect keep no dialect alive; statements are shared by alike dialects'
+        import gc, weakref
+        from aggregator.aggregation import _supports_upsert, _supports_returning, _supports_rowvalue, _dialect_key
+        engine = create_engine(self.meta.bind.url)
+        dialect = weakref.ref(engine.dialect)
+        for f in (_supports_upsert, _supports_returning, _supports_rowvalue, a.aggregation._func_checker4dialect):
+            f(engine.dialect)
+        self.assertEquals(_dialect_key(engine.dialect), _dialect_key(self.meta.bind.dialect))
+        del engine
+        gc.collect()
+        self.assert_(dialect() is None)
+
     def testNULL(self):
         b = self.Block()
         b.lines = None
@@ -562,6 +817,78 @@ class RelationsTest(testbase.TestBase):
         self.assertEquals(j.lines, 13)
         self.assertEquals(m.lines, 7)
 
+    def testRefreshRefs(self):
+        ext = self.extension(self.Line)
+        ext.auto_expire_refs = ['block', 'author']
+        ext.refresh_refs = True
+        u = self.User('john')
+        self.save(u)
+        b1 = self.Block()
+        b1.author = u
+        b2 = self.Block()
+        b2.author = u
+        self.save(b1, b2)
+        self.refresh(u, b1, b2)
+        for i in range(10):
+            l = self.Line()
+            l.block = [b1,b2][i%2]
+            l.author = u
+            self.session.save(l)
+        #the selects of the reload after the flush
+        selects = []
+        klas = a.aggregation._FlushState
+        postexec = klas.after_flush_postexec
+        def counting(state, session, flush_context):
+            execute = session.execute
+            def record(clause, *args, **kargs):
+                selects.append(clause)
+                return execute(clause, *args, **kargs)
+            session.execute = record
+            try:
+                return postexec(state, session, flush_context)
+            finally:
+                del session.execute
+        klas.after_flush_postexec = counting
+        try:
+            self.session.flush()
+        finally:
+            klas.after_flush_postexec = postexec
+        self.assertEquals(sorted(t.name for s in selects for t in s.froms), ['blocks', 'users'])   #one per class
+        self.assertEquals(b1.lines, 5)
+        self.assertEquals(b2.lines, 5)
+        self.assertEquals(b2.lastline, l.id)
+        self.assertEquals(u.lines, 10)
+
+    def testReturning(self):
+        ext = self.extension(self.Line)
+        ext.returning = True
+        if not a.aggregation._supports_returning(self.meta.bind.dialect):
+            return
+        u = self.User('john')
+        self.save(u)
+        b1 = self.Block()
+        b1.author = u
+        b2 = self.Block()
+        b2.author = u
+        self.save(b1, b2)
+        self.refresh(u, b1, b2)
+        for i in range(10):
+            l = self.Line()
+            l.block = [b1,b2][i%2]
+            l.author = u
+            self.session.save(l)
+        self.session.flush()
+        #no expire/refresh - values came back with the updates
+        self.assertEquals(b1.lines, 5)
+        self.assertEquals(b2.lines, 5)
+        self.assertEquals(b2.lastline, l.id)
+        self.assertEquals(u.lines, 10)
+        self.session.delete(l)
+        self.session.flush()
+        self.assertEquals(b2.lines, 4)
+        self.assertNotEquals(b2.lastline, l.id)
+        self.assertEquals(u.lines, 9)
+
 class TestBigValue(testbase.TestBase):
 
     def setUp(self):
@@ -675,6 +1002,191 @@ class TestUpdates(testbase.TestBase):
         self.assertEquals(b.minlength, 0)
         self.assertEquals(b.maxlength, 9)
 
+    def testDeleteValue(self):
+        b = self.Block()
+        self.save(b)
+        ls = []
+        for i in range(5):
+            l = self.Line()
+            l.block = b.id
+            l.length = i
+            self.session.save(l)
+            ls.append(l)
+        self.session.flush()
+        for l,minmax in [ (ls[2], (0,4)), (ls[4], (0,3)), (ls[0], (1,3)), (ls[3], (1,1)), (ls[1], (None,None)) ]:
+            self.session.delete(l)
+            self.session.flush()
+            self.session.refresh(b)
+            self.assertEquals(minmax, (b.minlength, b.maxlength))
+
+    def testDeleteValueNoRecalc(self):
+        'deleting a value other than the current extreme does not rescan the source rows'
+        b = self.Block()
+        self.save(b)
+        ls = []
+        for i in range(5):
+            l = self.Line()
+            l.block = b.id
+            l.length = i
+            self.session.save(l)
+            ls.append(l)
+        self.session.flush()
+        self.lines.insert().execute(block=b.id, length=100)    #unseen by the extension - a recalc would find it
+        quick = self.extension(self.Line)._delete_method == 'ondelete'
+        with self.budget(self.Line) as rec:
+            self.session.delete(ls[2])
+            self.session.flush()
+        self.session.refresh(b)
+        if quick:
+            self.assertEquals((b.minlength, b.maxlength), (0, 4))
+            self.failIf([ k for g,n,kinds,act in rec.statements for k in kinds if k == 'recalc' ], str(rec))
+        else:
+            self.assertEquals((b.minlength, b.maxlength), (0, 100))
+        self.session.delete(ls[4])     #the extreme leaving - recalc
+        self.session.flush()
+        self.session.refresh(b)
+        self.assertEquals((b.minlength, b.maxlength), (0, 100))
+
+    def testNullToValue(self):
+        'a value set on a NULL source is a candidate extreme - of Min too'
+        b = self.Block()
+        self.save(b)
+        ls = []
+        for length in (5, 3):
+            l = self.Line()
+            l.block = b.id
+            l.length = length
+            self.session.save(l)
+            ls.append(l)
+        self.session.flush()
+        for length,minmax in [ (None, (5,5)), (1, (1,5)), (None, (5,5)), (7, (5,7)) ]:
+            ls[1].length = length
+            self.session.flush()
+            self.session.refresh(b)
+            self.assertEquals(minmax, (b.minlength, b.maxlength))
+
+class TestDateRebuild(testbase.TestBase):
+    'rebuild() writes the target as the maintenance does - else its recalc_if would not match'
+    def setUp(self):
+        super(TestDateRebuild, self).setUp()
+        blocks = Table('blocks', self.meta,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('lastdate', DateTime),
+            )
+        lines = Table('lines', self.meta,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('block', Integer, ForeignKey(blocks.c.id)),
+            Column('date', DateTime),
+            )
+        class Block(object): pass
+        class Line(object): pass
+        self.Block, self.Line = Block, Line
+        self.meta.create_all()
+        mapper(Block, blocks)
+        mapper(Line, lines, extension=self.aggregator_class(a.Max(blocks.c.lastdate, lines.c.date)))
+
+    def testRebuild(self):
+        import datetime
+        b = self.Block()
+        self.save(b)
+        ext = self.extension(self.Line)
+        ext.off = True
+        ls = []
+        for day in (1, 2):
+            l = self.Line()
+            l.block = b.id
+            l.date = datetime.datetime(2009, 1, day, 10, 0)
+            ls.append(l)
+        self.save(*ls)
+        ext.off = False
+        ext.rebuild(self.session)
+        self.session.refresh(b)
+        self.assertEquals(b.lastdate, ls[1].date)
+        self.session.delete(ls[1])      #the max leaving - recalc_if target = old
+        self.session.flush()
+        self.session.refresh(b)
+        self.assertEquals(b.lastdate, ls[0].date)
+
+class TestDateRebuild2(TestDateRebuild, testbase.TestAccurateMixin):
+    pass
+
+class BulkArrayTest(testbase.TestBase):
+    'bulk_insert of a numpy structured array - same results as of the rows one by one'
+    def setUp(self):
+        try:
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest('no numpy')
+        self.numpy = numpy
+        super(BulkArrayTest, self).setUp()
+        blocks = self.blocks = Table('blocks', self.meta,
+            Column('id', Integer, primary_key=True),
+            Column('lines', Integer),
+            Column('length', Integer),
+            Column('longest', Integer),
+            Column('shortest', Integer),
+            )
+        hosts = self.hosts = Table('hosts', self.meta,
+            Column('host', Integer, primary_key=True),
+            Column('day', Integer, primary_key=True),
+            Column('lines', Integer),
+            Column('length', Integer),
+            )
+        lines = self.lines = Table('lines', self.meta,
+            Column('id', Integer, primary_key=True),
+            Column('block', Integer, ForeignKey(blocks.c.id)),
+            Column('host', Integer),
+            Column('day', Integer),
+            Column('length', Integer),
+            )
+        self.meta.create_all()
+        class Line(object): pass
+        self.Line = Line
+        key = (a.Target(hosts.c.host) == a.Source(lines.c.host)) & (a.Target(hosts.c.day) == a.Source(lines.c.day))
+        mapper(Line, lines,
+            extension=self.aggregator_class(
+                a.Count(blocks.c.lines),
+                a.Sum(blocks.c.length, lines.c.length),
+                a.Max(blocks.c.longest, lines.c.length),
+                a.Min(blocks.c.shortest, lines.c.length),
+                a.Count(hosts.c.lines, key),
+                a.Sum(hosts.c.length, lines.c.length, key),
+            ))
+        self.rows = [ (i+1, i%3+1, i%2, i%5, (i*7)%11) for i in range(30) ]
+
+    def targets(self):
+        self.blocks.delete().execute()
+        self.hosts.delete().execute()
+        self.blocks.insert().execute([ dict(id=b) for b in range(1, 4) ])
+        self.hosts.insert().execute([ dict(host=h, day=d) for h in range(2) for d in range(5) ])
+
+    def state(self):
+        return (
+            [ tuple(r) for r in select([self.blocks], order_by=[self.blocks.c.id]).execute() ],
+            [ tuple(r) for r in select([self.hosts], order_by=[self.hosts.c.host, self.hosts.c.day]).execute() ],
+            )
+
+    def testArray(self):
+        ext = self.extension(self.Line)
+        names = 'id block host day length'.split()
+        self.targets()
+        a.bulk_insert(ext, [ dict(zip(names, r)) for r in self.rows ])
+        expected = self.state()
+        self.lines.delete().execute()
+        self.targets()
+        combine = a.bulk._combine
+        def python_path(*args):
+            self.fail('python path for an array')
+        a.bulk._combine = python_path
+        try:
+            a.bulk_insert(ext, self.numpy.array(self.rows, dtype=[ (n, int) for n in names ]))
+        finally:
+            a.bulk._combine = combine
+        self.assertEquals(self.state(), expected)
+        blocks, hosts = expected
+        self.assertEquals(blocks[0], (1, 10, sum(r[4] for r in self.rows if r[1] == 1),
+                max(r[4] for r in self.rows if r[1] == 1), min(r[4] for r in self.rows if r[1] == 1)))
+
 class SimpleTest2(SimpleTest, testbase.TestAccurateMixin):
     pass
 
@@ -690,5 +1202,20 @@ class TestBigValue2(TestBigValue, testbase.TestAccurateMixin):
 class TestUpdates2(TestUpdates, testbase.TestAccurateMixin):
     pass
 
+class SimpleTest5(SimpleTest, testbase.TestCoalesceMixin):
+    pass
+
+class SimpleTest6(SimpleTest, testbase.TestCoalesceMixin):
+    max_pending = 1     #spill at each target row
+
+class ComplexTest5(ComplexTest, testbase.TestCoalesceMixin):
+    pass
+
+class RelationsTest5(RelationsTest, testbase.TestCoalesceMixin):
+    pass
+
+class TestUpdates5(TestUpdates, testbase.TestCoalesceMixin):
+    pass
+
 if __name__ == '__main__':
     unittest.main()
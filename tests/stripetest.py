@@ -0,0 +1,190 @@
+import testbase
+import unittest
+import aggregator as a
+from aggregator import stripes
+from sqlalchemy import *
+from sqlalchemy.orm import mapper
+
+class StripeTest(testbase.TestBase):
+    def setUp(self):
+        super(StripeTest, self).setUp()
+        blocks = self.blocks = Table('blocks', self.meta,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('lines', Integer),
+            Column('length', Integer),
+            Column('lastline', Integer),
+            )
+        lines = self.lines = Table('lines', self.meta,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('block', Integer, ForeignKey(blocks.c.id)),
+            Column('length', Integer, default=10),
+            )
+        class Block(object): pass
+        class Line(object): pass
+        self.Block, self.Line = Block, Line
+        mapper(Block, blocks)
+        mapper(Line, lines,
+            extension=self.aggregator_class(
+                a.Count(blocks.c.lines, stripes=4),
+                a.Sum(blocks.c.length, lines.c.length, stripes=4),
+                a.Max(blocks.c.lastline, lines.c.id),
+            ))
+        self.meta.create_all()
+        self.stripes_table = self.meta.tables['blocks_stripes']
+
+    def tearDown(self):
+        stripes._local.__dict__.pop('stripe', None)
+        super(StripeTest, self).tearDown()
+
+    def value(self, column, b):
+        return select([a.striped(column)], self.blocks.c.id == b.id).scalar()
+
+    def check(self, *blocks):
+        for b in blocks:
+            lines = self.session.query(self.Line).filter_by(block=b.id).all()
+            self.assertEquals(self.value(self.blocks.c.lines, b), len(lines))
+            self.assertEquals(self.value(self.blocks.c.length, b), sum(l.length for l in lines))
+
+    def makeLines(self):
+        b1 = self.Block()
+        b2 = self.Block()
+        self.save(b1, b2)
+        for i in range(8):
+            stripes._local.stripe = i   #as if by another thread
+            l = self.Line()
+            l.block = [b1,b2][i%2].id
+            l.length = i
+            self.save(l)
+        return b1, b2
+
+    def testInsert(self):
+        b1, b2 = self.makeLines()
+        self.check(b1, b2)
+        self.session.refresh(b1)
+        self.assertEquals((b1.lines, b1.length), (None, None))    #all in stripes
+        self.assertEquals(b1.lastline, 7)                         #not striped
+        rows = self.stripes_table.select(self.stripes_table.c.id == b1.id).execute().fetchall()
+        self.assertEquals(sorted(r.stripe for r in rows), [0, 2])
+        self.assertEquals(sum(r.lines for r in rows), 4)
+
+    def testUpdateMoveDelete(self):
+        b1, b2 = self.makeLines()
+        lines = self.session.query(self.Line).all()
+        lines[0].length = 100
+        lines[1].block = b1.id
+        self.session.flush()
+        self.check(b1, b2)
+        self.session.delete(lines[2])
+        self.session.flush()
+        self.check(b1, b2)
+
+    def testFold(self):
+        b1, b2 = self.makeLines()
+        a.fold_stripes(self.extension(self.Line))
+        self.session.refresh(b1)
+        self.assertEquals((b1.lines, b1.length), (4, 0+2+4+6))
+        st = self.stripes_table
+        self.assertEquals(select([func.sum(st.c.lines), func.sum(st.c.length)]).execute().fetchone(), (0, 0))
+        self.check(b1, b2)
+        l = self.Line()
+        l.block = b1.id
+        l.length = 5
+        self.save(l)
+        self.check(b1, b2)
+
+    def testRebuild(self):
+        b1, b2 = self.makeLines()
+        self.extension(self.Line).rebuild(self.session)
+        self.session.refresh(b1)
+        self.assertEquals((b1.lines, b1.length), (4, 12))
+        self.check(b1, b2)
+
+    def testBulkLoad(self):
+        b1, b2 = self.makeLines()
+        ext = self.extension(self.Line)
+        with ext.bulk_load(self.session):
+            l = self.Line()
+            l.block = b2.id
+            l.length = 1
+            self.session.save(l)
+        self.check(b1, b2)
+
+    def testRace(self):
+        'without upsert: a stripe row inserted meanwhile by another writer is added to'
+        from aggregator.aggregation import _upserts
+        b = self.Block()
+        self.save(b)
+        st = self.stripes_table
+        raced = []
+        class Racing(object):
+            'the connection, where another writer inserts the stripe row just before us'
+            def __init__(me, connection): me.connection = connection
+            def __getattr__(me, name): return getattr(me.connection, name)
+            def execute(me, stmt, **kargs):
+                if not raced and str(stmt).startswith('INSERT'):
+                    raced.append(me.connection.execute(st.insert(),
+                            id=kargs['s_key'], stripe=kargs['s_stripe'], lines=1, length=2).rowcount)
+                return me.connection.execute(stmt, **kargs)
+        ext = self.extension(self.Line)
+        ext._setup(ext.mapper)
+        g = ext._striped.values()[0]
+        apply = g.apply
+        g.apply = lambda deltas, instance, old, connection, execute=None: apply(deltas, instance, old, Racing(connection))
+        dialect = self.meta.bind.dialect
+        _upserts[dialect] = False
+        try:
+            l = self.Line()
+            l.block = b.id
+            l.length = 5
+            self.save(l)
+        finally:
+            del _upserts[dialect]
+            del g.apply
+        self.assertEquals(raced, [1])
+        self.assertEquals((self.value(self.blocks.c.lines, b), self.value(self.blocks.c.length, b)), (2, 7))
+
+    def testBudget(self):
+        'the stripe statements are in the budget too'
+        b = self.Block()
+        self.save(b)
+        ext = self.extension(self.Line)
+        ext._setup(ext.mapper)
+        with self.budget(self.Line, 3) as rec:     #stripe: upsert, or update+insert; the target (Max)
+            l = self.Line()
+            l.block = b.id
+            l.length = 5
+            self.save(l)
+        self.assertEquals(bool(ext._striped), bool([ act for g,n,kinds,act in rec.statements if 'stripe' in kinds ]), str(rec))
+        self.check(b)
+
+class StripeTest2(StripeTest, testbase.TestAccurateMixin):
+    'Accurate recalculates the target columns; the stripes stay unused, striped() is the target'
+    def testInsert(self):
+        b1, b2 = self.makeLines()
+        self.check(b1, b2)
+        self.session.refresh(b1)
+        self.assertEquals((b1.lines, b1.length, b1.lastline), (4, 0+2+4+6, 7))
+        self.assertEquals(self.stripes_table.count().scalar(), 0)
+    def testFold(self):
+        'nothing to fold'
+        b1, b2 = self.makeLines()
+        a.fold_stripes(self.extension(self.Line))
+        self.session.refresh(b1)
+        self.assertEquals((b1.lines, b1.length), (4, 0+2+4+6))
+        self.assertEquals(self.stripes_table.count().scalar(), 0)
+        self.check(b1, b2)
+    def testRace(self):
+        'no stripe rows written at all'
+        b = self.Block()
+        self.save(b)
+        l = self.Line()
+        l.block = b.id
+        self.save(l)
+        self.assertEquals(self.stripes_table.count().scalar(), 0)
+        self.check(b)
+
+class StripeTest5(StripeTest, testbase.TestCoalesceMixin):
+    pass
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,7 @@ suite = unittest.TestSuite()
 verbosity = sys.argv.count( '-v')
 tests = [a for a in sys.argv[1:] if a != '-v']
 if not tests:
-    tests = 'convertertest simpletest conditiontest guesstest'.split()
+    tests = 'convertertest simpletest conditiontest guesstest writebehindtest triggertest intercepttest benchtest budgettest stripetest locktest upserttest rolluptest cascadetest distincttest'.split()
 
 for test in tests:
     suite.addTest( unittest.TestLoader().loadTestsFromName( test))
@@ -10,8 +10,9 @@ except: echo = False
 else:   echo = True
 
 import unittest
-from sqlalchemy import Table, MetaData
-from sqlalchemy.orm import create_session
+from contextlib import contextmanager
+from sqlalchemy import Table, MetaData, create_engine
+from sqlalchemy.orm import create_session, class_mapper
 import aggregator as a
 
 class TestBase(unittest.TestCase):
@@ -24,8 +25,12 @@ class TestBase(unittest.TestCase):
             for k,v in kwargs.iteritems():
                 setattr( self, k, v)
 
+    def engine_options(self):
+        'keyword args of create_engine()'
+        return {}
+
     def setUp(self):
-        meta = self.meta = MetaData(bind=dburl)
+        meta = self.meta = MetaData(bind=create_engine(dburl, **self.engine_options()))
         meta.bind.echo = echo
         self.session = create_session()
 
@@ -43,7 +48,65 @@ class TestBase(unittest.TestCase):
         for ob in objs:
             self.session.refresh(ob)
 
+    def extension(self, klas):
+        for ext in class_mapper(klas).extension:
+            if isinstance(ext, a.Quick):
+                return ext
+
+    @contextmanager
+    def budget(self, klas, most=None, **match):
+        """record the statements issued by the aggregations of klas inside;
+        if most is given, assert no more than that many were issued
+        (of those matching - see StatementRecorder.count)"""
+        rec = StatementRecorder(self.extension(klas))
+        try:
+            yield rec
+        finally:
+            rec.stop()
+        if most is not None:
+            n = rec.count(**match)
+            self.assert_(n <= most, 'budget %s exceeded: %s statements\n%s' % (most, n, rec))
+
+class StatementRecorder(object):
+    """records the statements of an aggregating extension, via Quick.instrument():
+    one (group, aggregations, kinds, action) per statement, where group is
+    (target table, filter), aggregations are names as of Stats.name()"""
+    def __init__(self, ext):
+        self.ext = ext
+        self.statements = []
+        self._stats = ext.stats
+        ext.instrument(callback=self.record)
+
+    def record(self, ext, aggs, kinds, action, rowcount, seconds):
+        stats = ext.stats
+        names = tuple(stats.name(ag) for ag,k in zip(aggs, kinds) if k is not None)
+        self.statements.append((stats.group_key(aggs), names, kinds, action))
+
+    def stop(self):
+        self.ext.stats = self._stats
+
+    def count(self, action=None, aggregation=None, table=None):
+        n = 0
+        for group, names, kinds, act in self.statements:
+            if action is not None and act != action: continue
+            if aggregation is not None and aggregation not in names: continue
+            if table is not None and group[0] != table: continue
+            n += 1
+        return n
+
+    def __str__(self):
+        return '\n'.join('%s %s %s %s' % (g[0], act, ','.join(names), kinds)
+                        for g, names, kinds, act in self.statements)
+
 class TestAccurateMixin(unittest.TestCase):
     def __init__(self, arg):
         self.aggregator_class = a.Accurate
         return super(TestAccurateMixin, self).__init__(arg)
+
+class TestCoalesceMixin(unittest.TestCase):
+    max_pending = 10000
+    def __init__(self, arg):
+        def aggregator_class(*aggs, **kargs):
+            return a.Quick(coalesce=True, max_pending=self.max_pending, *aggs, **kargs)
+        self.aggregator_class = aggregator_class
+        return super(TestCoalesceMixin, self).__init__(arg)
@@ -0,0 +1,105 @@
+import testbase
+import unittest
+import aggregator as a
+from aggregator import triggers
+import simpletest
+import conditiontest
+
+class TriggerMixin(unittest.TestCase):
+    'the aggregations done by db triggers, extension is off'
+    source_class = 'Line'
+    def setUp(self):
+        super(TriggerMixin, self).setUp()
+        self.ext = self.extension(getattr(self, self.source_class))
+        triggers.create_triggers(self.ext)
+    def tearDown(self):
+        triggers.drop_triggers(self.ext)
+        super(TriggerMixin, self).tearDown()
+
+class SimpleTriggerTest(TriggerMixin, simpletest.SimpleTest):
+    def testCoreInsert(self):
+        b = self.Block()
+        self.save(b)
+        self.lines.insert().execute([dict(block=b.id, length=i) for i in range(5)])
+        self.lines.delete(self.lines.c.length == 4).execute()
+        self.refresh(b)
+        self.assertEquals(b.lines, 4)
+        self.assertEquals(b.length, 6)
+        self.assertEquals(b.lastline, 4)
+        self.avg(b)
+    def testDDL(self):
+        for dialect in ('sqlite', 'postgres', 'mysql'):
+            ddl = triggers.trigger_ddl(self.ext, dialect)
+            self.assertEquals(len(ddl), dialect == 'postgres' and 6 or 3)
+            ddl = ''.join(ddl)
+            self.assert_('NEW.' in ddl and 'OLD.' in ddl, ddl)
+            self.assert_(':' not in ddl, ddl)  #no bindparams left
+    def testBulkLoadScope(self):
+        'the triggers maintain all, also inside (nested) bulk_load()'
+        b = self.Block()
+        self.save(b)
+        with self.ext.bulk_load(self.session):
+            with self.ext.bulk_load(self.session):
+                l = self.Line()
+                l.block = b.id
+                l.length = 3
+                self.save(l)
+            self.refresh(b)
+            self.assertEquals((b.lines, b.length), (1, 3))
+        self.refresh(b)
+        self.assertEquals((b.lines, b.length), (1, 3))
+    def testBulkLoad(self):
+        'inside bulk_load() the triggers keep the totals; the recalc at exit agrees'
+        b1 = self.Block()
+        b2 = self.Block()
+        self.save(b1, b2)
+        with self.ext.bulk_load(self.session):
+            for i in range(10):
+                l = self.Line()
+                l.block = b1.id
+                l.length = i
+                self.session.save(l)
+            self.session.flush()
+            self.refresh(b1)
+            self.assertEquals((b1.lines, b1.length), (10, 45))
+            l.length = 20
+            l.block = b2.id
+        self.refresh(b1, b2)
+        self.assertEquals((b1.lines, b1.length, b2.lines, b2.length), (9, 36, 1, 20))
+        self.assertEquals(b2.lastline, l.id)
+        self.avg(b1)
+        self.avg(b2)
+    def testStatementCache(self):
+        'the extension is off - nothing compiled nor issued by it'
+        b = self.Block()
+        self.save(b)
+        for i in range(3):
+            l = self.Line()
+            l.block = b.id
+            l.length = i
+            self.save(l)
+        self.assertEquals(self.ext._statements, {})
+        self.refresh(b)
+        self.assertEquals((b.lines, b.length), (3, 3))
+    def testInstrument(self):
+        'the extension is off - no statements counted, the totals still kept'
+        b = self.Block()
+        self.save(b)
+        calls = []
+        stats = self.ext.instrument(callback=lambda *args: calls.append(args))
+        l = self.Line()
+        l.block = b.id
+        self.save(l)
+        self.ext.uninstrument()
+        self.assertEquals((stats.aggregations, calls), ({}, []))
+        self.refresh(b)
+        self.assertEquals(b.lines, 1)
+
+class TestBlogTriggers(TriggerMixin, conditiontest.TestBlog):
+    source_class = 'BlogEntry'
+
+class TestRecentTriggers(TriggerMixin, conditiontest.TestRecent):
+    source_class = 'Post'
+
+if __name__ == '__main__':
+    unittest.main()
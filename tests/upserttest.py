@@ -0,0 +1,126 @@
+import testbase
+import unittest
+import aggregator as a
+from datetime import date
+from sqlalchemy import *
+from sqlalchemy.orm import mapper
+
+class UpsertTest(testbase.TestBase):
+    'daily stats - the rows are made by the first post of the day'
+    returning = False
+    def setUp(self):
+        super(UpsertTest, self).setUp()
+        stats = self.stats = Table('stats', self.meta,
+            Column('date', Date, primary_key=True),
+            Column('posts', Integer),
+            Column('words', Integer),
+            Column('longest', Integer),
+            )
+        blog = self.blog = Table('blog', self.meta,
+            Column('id', Integer, primary_key=True),
+            Column('date', Date),
+            Column('words', Integer),
+            )
+        self.meta.create_all()
+        class BlogEntry(self.EasyInit): pass
+        class StatRow(object): pass
+        self.BlogEntry, self.StatRow = BlogEntry, StatRow
+        day = a.Target(stats.c.date) == a.Source(blog.c.date)
+        mapper(BlogEntry, blog,
+            extension=self.aggregator_class(
+                a.Count(stats.c.posts, day),
+                a.Sum(stats.c.words, blog.c.words, day),
+                a.Max(stats.c.longest, blog.c.words, day),
+                upsert=True, returning=self.returning,
+            ))
+        mapper(StatRow, stats)
+
+    def check(self):
+        self.session.expire_all()
+        entries = self.session.query(self.BlogEntry).all()
+        days = set(e.date for e in entries)
+        rows = dict((r.date, r) for r in self.session.query(self.StatRow).all())
+        self.assert_(days <= set(rows), (days, rows))
+        for d in days:
+            words = [ e.words for e in entries if e.date == d ]
+            r = rows[d]
+            self.assertEquals((r.posts, r.words, r.longest), (len(words), sum(words), max(words)))
+
+    def makeEntries(self):
+        entries = [ self.BlogEntry(date=date(2001,1,d), words=w)
+                    for d,w in [(1,10), (2,20), (2,5), (3,7)] ]
+        self.save(*entries)
+        return entries
+
+    def testInsert(self):
+        self.makeEntries()
+        self.assertEquals(self.session.query(self.StatRow).count(), 3)
+        self.check()
+
+    def testUpdateMove(self):
+        entries = self.makeEntries()
+        entries[0].words = 30
+        entries[1].date = date(2001,1,4)    #new day
+        self.session.flush()
+        self.check()
+        r = self.session.query(self.StatRow).get(date(2001,1,2))
+        self.assertEquals((r.posts, r.words, r.longest), (1, 5, 5))
+
+    def testDelete(self):
+        entries = self.makeEntries()
+        self.session.delete(entries[3])
+        self.session.flush()
+        self.check()
+        r = self.session.query(self.StatRow).get(date(2001,1,3))
+        self.assertEquals((r.posts, r.words or 0), (0, 0))  #stays, not made again
+
+    def testBudget(self):
+        'the insert ensuring the target row is in the budget too'
+        entries = self.makeEntries()
+        with self.budget(self.BlogEntry) as rec:
+            entries[1].words = 1    #the longest of the day leaving - not seedable
+            self.session.flush()
+        ensure = [ act for g,n,kinds,act in rec.statements if 'ensure' in kinds ]
+        pending = self.extension(self.BlogEntry).coalesce and 1 or 0    #the Sum delta, after the flush
+        self.assertEquals((len(ensure), rec.count()), (1, 2+pending), str(rec))
+        self.check()
+
+    def testKeys(self):
+        'upsert only if the filter is a unique key of the target == source values'
+        ext = self.extension(self.BlogEntry)
+        ext._setup(ext.mapper)
+        plan, = ext._plans.values()
+        self.assertEquals([ c for c,v in plan.keys ], [ self.stats.c.date ])
+        ag = a.Count(self.stats.c.posts,
+                (a.Target(self.stats.c.date) == a.Source(self.blog.c.date)) & (self.blog.c.words > 0))
+        ag._initialize(self.blog)
+        self.assertEquals(a.aggregation._upsert_keys(ag), None)
+        ag = a.Count(self.stats.c.posts, a.Target(self.stats.c.posts) == a.Source(self.blog.c.words))
+        ag._initialize(self.blog)
+        self.assertEquals(a.aggregation._upsert_keys(ag), None)
+
+    def testStatement(self):
+        try:
+            from sqlalchemy.databases import mysql, postgres
+        except ImportError:
+            from sqlalchemy.dialects import mysql, postgresql as postgres
+        ext = self.extension(self.BlogEntry)
+        ext._setup(ext.mapper)
+        aggs, = ext.aggregations.values()
+        kinds = ('delta', 'delta', None)
+        for dialect, clause in [ (mysql.dialect(), 'ON DUPLICATE KEY UPDATE'),
+                                 (postgres.dialect(), 'ON CONFLICT (date) DO UPDATE SET') ]:
+            stmt = ext._upsert(aggs, kinds, dialect, ext._plans[id(aggs)].keys)
+            text = str(stmt.compile(dialect=dialect))
+            self.assert_(text.startswith('INSERT INTO stats') and clause in text, text)
+            self.failIf('longest' in text, text)
+
+class UpsertTest2(UpsertTest, testbase.TestAccurateMixin):
+    pass
+class UpsertTest5(UpsertTest, testbase.TestCoalesceMixin):
+    pass
+class UpsertTestReturning(UpsertTest):
+    returning = True
+
+if __name__ == '__main__':
+    unittest.main()
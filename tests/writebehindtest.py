@@ -0,0 +1,164 @@
+import testbase
+import unittest
+import aggregator as a
+from sqlalchemy import *
+from sqlalchemy.orm import create_session, mapper
+import os, tempfile
+
+class WriteBehindTest(testbase.TestBase):
+
+    def setUp(self):
+        if testbase.dburl.startswith('sqlite:///:memory:'):
+            # the flusher thread needs to see same db on its own connection
+            fd, self.dbfile = tempfile.mkstemp(suffix='.db')
+            os.close(fd)
+            testbase.dburl, dburl = 'sqlite:///' + self.dbfile, testbase.dburl
+            try:
+                super(WriteBehindTest, self).setUp()
+            finally:
+                testbase.dburl = dburl
+        else:
+            self.dbfile = None
+            super(WriteBehindTest, self).setUp()
+        blocks = Table('blocks', self.meta,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('lines', Integer),
+            Column('lastline', Integer),
+            Column('length', Integer),
+            Column('avg', Float),
+            )
+        lines = Table('lines', self.meta,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('block', Integer, ForeignKey(blocks.c.id)),
+            Column('length', Integer, default=10),
+            )
+        class Block(object):
+            pass
+        class Line(object):
+            pass
+        self.Block = Block
+        self.Line = Line
+        self.meta.create_all()
+        self.ext = a.WriteBehind(
+                a.Max( blocks.c.lastline, lines.c.id),
+                a.Count( blocks.c.lines),
+                a.Sum( blocks.c.length, lines.c.length),
+                a.Average1( blocks.c.avg, lines.c.length),
+                interval=60)
+        mapper(Block, blocks)
+        mapper(Line, lines, extension=self.ext)
+
+    def tearDown(self):
+        self.ext.shutdown()
+        super(WriteBehindTest, self).tearDown()
+        if self.dbfile:
+            os.remove(self.dbfile)
+
+    def testInsertDelete(self):
+        b1 = self.Block()
+        b2 = self.Block()
+        self.save(b1, b2)
+        for i in range(10):
+            l = self.Line()
+            l.block = [b1,b2][i%2].id
+            l.length = i
+            self.session.save(l)
+        self.session.flush()
+        self.refresh(b1)
+        self.assertEquals(b1.lines, None)   #not yet
+        self.ext.drain()
+        self.refresh(b1, b2)
+        self.assertEquals((b1.lines, b2.lines), (5, 5))
+        self.assertEquals((b1.length, b2.length), (20, 25))
+        self.assertEquals(b2.lastline, l.id)
+        self.assertEquals(b2.avg, 5)
+        self.session.delete(l)
+        l = self.session.query(self.Line).filter_by(block=b1.id).first()
+        l.length = 100
+        self.session.flush()
+        self.ext.drain()
+        self.refresh(b1, b2)
+        self.assertEquals((b1.lines, b2.lines), (5, 4))
+        self.assertEquals((b1.length, b2.length), (120, 16))
+        self.assertNotEquals(b2.lastline, l.id)
+        self.assertEquals(b2.avg, 4)
+
+    def testRollback(self):
+        b = self.Block()
+        self.save(b)
+        self.session.begin()
+        l = self.Line()
+        l.block = b.id
+        self.session.save(l)
+        self.session.flush()
+        self.session.rollback()
+        self.ext.drain()
+        self.refresh(b)
+        self.assertEquals(b.lines, None)
+
+    def savepointable(self):
+        'a session where begin_nested() works - pysqlite needs explicit BEGIN for it'
+        bind = self.meta.bind
+        if bind.dialect.name != 'sqlite': return create_session()
+        engine = create_engine(bind.url, connect_args=dict(isolation_level=None))
+        engine.dialect.do_begin = lambda connection: connection.execute('BEGIN')
+        return create_session(bind=engine)
+
+    def testSavepoint(self):
+        'a rolled back savepoint drops only its own changes'
+        b = self.Block()
+        self.save(b)
+        session = self.savepointable()
+        def line(length):
+            l = self.Line()
+            l.block = b.id
+            l.length = length
+            session.save(l)
+            session.flush()
+        session.begin()
+        line(1)
+        session.begin_nested()
+        line(2)
+        session.rollback()      #the savepoint
+        session.begin_nested()
+        line(4)
+        session.begin_nested()
+        line(8)
+        session.rollback()
+        session.commit()        #released into the outer one
+        session.commit()
+        session.close()
+        self.ext.drain()
+        self.refresh(b)
+        self.assertEquals((b.lines, b.length), (2, 5))
+
+    def testShutdown(self):
+        b = self.Block()
+        self.save(b)
+        l = self.Line()
+        l.block = b.id
+        self.save(l)
+        self.ext.shutdown()
+        self.refresh(b)
+        self.assertEquals(b.lines, 1)
+
+    def testDeadlockRetry(self):
+        b = self.Block()
+        self.save(b)
+        apply = self.ext._apply
+        failures = []
+        def deadlocking(pending, connection):
+            if len(failures) < 2:
+                failures.append(1)
+                raise Exception(1213, 'Deadlock found when trying to get lock')
+            return apply(pending, connection)
+        self.ext._apply = deadlocking
+        l = self.Line()
+        l.block = b.id
+        self.save(l)
+        self.ext.drain()
+        self.refresh(b)
+        self.assertEquals((len(failures), b.lines), (2, 1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+#$Id$
+
+'''Native database triggers, equivalent to the aggregations maintained by a
+Quick/Accurate mapper extension - for sqlite, postgres and mysql.
+The maintenance is then done inside the database, also for changes not going
+through the mapper (e.g. plain sql / Core executemany).
+
+Usage:
+    create_triggers( extension, bind =None)    #extension is switched off
+    drop_triggers( extension, bind =None)      #extension is switched on
+    trigger_ddl( extension, dialect)           #the create statements, offline
+    drop_ddl( extension, dialect)
+dialect - Dialect instance or name: sqlite, postgres, mysql
+
+Per source table: AFTER INSERT does the NEW row as insert, AFTER DELETE does
+the OLD row as delete, AFTER UPDATE both. Delta-able aggregations (Count, Sum,
+Max, Min) use their delta expressions, others a correlated recalc of the
+target row (see _Aggregation.recalc4set). Filters computed per instance
+(callable) cannot be done this way.
+'''
+
+import operator
+import datetime
+import sqlalchemy
+from sqlalchemy import literal_column
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.expression import _BindParamClause
+from aggregation import Quick, _Aggregation, Converter, _func_checker4dialect
+
+def _dialect( dialect):
+    if not isinstance( dialect, basestring): return dialect
+    try:
+        module = __import__( 'sqlalchemy.databases.'+dialect, fromlist= ['dialect'])    #SA0.5
+    except ImportError:
+        name = dict( postgres= 'postgresql').get( dialect, dialect)
+        module = __import__( 'sqlalchemy.dialects.'+name, fromlist= ['dialect'])
+    return module.dialect()
+
+def _is_postgres( dialect):
+    return dialect.name in ('postgres', 'postgresql')
+
+def _sql_literal( value, type_, dialect):
+    '''value as sql text, in the format SA binds it for dialect - e.g. sqlite
+    datetimes as strings, compared as such with the stored ones'''
+    process = type_.dialect_impl( dialect).bind_processor( dialect)
+    if process is not None: value = process( value)
+    if value is None: return 'NULL'
+    if isinstance( value, bool): return str( int( value))
+    if isinstance( value, (int, long, float)): return repr( value)
+    if isinstance( value, (datetime.date, datetime.time)): value = value.isoformat()
+    return "'" + unicode( value).replace( "'", "''") + "'"
+
+class _RowRef( object):
+    'the NEW/OLD row, as instance-like: attributes by column name, key and mapper property'
+    def __init__( self, ext, which, dialect):
+        quote = dialect.identifier_preparer.quote_identifier
+        mapper = ext.mapper
+        for c in ext.local_table.columns:
+            col = literal_column( which+'.'+quote( c.name), type_= c.type)
+            setattr( self, c.name, col)
+            setattr( self, c.key, col)
+            try:
+                setattr( self, mapper._columntoproperty[ c].key, col)
+            except KeyError: pass
+
+def _inline( expr, row, dialect):
+    'replace the bindparams: filter ones with the row columns, others with their literal values'
+    pfx = Converter._pfx
+    def replace( e):
+        if not isinstance( e, _BindParamClause): return None
+        if pfx and e.key.startswith( pfx):
+            return getattr( row, e.key[ len( pfx):])
+        return literal_column( _sql_literal( e.value, e.type, dialect), type_= e.type)
+    return visitors.replacement_traverse( expr, {}, replace)
+
+def _change( a, fc, row, insert):
+    'dict of target-column names/expressions for row being inserted (else deleted)'
+    d = a._delta_combine and a.delta( 'oninsert', row)
+    if d is not None:
+        if insert:
+            return { a.target.name: a.apply_delta( fc, d) }
+        if a._delta_combine is operator.add:
+            return { a.target.name: a.apply_delta( fc, d * -1) }   #no unary minus on SA0.5 columns
+        if a.__class__.recalc_if.im_func is not _Aggregation.recalc_if.im_func:
+            recalc = a.recalc4set()[ a.target.name]
+            return { a.target.name: a.recalc_if( fc, d, recalc) }
+    return a.recalc4set()
+
+def _statements( ext, dialect, insert):
+    'the sql text of one update per aggregation group, for NEW row inserted / OLD row deleted'
+    fc = _func_checker4dialect( dialect)
+    row = _RowRef( ext, insert and 'NEW' or 'OLD', dialect)
+    r = []
+    for aggs in ext.aggregations.itervalues():
+        ag = aggs[0]
+        fexpr = ag._filter4mapper[0]
+        if callable( fexpr):
+            raise NotImplementedError( 'triggers: filter of %s is computed per instance' % ag.target_table)
+        values = dict()
+        for a in aggs:
+            values.update( _change( a, fc, row, insert))
+        values = dict( (k, _inline( v, row, dialect)) for k,v in values.iteritems())
+        stmt = ag.target_table.update( _inline( fexpr, row, dialect), values= values)
+        r.append( unicode( stmt.compile( dialect= dialect, column_keys= [])))
+    return r
+
+_actions = dict( insert= [True], delete= [False], update= [False, True])
+
+def _name( ext, action):
+    return 'ag_%s_%s' % (ext.local_table.name, action)
+
+def trigger_ddl( ext, dialect):
+    'list of statements creating the triggers (and trigger functions for postgres)'
+    dialect = _dialect( dialect)
+    ext._setup( ext.mapper)
+    table = dialect.identifier_preparer.format_table( ext.local_table)
+    r = []
+    for action in ('insert', 'delete', 'update'):
+        body = []
+        for insert in _actions[ action]:
+            body += _statements( ext, dialect, insert)
+        body = ''.join( '\n    %s;' % s for s in body)
+        name = _name( ext, action)
+        a = dict( name= name, action= action.upper(), table= table, body= body)
+        if _is_postgres( dialect):
+            r.append( 'CREATE FUNCTION %(name)s() RETURNS trigger AS $$\nBEGIN%(body)s\n    RETURN NULL;\nEND\n$$ LANGUAGE plpgsql' % a)
+            r.append( 'CREATE TRIGGER %(name)s AFTER %(action)s ON %(table)s FOR EACH ROW EXECUTE PROCEDURE %(name)s()' % a)
+        else:   #sqlite, mysql
+            r.append( 'CREATE TRIGGER %(name)s AFTER %(action)s ON %(table)s FOR EACH ROW\nBEGIN%(body)s\nEND' % a)
+    return r
+
+def drop_ddl( ext, dialect):
+    dialect = _dialect( dialect)
+    table = dialect.identifier_preparer.format_table( ext.local_table)
+    r = []
+    for action in ('insert', 'delete', 'update'):
+        name = _name( ext, action)
+        if _is_postgres( dialect):
+            r.append( 'DROP TRIGGER IF EXISTS %s ON %s' % (name, table))
+            r.append( 'DROP FUNCTION IF EXISTS %s()' % name)
+        else:
+            r.append( 'DROP TRIGGER IF EXISTS %s' % name)
+    return r
+
+def create_triggers( ext, bind =None):
+    '''create the triggers and switch the extension off, as the db does it all.
+    bind - Connection or Engine; default is the metadata.bind'''
+    ext._setup( ext.mapper)
+    if bind is None: bind = ext.local_table.metadata.bind
+    for ddl in trigger_ddl( ext, bind.dialect):
+        bind.execute( ddl)
+    ext.off = True
+
+def drop_triggers( ext, bind =None):
+    if bind is None: bind = ext.local_table.metadata.bind
+    for ddl in drop_ddl( ext, bind.dialect):
+        bind.execute( ddl)
+    ext.off = False
+
+# vim:ts=4:sw=4:expandtab